@@ -1,21 +1,67 @@
 import re
+import json
+import hashlib
 import requests
 from io import BytesIO
 from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional
+from sqlalchemy import text
 from sqlalchemy.orm import Session
 import google.generativeai as genai
 from PIL import Image
-from app.database import models
-import asyncio
+from app import config
+from app.database import crud, models
+from app.utils.redis_helper import r
+from app.utils.keyword_matcher import get_knowledge_matcher
 import time
 import random
+from concurrent.futures import Future, ThreadPoolExecutor
 
-# simple cache
-_cache_text = {}
-_cache_image = {}
+# pool สำหรับดาวน์โหลด + ทำ caption รูป (สร้างเมื่อใช้ครั้งแรก)
+_image_pool = None
 
+# GenerativeModel ต่อชื่อ model (สร้างครั้งเดียวต่อ process)
+_models = {}
+
+# ค่าใน cache เมื่อ Gemini ตอบว่าไม่ชัดเจน (ให้คงหมวดเดิมของลูกค้า)
+_UNCLEAR = "0"
+
+
+# ลูกค้าที่คุยหลัง classification ล่าสุด (และไม่ได้คุยใน 1 ชม.) พร้อมข้อความล่าสุดหลัง classification นั้น
+_CANDIDATES_SQL = text("""
+    WITH last_cls AS (
+        SELECT DISTINCT ON (customer_id) customer_id, new_category_id, classified_at
+        FROM fb_customer_classifications
+        WHERE page_id = :page_id
+        ORDER BY customer_id, classified_at DESC
+    )
+    SELECT c.id, c.customer_psid, lc.new_category_id AS old_category_id,
+           m.message_text, m.message_type
+    FROM fb_customers c
+    LEFT JOIN last_cls lc ON lc.customer_id = c.id
+    JOIN LATERAL (
+        SELECT cm.message_text, cm.message_type
+        FROM customer_messages cm
+        WHERE cm.customer_id = c.id
+          AND (lc.classified_at IS NULL OR cm.created_at > lc.classified_at)
+        ORDER BY cm.created_at DESC
+        LIMIT 1
+    ) m ON TRUE
+    WHERE c.page_id = :page_id
+      AND (lc.classified_at IS NULL OR lc.classified_at <= c.last_interaction_at)
+      AND (c.last_interaction_at IS NULL OR c.last_interaction_at <= now() - interval '1 hour')
+      AND m.message_text <> ''
+    ORDER BY c.id
+""")
+
+
+def classify_and_assign_tier_hybrid(db: Session, page_id):
+    # page_id อาจเป็น database ID หรือ facebook page_id
+    page = crud.get_page_ref(db, page_id) if isinstance(page_id, str) else crud.get_page_ref_by_db_id(db, page_id)
+    if not page:
+        return
+    page_id = page.ID
 
-def classify_and_assign_tier_hybrid(db: Session, page_id: int):
     # 1️⃣ โหลด knowledge config ที่ enabled
     enabled_knowledge_ids = [
         pk.customer_type_knowledge_id
@@ -34,155 +80,96 @@ def classify_and_assign_tier_hybrid(db: Session, page_id: int):
         .all()
     }
 
-    # 2️⃣ โหลด tier config
-    tier_configs = (
-        db.query(models.RetargetTiersConfig)
-        .filter(models.RetargetTiersConfig.page_id == page_id)
-        .order_by(models.RetargetTiersConfig.days_since_last_contact.asc())
-        .all()
-    )
-
-    customers = (
-        db.query(models.FbCustomer)
-        .filter(models.FbCustomer.page_id == page_id)
-        .all()
+    # 2️⃣ หา candidate ทั้งหมดด้วย query เดียว แล้วอ่านทีละ chunk (server-side cursor)
+    result = db.connection().execution_options(stream_results=True).execute(
+        _CANDIDATES_SQL, {"page_id": page_id}
     )
 
-    now = datetime.now(timezone.utc)
     pending_updates = []
-
-    for cust in customers:
-        # ✅ classification ล่าสุด
-        last_classification = (
-            db.query(models.FBCustomerClassification)
-            .filter(models.FBCustomerClassification.customer_id == cust.id)
-            .order_by(models.FBCustomerClassification.classified_at.desc())
-            .first()
+    classified_count = 0
+    keyword_matcher = get_knowledge_matcher(knowledge_map)
+    for rows in result.partitions(config.CLASSIFICATION_CANDIDATE_CHUNK_SIZE):
+        # 3️⃣ Classification (keyword ทันที, รูปภาพทำ caption ใน pool คู่ขนาน, ข้อความที่เหลือรวมส่ง Gemini ทีเดียว)
+        candidates = []
+        for row in rows:
+            category_id = None
+            gemini_text = None
+            image_url = None
+            if row.message_type == "text":
+                category_id = match_by_keyword(row.message_text, knowledge_map, keyword_matcher)
+                if not category_id:
+                    gemini_text = row.message_text
+            elif row.message_type == "attachment":
+                if re.search(r'\.(png|jpe?g)(\?.*)?$', row.message_text, re.IGNORECASE):
+                    image_url = row.message_text
+            candidates.append((row, category_id, gemini_text, image_url))
+
+        caption_futures = submit_image_captions(url for _, _, _, url in candidates if url)
+        gemini_results = classify_texts_with_gemini(
+            [text for _, _, text, _ in candidates if text], knowledge_map
         )
-        old_category_id = last_classification.new_category_id if last_classification else None
-
-        last_message = None
-        if last_classification:
-            if last_classification.classified_at > cust.last_interaction_at:
-                # ✅ เคยจัดกลุ่มใหม่กว่าการคุยล่าสุด → ไม่ต้องจัดซ้ำ
-                print(f"⏭ Skip {cust.id}: already classified at {last_classification.classified_at}")
-                continue
-            else:
-                # 🔄 จัดใหม่จากข้อความหลัง classified_at
-                last_message = (
-                    db.query(models.CustomerMessage.message_text,
-                             models.CustomerMessage.message_type)
-                    .filter(
-                        models.CustomerMessage.customer_id == cust.id,
-                        models.CustomerMessage.created_at > last_classification.classified_at
-                    )
-                    .order_by(models.CustomerMessage.created_at.desc())
-                    .first()
+        image_results = classify_image_captions(caption_futures, knowledge_map)
+
+        # 4️⃣ Insert classification ที่เปลี่ยน (bulk)
+        classified_at = datetime.now(timezone.utc)
+        new_classifications = []
+        for row, category_id, gemini_text, image_url in candidates:
+            if image_url:
+                category_id = image_results.get(image_url)
+            if gemini_text:
+                # ไม่ชัดเจน → คงหมวดเดิม, เรียก API ไม่สำเร็จ → None
+                category_id = gemini_results.get(gemini_text) or (
+                    row.old_category_id if gemini_text in gemini_results else None
                 )
-        else:
-            # ถ้ายังไม่เคยมี classification → ใช้ข้อความล่าสุดทั้งหมด
-            last_message = (
-                db.query(models.CustomerMessage.message_text,
-                         models.CustomerMessage.message_type)
-                .filter(models.CustomerMessage.customer_id == cust.id)
-                .order_by(models.CustomerMessage.created_at.desc())
-                .first()
-            )
-
-        if not last_message:
-            continue
-
-        message_text, message_type = last_message
-        if not message_text:
-            continue
-
-        # 3️⃣ Classification
-        category_id = None
-        if message_type == "text":
-            category_id = match_by_keyword(message_text, knowledge_map)
-            if not category_id:
-                category_id = classify_with_gemini(
-                    message_text,
-                    knowledge_map,
-                    prev_category_id=old_category_id
-                )
-        elif message_type == "attachment":
-            if re.search(r'\.(png|jpe?g)(\?.*)?$', message_text, re.IGNORECASE):
-                category_id = classify_with_gemini_image(message_text, knowledge_map)
-
-        # ⏳ Skip ลูกค้าที่เพิ่งคุย <1 ชม.
-        if cust.last_interaction_at:
-            diff_hours = (now - cust.last_interaction_at).total_seconds() / 3600
-            if diff_hours < 1:
-                print(f"⏳ Skip {cust.id}: last_interaction_at {diff_hours:.2f}h < 1h")
+            if not category_id or category_id == row.old_category_id:
                 continue
 
-        # 4️⃣ Insert classification ถ้าเปลี่ยน
-        if category_id and category_id != old_category_id:
-            new_classification = models.FBCustomerClassification(
-                customer_id=cust.id,
-                old_category_id=old_category_id,
-                new_category_id=category_id,
-                classified_at=datetime.now(timezone.utc),
-                classified_by="Gemini-2.5-flash-lite",
-                page_id=page_id
-            )
-            db.add(new_classification)
-
+            new_classifications.append({
+                'customer_id': row.id,
+                'old_category_id': row.old_category_id,
+                'new_category_id': category_id,
+                'classified_at': classified_at,
+                'classified_by': "Gemini-2.5-flash-lite",
+                'page_id': page_id
+            })
             knowledge_type = knowledge_map.get(category_id)
             if knowledge_type:
-                update_data = {
-                    'page_id': page_id,
-                    'psid': cust.customer_psid,
+                pending_updates.append({
+                    'page_id': page.page_id,
+                    'psid': row.customer_psid,
                     'customer_type_knowledge_id': category_id,
                     'customer_type_knowledge_name': knowledge_type.type_name,
-                    'timestamp': datetime.now(timezone.utc).isoformat()
-                }
-                pending_updates.append(update_data)
-
-        # 5️⃣ หา tier จากวัน
-        if cust.last_interaction_at:
-            days_since_last = (now - cust.last_interaction_at).days
-            selected_tier = None
-            for tier in sorted(tier_configs, key=lambda x: x.days_since_last_contact):
-                if days_since_last >= tier.days_since_last_contact:
-                    selected_tier = tier.tier_name
-            if selected_tier:
-                cust.current_tier = selected_tier
+                    'timestamp': classified_at.isoformat()
+                })
+
+        if new_classifications:
+            db.bulk_insert_mappings(models.FBCustomerClassification, new_classifications)
+            classified_count += len(new_classifications)
 
     # ✅ Commit ก่อน
     db.commit()
+    print(f"✅ Page {page_id}: {classified_count} customers reclassified")
 
     # ✅ ส่ง SSE หลัง commit
     if pending_updates:
         try:
-            from app.routes.facebook.sse import customer_type_update_queue
-
-            async def send_all():
-                for update in pending_updates:
-                    await customer_type_update_queue.put(update)
-                    print(f"📡 Queueing SSE update: {update['psid']} -> {update['customer_type_knowledge_name']}")
+            from app.service.sse_hub import publish_customer_type_update
 
-            try:
-                loop = asyncio.get_running_loop()
-                loop.create_task(send_all())
-            except RuntimeError:
-                asyncio.run(send_all())
+            for update in pending_updates:
+                publish_customer_type_update(update)
+                print(f"📡 Publishing SSE update: {update['psid']} -> {update['customer_type_knowledge_name']}")
 
         except Exception as e:
             print(f"❌ Error sending SSE updates: {e}")
 
 
-def match_by_keyword(message_text: str, knowledge_map: dict):
+def match_by_keyword(message_text: str, knowledge_map: dict, keyword_matcher=None):
     """ตรวจสอบด้วย keyword ก่อน ถ้า match ก็ return category id"""
-    for k in knowledge_map.values():
-        if not k.keywords:
-            continue
-        for kw in k.keywords:
-            if re.search(r'\b' + re.escape(kw) + r'\b', message_text, re.IGNORECASE):
-                print(f"Keyword matched: '{kw}' -> Category ID: {k.id}")
-                return k.id
-    return None
+    keyword_matcher = keyword_matcher or get_knowledge_matcher(knowledge_map)
+    category_id = keyword_matcher.match(message_text)
+    if category_id:
+        print(f"Keyword matched -> Category ID: {category_id}")
+    return category_id
 
 
 def safe_extract_text(response):
@@ -200,45 +187,103 @@ def safe_extract_text(response):
     return cand.content.parts[0].text.strip(), None
 
 
-def classify_with_gemini(
-    message_text: str,
-    knowledge_map: dict,
-    prev_category_id=None,
-    max_retries: int = 3,
-    model_name: str = "gemini-2.5-flash-lite"
-):
-    if message_text in _cache_text:
-        return _cache_text[message_text]
-
+def get_model(model_name: str, **generation_config):
+    """ใช้ GenerativeModel ซ้ำ แทนการสร้างใหม่ทุกครั้งที่เรียก"""
+    key = (model_name, tuple(sorted(generation_config.items())))
+    if key not in _models:
+        _models[key] = genai.GenerativeModel(model_name=model_name, generation_config=generation_config)
+    return _models[key]
+
+
+def normalize_text(message_text: str) -> str:
+    return re.sub(r'\s+', ' ', message_text).strip().lower()
+
+
+def knowledge_version(knowledge_map: dict) -> str:
+    """hash ของชุดหมวดหมู่ - เมื่อแก้หมวดหมู่ cache เดิมจะไม่ถูกใช้อีก"""
+    payload = json.dumps([
+        [k.id, k.type_name, k.rule_description, k.examples, k.keywords]
+        for k in sorted(knowledge_map.values(), key=lambda k: k.id)
+    ], ensure_ascii=False, default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()[:16]
+
+
+def _cache_key(version: str, normalized: str) -> str:
+    digest = hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+    return f"{config.CLASSIFICATION_CACHE_PREFIX}:{version}:{digest}"
+
+
+def _cache_get(keys: List[str]) -> List[Optional[str]]:
+    if not keys:
+        return []
+    values = r.mget(keys)
+    now = time.time()
+    hits = {key: now for key, value in zip(keys, values) if value is not None}
+    if hits:
+        # ต่ออายุทั้ง key และใน LRU index (entry ที่ยังถูกใช้ไม่หมดอายุตาม TTL)
+        pipe = r.pipeline()
+        for key in hits:
+            pipe.expire(key, config.CLASSIFICATION_CACHE_TTL_SECONDS)
+        pipe.zadd(f"{config.CLASSIFICATION_CACHE_PREFIX}:lru", hits)
+        pipe.execute()
+    return values
+
+
+def _cache_set(entries: Dict[str, str]):
+    if not entries:
+        return
+    lru_key = f"{config.CLASSIFICATION_CACHE_PREFIX}:lru"
+    now = time.time()
+    pipe = r.pipeline()
+    for key, value in entries.items():
+        pipe.set(key, value, ex=config.CLASSIFICATION_CACHE_TTL_SECONDS)
+    pipe.zadd(lru_key, {key: now for key in entries})
+    # ตัด entry ที่ไม่ได้ใช้นานเกิน TTL ออกจาก index
+    pipe.zremrangebyscore(lru_key, 0, now - config.CLASSIFICATION_CACHE_TTL_SECONDS)
+    pipe.zcard(lru_key)
+    size = pipe.execute()[-1]
+
+    # เกินขนาดที่กำหนด → ลบ entry ที่ใช้ล่าสุดนานที่สุด
+    overflow = size - config.CLASSIFICATION_CACHE_MAX_ENTRIES
+    if overflow > 0:
+        evicted = [key for key, _ in r.zpopmin(lru_key, overflow)]
+        if evicted:
+            r.delete(*evicted)
+
+
+def _build_batch_prompt(texts: List[str], knowledge_map: dict) -> str:
     prompt_parts = [
         "คุณคือผู้เชี่ยวชาญในการจัดหมวดหมู่ลูกค้าจากข้อความแชท",
-        "กรุณาเลือกหมวดหมู่ที่ตรงที่สุดจากข้อความนี้",
+        "กรุณาเลือกหมวดหมู่ที่ตรงที่สุดให้ข้อความของลูกค้าแต่ละรายการ",
         "\n--- หมวดหมู่ทั้งหมด ---"
     ]
     for k in knowledge_map.values():
         prompt_parts.append(f"ID {k.id}: {k.type_name} (คำอธิบาย: {k.rule_description}) (ตัวอย่าง: {k.examples})")
 
-    if prev_category_id:
-        prompt_parts.append(f"\nหมวดหมู่เดิมของลูกค้าคือ ID {prev_category_id} กรุณาพิจารณาประกอบ")
-
-    prompt_parts.append("\n--- ข้อความของลูกค้า ---")
-    prompt_parts.append(message_text)
+    prompt_parts.append("\n--- ข้อความของลูกค้า (JSON) ---")
+    prompt_parts.append(json.dumps([{"i": i, "text": text} for i, text in enumerate(texts)], ensure_ascii=False))
     prompt_parts.append(
         """--- คำสั่ง ---
         1. ถ้ามีข้อความที่เหมือนหรือใกล้เคียงกับ "ตัวอย่าง" ของหมวดใด ให้เลือกหมวดนั้นทันที
         2. ถ้าไม่เจอตรงกับตัวอย่าง ให้ใช้คำอธิบายหมวดเพื่อเลือก
-        3. ถ้าไม่ชัดเจนและข้อความไม่เพียงพอ ให้คงหมวดเดิมไว้ (ตอบ ID เดิม)
-        4. ตอบกลับด้วยตัวเลข ID อย่างเดียว"""
+        3. ถ้าไม่ชัดเจนและข้อความไม่เพียงพอ ให้ตอบ category_id เป็น null
+        4. ตอบกลับเป็น JSON array เท่านั้น เช่น [{"i": 0, "category_id": 3}] ครบทุกรายการ"""
     )
+    return "\n".join(prompt_parts)
+
 
-    prompt = "\n".join(prompt_parts)
+def _classify_batch(texts: List[str], knowledge_map: dict, max_retries: int, model_name: str) -> Optional[Dict[int, Optional[int]]]:
+    """ส่งข้อความหลายรายการใน prompt เดียว คืน {index: category_id หรือ None} (None ถ้าเรียกไม่สำเร็จ)"""
+    prompt = _build_batch_prompt(texts, knowledge_map)
+    model = get_model(
+        model_name,
+        temperature=0,
+        response_mime_type="application/json",
+        max_output_tokens=32 * len(texts) + 64
+    )
 
     for attempt in range(max_retries):
         try:
-            model = genai.GenerativeModel(
-                model_name=model_name,
-                generation_config={"temperature": 0, "max_output_tokens": 20}
-            )
             response = model.generate_content(prompt)
 
             answer, err = safe_extract_text(response)
@@ -249,16 +294,26 @@ def classify_with_gemini(
                     continue
                 return None
 
-            match = re.search(r'\d+', answer)
-            if match and int(match.group(0)) in knowledge_map:
-                category_id = int(match.group(0))
-                print(f"Gemini classified text into Category ID: {category_id} (via {model_name})")
-                _cache_text[message_text] = category_id
-                return category_id
-            else:
-                print(f"⚠️ Gemini {model_name} returned invalid answer: {answer}")
+            try:
+                items = json.loads(answer)
+            except ValueError:
+                print(f"⚠️ Gemini {model_name} returned invalid JSON: {answer[:200]}")
                 return None
 
+            results = {}
+            for item in items if isinstance(items, list) else []:
+                if not isinstance(item, dict) or not isinstance(item.get("i"), int):
+                    continue
+                category_id = item.get("category_id")
+                if isinstance(category_id, str) and category_id.isdigit():
+                    category_id = int(category_id)
+                if category_id is not None and category_id not in knowledge_map:
+                    # id ที่ไม่มีอยู่จริง ไม่ใส่ในผลลัพธ์ (ไม่ cache เป็น "ไม่ชัดเจน" รอบหน้าจะถามใหม่)
+                    continue
+                results[item["i"]] = category_id
+            print(f"Gemini classified {len(results)}/{len(texts)} texts in one call (via {model_name})")
+            return results
+
         except Exception as e:
             err_msg = str(e)
             if "429" in err_msg and attempt < max_retries - 1:
@@ -273,20 +328,136 @@ def classify_with_gemini(
     return None
 
 
-def classify_with_gemini_image(image_url: str, knowledge_map: dict, max_retries: int = 3):
-    """ใช้ Gemini Vision วิเคราะห์ภาพ + retry/backoff + cache"""
-    if image_url in _cache_image:
-        return _cache_image[image_url]
+def classify_texts_with_gemini(
+    texts: List[str],
+    knowledge_map: dict,
+    max_retries: int = 3,
+    model_name: str = "gemini-2.5-flash-lite"
+) -> Dict[str, Optional[int]]:
+    """
+    จัดหมวดหมู่หลายข้อความ: อ่าน Redis cache ก่อน ที่เหลือส่ง Gemini เป็น batch ละ CLASSIFICATION_BATCH_SIZE
+    คืน {ข้อความ: category_id หรือ None (ไม่ชัดเจน)} - ข้อความที่เรียก API ไม่สำเร็จจะไม่อยู่ใน dict
+    """
+    if not texts or not knowledge_map:
+        return {}
+
+    version = knowledge_version(knowledge_map)
+    by_normalized: Dict[str, List[str]] = {}
+    for text in texts:
+        by_normalized.setdefault(normalize_text(text), []).append(text)
+
+    normalized_texts = list(by_normalized)
+    keys = [_cache_key(version, normalized) for normalized in normalized_texts]
+    resolved: Dict[str, Optional[int]] = {}
+    misses = []
+    try:
+        cached = _cache_get(keys)
+    except Exception as e:
+        print(f"⚠️ Classification cache unavailable: {e}")
+        cached = [None] * len(keys)
+    for normalized, value in zip(normalized_texts, cached):
+        if value is None:
+            misses.append(normalized)
+        else:
+            resolved[normalized] = None if value == _UNCLEAR else int(value)
+
+    batch_size = config.CLASSIFICATION_BATCH_SIZE
+    for start in range(0, len(misses), batch_size):
+        batch = misses[start:start + batch_size]
+        results = _classify_batch(batch, knowledge_map, max_retries, model_name)
+        if results is None:
+            continue
+        new_entries = {}
+        for i, normalized in enumerate(batch):
+            if i not in results:
+                continue
+            resolved[normalized] = results[i]
+            new_entries[_cache_key(version, normalized)] = str(results[i]) if results[i] else _UNCLEAR
+        try:
+            _cache_set(new_entries)
+        except Exception as e:
+            print(f"⚠️ Cannot write classification cache: {e}")
+
+    print(f"Classification: {len(normalized_texts)} unique texts, {len(normalized_texts) - len(misses)} from cache")
+    return {
+        text: resolved[normalized]
+        for normalized, originals in by_normalized.items() if normalized in resolved
+        for text in originals
+    }
+
+
+def classify_with_gemini(
+    message_text: str,
+    knowledge_map: dict,
+    prev_category_id=None,
+    max_retries: int = 3,
+    model_name: str = "gemini-2.5-flash-lite"
+):
+    """จัดหมวดหมู่ข้อความเดียว (ถ้าไม่ชัดเจนคืนหมวดเดิม)"""
+    results = classify_texts_with_gemini([message_text], knowledge_map, max_retries, model_name)
+    if message_text not in results:
+        return None
+    return results[message_text] or prev_category_id
+
 
+def _get_image_pool() -> ThreadPoolExecutor:
+    global _image_pool
+    if _image_pool is None:
+        _image_pool = ThreadPoolExecutor(max_workers=config.IMAGE_PIPELINE_CONCURRENCY, thread_name_prefix="image-caption")
+    return _image_pool
+
+
+def download_image(image_url: str) -> Optional[bytes]:
+    """ดาวน์โหลดรูปแบบ stream และหยุดทันทีถ้าใหญ่เกิน IMAGE_MAX_BYTES"""
     try:
-        img_bytes = requests.get(image_url, timeout=10).content
-        image = Image.open(BytesIO(img_bytes))
+        with requests.get(image_url, stream=True, timeout=config.IMAGE_DOWNLOAD_TIMEOUT) as response:
+            response.raise_for_status()
+            if int(response.headers.get("Content-Length") or 0) > config.IMAGE_MAX_BYTES:
+                print(f"⚠️ Image too large, skipped: {image_url}")
+                return None
+            data = BytesIO()
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                data.write(chunk)
+                if data.tell() > config.IMAGE_MAX_BYTES:
+                    print(f"⚠️ Image too large, skipped: {image_url}")
+                    return None
+            return data.getvalue()
     except Exception as e:
         print(f"❌ Error loading image: {e}")
         return None
 
-    model = genai.GenerativeModel("gemini-1.5-flash")
 
+def prepare_image(data: bytes) -> Image.Image:
+    """ย่อรูปก่อนส่งให้ Gemini (JPEG ใช้ draft เพื่อไม่ต้อง decode เต็มขนาด)"""
+    image = Image.open(BytesIO(data))
+    size = (config.IMAGE_MAX_DIMENSION, config.IMAGE_MAX_DIMENSION)
+    image.draft("RGB", size)
+    image = image.convert("RGB")
+    image.thumbnail(size)
+    return image
+
+
+def caption_image(image_url: str, max_retries: int = 3, model_name: str = "gemini-1.5-flash") -> Optional[str]:
+    """ดาวน์โหลด + ทำ caption รูป (cache ตาม hash ของเนื้อรูป ไม่ใช่ URL)"""
+    data = download_image(image_url)
+    if not data:
+        return None
+
+    cache_key = f"{config.CLASSIFICATION_CACHE_PREFIX}:caption:{hashlib.sha256(data).hexdigest()}"
+    try:
+        cached = r.get(cache_key)
+        if cached:
+            return cached
+    except Exception as e:
+        print(f"⚠️ Caption cache unavailable: {e}")
+
+    try:
+        image = prepare_image(data)
+    except Exception as e:
+        print(f"❌ Error decoding image: {e}")
+        return None
+
+    model = get_model(model_name)
     for attempt in range(max_retries):
         try:
             response = model.generate_content(
@@ -297,11 +468,11 @@ def classify_with_gemini_image(image_url: str, knowledge_map: dict, max_retries:
             )
             caption = response.text.strip()
             print(f"Gemini Vision caption: {caption}")
-
-            category_id = classify_with_gemini(caption, knowledge_map)
-            if category_id:
-                _cache_image[image_url] = category_id
-            return category_id
+            try:
+                r.set(cache_key, caption, ex=config.IMAGE_CAPTION_CACHE_TTL_SECONDS)
+            except Exception as e:
+                print(f"⚠️ Cannot write caption cache: {e}")
+            return caption
 
         except Exception as e:
             err_msg = str(e)
@@ -314,4 +485,34 @@ def classify_with_gemini_image(image_url: str, knowledge_map: dict, max_retries:
                 print(f"❌ Gemini image API error: {e}")
                 return None
 
-    return None
\ No newline at end of file
+    return None
+
+
+def submit_image_captions(image_urls: Iterable[str]) -> Dict[str, Future]:
+    """ส่งรูปเข้า pool (จำกัดจำนวนพร้อมกันด้วย IMAGE_PIPELINE_CONCURRENCY) คืน {url: future ของ caption}"""
+    futures = {}
+    for image_url in image_urls:
+        if image_url not in futures:
+            futures[image_url] = _get_image_pool().submit(caption_image, image_url)
+    return futures
+
+
+def classify_image_captions(caption_futures: Dict[str, Future], knowledge_map: dict) -> Dict[str, Optional[int]]:
+    """รอ caption แล้วจัดหมวดหมู่ caption ทั้งหมดด้วย classify_texts_with_gemini ครั้งเดียว"""
+    captions = {}
+    for image_url, future in caption_futures.items():
+        try:
+            caption = future.result()
+        except Exception as e:
+            print(f"❌ Image pipeline error for {image_url}: {e}")
+            caption = None
+        if caption:
+            captions[image_url] = caption
+
+    results = classify_texts_with_gemini(list(captions.values()), knowledge_map)
+    return {image_url: results.get(caption) for image_url, caption in captions.items()}
+
+
+def classify_with_gemini_image(image_url: str, knowledge_map: dict):
+    """ใช้ Gemini Vision วิเคราะห์ภาพ (ผ่าน image pipeline + cache)"""
+    return classify_image_captions(submit_image_captions([image_url]), knowledge_map).get(image_url)
@@ -17,11 +17,14 @@ from app.routes import mining_status
 
 # Import database
 from app.database import crud, database, models, schemas
-from app.database.database import SessionLocal, engine, Base
+from app.database.database import SessionLocal, engine
+from app.database.schema_sync import ensure_schema
 
 # Import services
 from app.service.message_scheduler import message_scheduler
 from app.service.auto_sync_service import auto_sync_service
+from app.service.graph_client import graph_client
+from app.service.webhook_ingest import webhook_ingestor
 
 # Import task scheduler
 from app.task.scheduler import start_scheduler
@@ -40,8 +43,8 @@ load_dotenv()
 
 app = FastAPI()
 
-# สร้างตารางในฐานข้อมูล
-Base.metadata.create_all(bind=engine)
+# สร้างตารางในฐานข้อมูล (extension -> ตาราง -> index)
+ensure_schema(engine)
 
 # เพิ่ม CORS middleware
 app.add_middleware(
@@ -103,6 +106,15 @@ def run_auto_sync():
     finally:
         loop.close()
 
+# ฟังก์ชันสำหรับ run webhook consumer
+def run_webhook_consumer():
+    """อ่าน webhook events จาก Redis stream เป็น batch ใน thread แยก"""
+    try:
+        logging.info("Starting webhook consumer...")
+        webhook_ingestor.run()
+    except Exception as e:
+        logging.error(f"Webhook consumer error: {e}")
+
 # Event handlers
 @app.on_event("startup")
 async def startup_event():
@@ -119,6 +131,11 @@ async def startup_event():
     auto_sync_thread.start()
     logging.info("Auto sync thread started - จะดึงข้อมูลจาก Facebook ทุก 10 วินาที")
     
+    # Start webhook consumer
+    webhook_thread = threading.Thread(target=run_webhook_consumer, daemon=True)
+    webhook_thread.start()
+    logging.info("Webhook consumer thread started")
+    
     # Start task scheduler
     start_scheduler()
 
@@ -128,6 +145,9 @@ async def shutdown_event():
     logging.info("Shutting down...")
     message_scheduler.stop()
     auto_sync_service.stop()
+    webhook_ingestor.stop()
+    await graph_client.aclose()
+    graph_client.close()
 
 # สำหรับรันแอป
 if __name__ == "__main__":
@@ -1,43 +1,36 @@
 import asyncio
 from celery import group
 from datetime import datetime
+from typing import Dict, List
+from app import config
 from app.celery_worker import celery_app
 from app.database.database import SessionLocal
 from app.database import crud, models
 from app.service.facebook_api import fb_get
 from app.service.auto_sync_service import auto_sync_service
-from app.celery_task.customer_tasks import handle_new_customer_task, handle_existing_customer_task
+from app.service.sse_hub import publish
 from app.utils.redis_helper import get_page_token
 import logging
 
 logger = logging.getLogger(__name__)
 
+CONVERSATION_PARAMS = {
+    "fields": "participants,updated_time,id,messages.limit(10){created_time,from,message,id}",
+    "limit": 100
+}
+
 @celery_app.task(bind=True, autoretry_for=(Exception,), retry_backoff=True, retry_kwargs={'max_retries': 3})
-def sync_all_pages_task(self, page_id: str):
+def sync_all_pages_task(self, page_id: str = None):
     """
-    Task หลัก: ดึงข้อมูลทุกเพจ (เรียก subtask สำหรับแต่ละเพจ)
+    Task หลัก: ส่ง task sync ให้ทุกเพจ (เพจละ 1 task ดึง token เองใน task)
     """
     db = SessionLocal()
     try:
         pages = db.query(models.FacebookPage).all()
         logger.info(f"🚀 Celery started syncing {len(pages)} pages")
 
-        print(f"🔍 Step 1: Fetching token from Redis for page_id={page_id}")
-        access_token = get_page_token(page_id)
-
-        if not access_token:
-            print(f"❌ Step 1 Failed: No access_token found for page_id={page_id}")
-            return {"status": "error", "message": f"No access_token for page_id={page_id}"}
-        
-        print(f"✅ Step 1 Success: Token found for page_id={page_id}")
-
         for page in pages:
-            token_entry = auto_sync_service.page_tokens.get(page.page_id)
-            if not token_entry:
-                logger.warning(f"⚠️ No token found for page_id={page.page_id}")
-                continue
-
-            sync_page_conversations_task.delay(page.page_id, token_entry)
+            sync_page_conversations_task.delay(page.page_id)
 
         return {"status": "scheduled", "page_count": len(pages)}
     finally:
@@ -45,48 +38,45 @@ def sync_all_pages_task(self, page_id: str):
 
 
 @celery_app.task(bind=True)
-def sync_page_conversations_task(self, page_id: str, access_token: str):
+def sync_page_conversations_task(self, page_id: str, access_token: str = None):
     """
-    Task: ดึง conversations ของเพจเดียว แล้วส่งไป process_conversation_task
+    Task: ดึง conversations ของเพจเดียวแล้วประมวลผลเป็น chunk ใน task เดียว
+    - ถ้าจำนวน conversations เกิน AUTO_SYNC_FANOUT_THRESHOLD จะแบ่ง chunk ให้ worker อื่นช่วย
     """
     db = SessionLocal()
     try:
         logger.info(f"🔁 Syncing page {page_id}")
 
-        page = crud.get_page_by_page_id(db, page_id)
+        page = crud.get_page_ref(db, page_id)
         if not page:
             return {"error": f"Page not found: {page_id}"}
 
-        endpoint = f"{page_id}/conversations"
-        params = {
-            "fields": "participants,updated_time,id,messages.limit(10){created_time,from,message,id}",
-            "limit": 100
-        }
-
-        print(f"🔍 Step 1: Fetching token from Redis for page_id={page_id}")
         access_token = get_page_token(page_id)
-
         if not access_token:
-            print(f"❌ Step 1 Failed: No access_token found for page_id={page_id}")
+            logger.error(f"❌ No access_token found for page_id={page_id}")
             return {"status": "error", "message": f"No access_token for page_id={page_id}"}
-        
-        print(f"✅ Step 1 Success: Token found for page_id={page_id}")
-
 
-        result = fb_get(endpoint, params, access_token)
+        result = fb_get(f"{page_id}/conversations", CONVERSATION_PARAMS, access_token)
         if "error" in result:
             return {"error": result["error"]}
 
         conversations = result.get("data", [])
         logger.info(f"📨 Found {len(conversations)} conversations for page {page_id}")
 
-        job_group = group(
-            process_conversation_task.s(convo, page_id, access_token)
-            for convo in conversations
-        )
-        result_group = job_group.apply_async()
+        chunk_size = config.AUTO_SYNC_CHUNK_SIZE
+        chunks = [conversations[i:i + chunk_size] for i in range(0, len(conversations), chunk_size)]
+
+        if len(conversations) > config.AUTO_SYNC_FANOUT_THRESHOLD:
+            group(process_conversation_chunk_task.s(page_id, chunk) for chunk in chunks).apply_async()
+            return {"status": "queued", "page_id": page_id, "conversation_count": len(conversations), "chunks": len(chunks)}
+
+        stats = {'new': 0, 'updated': 0, 'status_updated': 0}
+        for chunk in chunks:
+            chunk_stats = run_async(process_conversation_chunk(db, page, access_token, chunk))
+            for key in stats:
+                stats[key] += chunk_stats[key]
 
-        return {"status": "queued", "page_id": page_id, "conversation_count": len(conversations)}
+        return {"status": "success", "page_id": page_id, "conversation_count": len(conversations), **stats}
 
     except Exception as e:
         logger.error(f"❌ Error syncing page {page_id}: {e}")
@@ -94,84 +84,165 @@ def sync_page_conversations_task(self, page_id: str, access_token: str):
     finally:
         db.close()
 
+
 @celery_app.task(bind=True, autoretry_for=(Exception,), retry_backoff=True, retry_kwargs={'max_retries': 3})
-def process_participant_task(self, participant_data, page_id, convo_id, access_token):
+def process_conversation_chunk_task(self, page_id: str, conversations: List[Dict]):
     """
-    ประมวลผลลูกค้าแต่ละคน (participant)
+    ประมวลผล conversations ชุดหนึ่งของเพจ (ใช้เมื่อเพจมี conversations มากจนต้องแบ่งให้หลาย worker)
     """
     db = SessionLocal()
     try:
-        participant_id = participant_data.get("id")
-        name = participant_data.get("name")
-
-        logger.info(f"👤 [Participant] Processing {name} ({participant_id})")
-
-        page = crud.get_page_by_page_id(db, page_id)
+        page = crud.get_page_ref(db, page_id)
         if not page:
-            return {"error": f"page_id {page_id} not found"}
-        
-        print(f"🔍 Step 1: Fetching token from Redis for page_id={page_id}")
-        access_token = get_page_token(page_id)
+            return {"error": f"Page not found: {page_id}"}
 
+        access_token = get_page_token(page_id)
         if not access_token:
-            print(f"❌ Step 1 Failed: No access_token found for page_id={page_id}")
+            logger.error(f"❌ No access_token found for page_id={page_id}")
             return {"status": "error", "message": f"No access_token for page_id={page_id}"}
-        
-        print(f"✅ Step 1 Success: Token found for page_id={page_id}")
-
-
-        existing = crud.get_customer_by_psid(db, page.ID, participant_id)
-        if existing:
-            # ✅ ลูกค้าเก่า → ให้ Celery จัดการอัปเดต
-            msg_time = datetime.now().isoformat()
-            handle_existing_customer_task.delay(page_id, participant_id, msg_time)
-            logger.info(f"📝 Queued existing customer update for {participant_id}")
-        else:
-            # 🆕 ลูกค้าใหม่ → ให้ Celery จัดการสร้าง
-            handle_new_customer_task.delay(page_id, participant_id, name, convo_id, access_token)
-            logger.info(f"🆕 Queued new customer creation for {participant_id}")
 
-        return {"status": "queued", "participant": participant_id}
-
-    except Exception as e:
-        logger.error(f"❌ Error processing participant {participant_data}: {e}")
-        raise
+        stats = run_async(process_conversation_chunk(db, page, access_token, conversations))
+        return {"status": "success", "page_id": page_id, **stats}
     finally:
         db.close()
 
-# ✅ Task ระดับ conversation
-@celery_app.task(bind=True)
-def process_conversation_task(self, convo_data, page_id, access_token):
-    """
-    ประมวลผลแต่ละ conversation (เรียก task ลูกค้าแต่ละคน)
-    """
-    try:
-        print(f"🔍 Step 1: Fetching token from Redis for page_id={page_id}")
-        access_token = get_page_token(page_id)
-
-        if not access_token:
-            print(f"❌ Step 1 Failed: No access_token found for page_id={page_id}")
-            return {"status": "error", "message": f"No access_token for page_id={page_id}"}
-        
-        print(f"✅ Step 1 Success: Token found for page_id={page_id}")
-
-        convo_id = convo_data.get("id")
-        participants = convo_data.get("participants", {}).get("data", [])
 
-        logger.info(f"💬 [Conversation] Processing {convo_id} ({len(participants)} participants)")
+def run_async(coro):
+    """รัน coroutine ใน event loop ใหม่ของ worker"""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
 
-        from celery import group
 
-        job_group = group(
-            process_participant_task.s(participant, page_id, convo_id, access_token)
-            for participant in participants
-            if participant.get("id") and participant.get("id") != page_id
+async def process_conversation_chunk(db, page, access_token: str, conversations: List[Dict]) -> Dict[str, int]:
+    """
+    ประมวลผล conversations ด้วย session เดียว
+    - หา customer เดิมด้วย query เดียว
+    - ลูกค้าใหม่: ดึงชื่อ/เวลาข้อความแรกแบบ batch แล้ว upsert ครั้งเดียว
+    - ลูกค้าเดิม: เลื่อน last_interaction_at ด้วย upsert ครั้งเดียว และอัพเดทสถานะการขุดแบบ bulk
+    """
+    page_id = page.page_id
+    stats = {'new': 0, 'updated': 0, 'status_updated': 0}
+    installed_at = auto_sync_service._get_installed_at(page)
+
+    # (psid, participant, convo_id, เวลาข้อความล่าสุดของ user)
+    candidates = {}
+    for convo in conversations:
+        messages = convo.get("messages", {}).get("data", [])
+        for participant in convo.get("participants", {}).get("data", []):
+            participant_id = participant.get("id")
+            if not participant_id or participant_id == page_id:
+                continue
+            latest = auto_sync_service._get_latest_user_message(messages, participant_id)
+            if latest:
+                candidates[participant_id] = (participant, convo.get("id"), latest['msg_time'])
+
+    if not candidates:
+        return stats
+
+    # ดึงเป็น tuple (ไม่ใช่ ORM object) จึงไม่ถูก expire/refresh หลัง commit
+    existing = {
+        customer.customer_psid: customer
+        for customer in db.query(
+            models.FbCustomer.id, models.FbCustomer.customer_psid,
+            models.FbCustomer.name, models.FbCustomer.last_interaction_at
+        ).filter(
+            models.FbCustomer.page_id == page.ID,
+            models.FbCustomer.customer_psid.in_(list(candidates))
+        ).all()
+    }
+
+    # ---------- ลูกค้าเดิม ----------
+    updated_customers = []
+    for psid, customer in existing.items():
+        msg_time = candidates[psid][2]
+        last_interaction = auto_sync_service.make_datetime_aware(customer.last_interaction_at)
+        if last_interaction is None or msg_time > last_interaction:
+            updated_customers.append((customer, msg_time))
+
+    if updated_customers:
+        crud.bulk_create_or_update_customers(db, page.ID, [
+            {'customer_psid': customer.customer_psid, 'last_interaction_at': msg_time}
+            for customer, msg_time in updated_customers
+        ])
+        stats['updated'] = len(updated_customers)
+        stats['status_updated'] = mark_replied_customers(
+            db, page_id, page.ID, {c.customer_psid: c.name for c, _ in updated_customers}
         )
 
-        result = job_group.apply_async()
-        logger.info(f"📤 Dispatched {len(participants)} participant tasks for convo={convo_id}")
-
-        return {"status": "queued", "convo_id": convo_id, "participants": len(participants)}
-    except Exception as e:
-        logger.error(f"❌ Error processing conversation {convo_data}: {e}")
-        raise
\ No newline at end of file
+    # ---------- ลูกค้าใหม่ ----------
+    new_psids = [psid for psid in candidates if psid not in existing]
+    if new_psids:
+        new_conversations = [
+            convo for convo in conversations
+            if any(p.get("id") in new_psids for p in convo.get("participants", {}).get("data", []))
+        ]
+        prefetched_keys = await auto_sync_service._prefetch_new_customer_info(
+            new_conversations, page, page_id, access_token, db
+        )
+        try:
+            rows = []
+            for psid in new_psids:
+                participant, convo_id, msg_time = candidates[psid]
+                user_name, profile_pic = await auto_sync_service._get_user_info(psid, participant, access_token)
+                first_interaction = await auto_sync_service.get_first_message_time(convo_id, psid, access_token) or msg_time
+                rows.append({
+                    'customer_psid': psid,
+                    'name': user_name,
+                    'profile_pic': profile_pic,
+                    'first_interaction_at': first_interaction,
+                    'last_interaction_at': msg_time,
+                    'source_type': 'new' if first_interaction >= installed_at else 'imported'
+                })
+        finally:
+            for psid, convo_id in prefetched_keys:
+                auto_sync_service.prefetched_user_info.pop(psid, None)
+                auto_sync_service.prefetched_first_messages.pop((convo_id, psid), None)
+
+        results = crud.bulk_create_or_update_customers(db, page.ID, rows)
+        stats['new'] = results.get("created", 0)
+        create_initial_mining_statuses(db, page.ID, [row['customer_psid'] for row in rows])
+
+        for row in rows:
+            await auto_sync_service._send_new_customer_sse(
+                page_id, row['customer_psid'], row['name'], row['profile_pic'], row['source_type']
+            )
+
+    auto_sync_service._log_sync_summary(stats)
+    return stats
+
+
+def mark_replied_customers(db, page_id: str, page_db_id: int, names: Dict[str, str]) -> int:
+    """
+    เปลี่ยนสถานะ 'ขุดแล้ว' เป็น 'มีการตอบกลับ' ให้ลูกค้าที่ตอบกลับ (statement เดียว) คืนจำนวนที่เปลี่ยน
+    names: {psid: ชื่อลูกค้า}
+    """
+    replied = crud.set_mining_statuses(
+        db, page_db_id, list(names), "มีการตอบกลับ",
+        note=f"User replied via auto-sync at {datetime.now()}",
+        expected_status="ขุดแล้ว"
+    )
+    if not replied:
+        return 0
+
+    for psid in replied:
+        publish(page_id, 'customer_type_update', [{
+            'page_id': page_id,
+            'psid': psid,
+            'name': names[psid],
+            'mining_status': 'มีการตอบกลับ',
+            'action': 'mining_status_update',
+            'timestamp': datetime.now().isoformat()
+        }])
+    logger.info(f"💬 ✅ Updated mining status to 'มีการตอบกลับ' for {len(replied)} customers")
+    return len(replied)
+
+
+def create_initial_mining_statuses(db, page_db_id: int, psids: List[str]):
+    """สร้างสถานะ 'ยังไม่ขุด' ให้ลูกค้าใหม่ (statement เดียว)"""
+    crud.set_mining_statuses(
+        db, page_db_id, psids, crud.MINING_DEFAULT_STATUS, note=f"New user added at {datetime.now()}"
+    )
@@ -0,0 +1,28 @@
+# app/celery_task/backfill_tasks.py
+from app.celery_worker import celery_app
+from celery.exceptions import SoftTimeLimitExceeded
+import logging
+
+logger = logging.getLogger(__name__)
+
+@celery_app.task(bind=True, acks_late=True, autoretry_for=(Exception,), retry_backoff=True, retry_kwargs={'max_retries': 5})
+def backfill_customers_slice_task(self, slice_id: int):
+    """
+    Celery task สำหรับ sync ลูกค้าย้อนหลัง 1 slice
+    ทำทีละ BACKFILL_PAGES_PER_TASK หน้า แล้วส่ง task ต่อจาก cursor ที่บันทึกไว้
+    """
+    from app.service.customer_backfill import run_backfill_slice  # lazy import เพื่อหลีกเลี่ยง circular import
+
+    try:
+        result = run_backfill_slice(slice_id)
+    except SoftTimeLimitExceeded:
+        # cursor ของหน้าที่เสร็จแล้วถูกบันทึกไว้ ส่ง task ต่อได้เลย
+        logger.warning(f"⏰ Backfill slice {slice_id} hit time limit, continuing in a new task")
+        backfill_customers_slice_task.delay(slice_id)
+        return {"status": "continued", "slice_id": slice_id}
+
+    if not result.get("done") and not result.get("skipped"):
+        backfill_customers_slice_task.delay(slice_id)
+        return {"status": "continued", "slice_id": slice_id, "pages": result.get("pages")}
+
+    return {"status": "done" if result.get("done") else "skipped", "slice_id": slice_id}
@@ -2,6 +2,8 @@ from app.celery_worker import celery_app
 from app.database.database import SessionLocal
 from app.database import models
 from app.database import crud
+from app.database import rollups
+from app.utils.keyword_matcher import get_custom_group_matcher, invalidate_custom_groups, invalidate_knowledge
 import logging
 from datetime import datetime
 import asyncio
@@ -25,13 +27,10 @@ def get_customer_groups_task(page_id: int, include_inactive: bool = False):
 
         groups = query.order_by(models.CustomerTypeCustom.created_at.desc()).all()
 
+        counts = rollups.get_category_counts(db, page_id)
+
         result = []
         for group in groups:
-            customer_count = db.query(models.FbCustomer).filter(
-                models.FbCustomer.page_id == page_id,
-                models.FbCustomer.current_category_id == group.id
-            ).count()
-
             result.append({
                 "id": group.id,
                 "page_id": group.page_id,
@@ -42,7 +41,7 @@ def get_customer_groups_task(page_id: int, include_inactive: bool = False):
                 "is_active": group.is_active,
                 "created_at": str(group.created_at),
                 "updated_at": str(group.updated_at),
-                "customer_count": customer_count
+                "customer_count": counts.get(group.id, 0)
             })
 
         return result
@@ -143,6 +142,7 @@ def delete_customer_group_task(group_id: int, hard_delete: bool = False):
         
         if not group:
             raise ValueError("Group not found")
+        page_id = group.page_id
         
         if hard_delete:
             db.delete(group)
@@ -153,6 +153,7 @@ def delete_customer_group_task(group_id: int, hard_delete: bool = False):
             action = "soft deleted"
         
         db.commit()
+        invalidate_custom_groups(page_id)
         logger.info(f"✅ Celery task: Group {group_id} {action}")
         return {"group_id": group_id, "hard_delete": hard_delete, "status": "success"}
     
@@ -286,15 +287,7 @@ def toggle_page_knowledge_task(page_id: str, knowledge_id: int):
             # ปิด schedules ที่เกี่ยวข้อง
             group_id = f"knowledge_{knowledge_id}"
 
-            if page_id in message_scheduler.active_schedules:
-                schedules_to_remove = []
-                for schedule in message_scheduler.active_schedules[page_id]:
-                    if group_id in schedule.get('groups', []):
-                        schedules_to_remove.append(schedule['id'])
-
-                for schedule_id in schedules_to_remove:
-                    message_scheduler.remove_schedule(page_id, schedule_id)
-                    removed_count += 1
+            removed_count += len(message_scheduler.remove_schedules_for_group(page_id, group_id))
 
             logger.info(f"Disabled knowledge group {knowledge_id} and deactivated {removed_count} schedules")
         else:
@@ -368,6 +361,7 @@ def update_customer_type_knowledge_task(knowledge_id: int, update_data: dict):
             
             result = db.execute(query, params)
             db.commit()
+            invalidate_knowledge()
             updated_row = result.fetchone()
             
             logger.info(f"✅ Updated knowledge type {knowledge_id}")
@@ -399,25 +393,9 @@ def auto_group_customer_task(page_id: str, customer_psid: str, message_text: str
         if not page:
             return {"status": "error", "message": "Page not found"}
         
-        # ดึงกลุ่มที่ active ทั้งหมดของเพจ
-        groups = db.query(models.CustomerTypeCustom).filter(
-            models.CustomerTypeCustom.page_id == page.ID,
-            models.CustomerTypeCustom.is_active == True
-        ).all()
-        
-        # ตรวจสอบ keywords
-        detected_group = None
-        message_lower = message_text.lower()
-        
-        for group in groups:
-            if group.keywords:
-                keywords = [k.strip().lower() for k in group.keywords.split(",")]
-                for keyword in keywords:
-                    if keyword and keyword in message_lower:
-                        detected_group = group
-                        break
-            if detected_group:
-                break
+        # ตรวจสอบ keywords ของกลุ่มที่ active ทั้งหมดของเพจ (matcher ที่ cache ไว้)
+        group_id = get_custom_group_matcher(db, page.ID).match(message_text)
+        detected_group = crud.get_customer_type_custom_by_id(db, group_id) if group_id else None
         
         if detected_group:
             customer = crud.get_customer_by_psid(db, page.ID, customer_psid)
@@ -2,8 +2,7 @@ from app.celery_worker import celery_app
 from app.database.database import SessionLocal
 from celery.exceptions import SoftTimeLimitExceeded
 from sqlalchemy import text
-from app.database import crud, models
-from datetime import datetime
+from app.database import crud
 import logging
 
 logger = logging.getLogger(__name__)
@@ -11,38 +10,22 @@ logger = logging.getLogger(__name__)
 
 @celery_app.task(bind=True, autoretry_for=(Exception,), retry_backoff=True, retry_kwargs={'max_retries': 3})
 def update_mining_status_task(self, page_id: str, psids: list, status: str, note: str = None):
-    """Celery task สำหรับอัปเดต mining status ของลูกค้าหลายคน"""
-    from app.routes.mining_status import update_customer_mining_status  # lazy import เพื่อเลี่ยง circular import
-
+    """Celery task สำหรับอัปเดต mining status ของลูกค้าหลายคน (statement เดียว)"""
     db = SessionLocal()
-    updated_count = 0
-    errors = []
 
     try:
-        page = crud.get_page_by_page_id(db, page_id)
+        page = crud.get_page_ref(db, page_id)
         if not page:
             raise ValueError(f"Page not found: {page_id}")
 
-        for psid in psids:
-            try:
-                customer = crud.get_customer_by_psid(db, page.ID, psid)
-                if not customer:
-                    errors.append(f"❌ Customer {psid} not found")
-                    continue
-
-                update_customer_mining_status(db, customer, status, note)
-                updated_count += 1
-
-            except Exception as e:
-                logger.error(f"Error updating status for {psid}: {e}")
-                errors.append(str(e))
-
-        db.commit()
-        logger.info(f"✅ Updated {updated_count}/{len(psids)} customers to '{status}'")
+        updated = crud.set_mining_statuses(db, page.ID, psids, status, note)
+        updated_set = set(updated)
+        errors = [f"❌ Customer {psid} not found" for psid in dict.fromkeys(psids) if psid not in updated_set]
+        logger.info(f"✅ Updated {len(updated)}/{len(psids)} customers to '{status}'")
 
         return {
             "status": "success",
-            "updated": updated_count,
+            "updated": len(updated),
             "errors": errors,
         }
 
@@ -60,24 +43,15 @@ def update_mining_status_task(self, page_id: str, psids: list, status: str, note
 @celery_app.task(bind=True)
 def reset_mining_status_task(self, page_id: str, psids: list):
     """รีเซ็ตสถานะลูกค้าเป็น 'ยังไม่ขุด'"""
-    from app.routes.mining_status import update_customer_mining_status
-
     db = SessionLocal()
-    reset_count = 0
     try:
-        page = crud.get_page_by_page_id(db, page_id)
+        page = crud.get_page_ref(db, page_id)
         if not page:
             raise ValueError(f"Page not found: {page_id}")
 
-        for psid in psids:
-            customer = crud.get_customer_by_psid(db, page.ID, psid)
-            if customer:
-                update_customer_mining_status(db, customer, "ยังไม่ขุด", "Reset status")
-                reset_count += 1
-
-        db.commit()
-        logger.info(f"✅ Reset {reset_count} customers on page {page_id}")
-        return {"status": "success", "reset_count": reset_count}
+        reset = crud.set_mining_statuses(db, page.ID, psids, crud.MINING_DEFAULT_STATUS, "Reset status")
+        logger.info(f"✅ Reset {len(reset)} customers on page {page_id}")
+        return {"status": "success", "reset_count": len(reset)}
 
     except Exception as e:
         db.rollback()
@@ -89,7 +63,7 @@ def reset_mining_status_task(self, page_id: str, psids: list):
 
 @celery_app.task(bind=True)
 def clean_mining_history_task(self, page_id: str):
-    """ล้าง record เก่าของสถานะ (เก็บเฉพาะล่าสุด)"""
+    """ล้างประวัติสถานะเก่า (เก็บเฉพาะล่าสุด) สถานะปัจจุบันอยู่ใน fb_customer_mining_current จึงไม่ได้รับผลกระทบ"""
     db = SessionLocal()
     try:
         page = crud.get_page_by_page_id(db, page_id)
@@ -9,7 +9,7 @@ logger = logging.getLogger(__name__)
 @celery_app.task(bind=True, autoretry_for=(Exception,), retry_backoff=True, retry_kwargs={'max_retries': 3})
 def sync_new_user_data_task(self, page_id: str, sender_id: str, page_db_id: int):
     """Celery task สำหรับ sync ข้อมูลลูกค้าใหม่จาก webhook"""
-    from app.routes.facebook.customers import sync_new_user_data  # lazy import เพื่อหลีกเลี่ยง circular import
+    from app.routes.webhook import sync_new_user_data  # lazy import เพื่อหลีกเลี่ยง circular import
 
     db = SessionLocal()
     try:
@@ -42,4 +42,8 @@ celery_app.conf.include = [
     "app.celery_task.page_tasks",
     "app.celery_task.pages_admin",
     "app.celery_task.groups_task",
-]
\ No newline at end of file
+    "app.celery_task.backfill_tasks",
+]
+
+# ลงทะเบียน hook ที่ publish SSE customer_update เมื่อ task แก้ fb_customers
+import app.service.sse_hub  # noqa: E402,F401
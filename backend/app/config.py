@@ -18,4 +18,94 @@ OAUTH_LINK = (
 )
 
 page_tokens = {}
-page_names = {}
\ No newline at end of file
+page_names = {}
+
+# ตั้งค่า connection pool สำหรับ Facebook Graph API
+GRAPH_API_URL = os.getenv("GRAPH_API_URL", "https://graph.facebook.com/v14.0")
+GRAPH_CONNECT_TIMEOUT = float(os.getenv("GRAPH_CONNECT_TIMEOUT", 5))
+GRAPH_READ_TIMEOUT = float(os.getenv("GRAPH_READ_TIMEOUT", 20))
+GRAPH_POOL_TIMEOUT = float(os.getenv("GRAPH_POOL_TIMEOUT", 10))
+GRAPH_MAX_CONNECTIONS = int(os.getenv("GRAPH_MAX_CONNECTIONS", 50))
+GRAPH_MAX_KEEPALIVE = int(os.getenv("GRAPH_MAX_KEEPALIVE", 20))
+GRAPH_KEEPALIVE_EXPIRY = float(os.getenv("GRAPH_KEEPALIVE_EXPIRY", 30))
+
+# ตั้งค่า rate limiter ของ Graph API (token bucket ใน Redis ใช้ร่วมกันทุก process)
+GRAPH_RATE_LIMIT_ENABLED = os.getenv("GRAPH_RATE_LIMIT_ENABLED", "true").lower() == "true"
+GRAPH_RATE_APP_PER_SEC = float(os.getenv("GRAPH_RATE_APP_PER_SEC", 50))
+GRAPH_RATE_APP_BURST = float(os.getenv("GRAPH_RATE_APP_BURST", 100))
+GRAPH_RATE_PAGE_PER_SEC = float(os.getenv("GRAPH_RATE_PAGE_PER_SEC", 20))
+GRAPH_RATE_PAGE_BURST = float(os.getenv("GRAPH_RATE_PAGE_BURST", 40))
+GRAPH_RATE_MIN_FACTOR = float(os.getenv("GRAPH_RATE_MIN_FACTOR", 0.05))
+GRAPH_RATE_MAX_WAIT = float(os.getenv("GRAPH_RATE_MAX_WAIT", 30))
+GRAPH_USAGE_THROTTLE_START = float(os.getenv("GRAPH_USAGE_THROTTLE_START", 50))
+GRAPH_USAGE_BLOCK_AT = float(os.getenv("GRAPH_USAGE_BLOCK_AT", 95))
+GRAPH_BACKOFF_BASE_SECONDS = float(os.getenv("GRAPH_BACKOFF_BASE_SECONDS", 60))
+GRAPH_BACKOFF_MAX_SECONDS = float(os.getenv("GRAPH_BACKOFF_MAX_SECONDS", 900))
+
+# ตั้งค่า broadcast sender (ส่งข้อความหลาย users พร้อมกัน)
+BROADCAST_MAX_WORKERS = int(os.getenv("BROADCAST_MAX_WORKERS", 32))
+BROADCAST_PAGE_CONCURRENCY = int(os.getenv("BROADCAST_PAGE_CONCURRENCY", 8))
+
+# ตั้งค่า schedule engine (เก็บใน Postgres, claim ด้วย lease)
+SCHEDULE_RESYNC_SECONDS = float(os.getenv("SCHEDULE_RESYNC_SECONDS", 60))
+SCHEDULE_HEAP_SIZE = int(os.getenv("SCHEDULE_HEAP_SIZE", 500))
+SCHEDULE_LEASE_SECONDS = int(os.getenv("SCHEDULE_LEASE_SECONDS", 300))
+SCHEDULE_RETRY_SECONDS = int(os.getenv("SCHEDULE_RETRY_SECONDS", 60))
+SCHEDULE_INACTIVITY_CHECK_SECONDS = int(os.getenv("SCHEDULE_INACTIVITY_CHECK_SECONDS", 30))
+SCHEDULE_MISFIRE_GRACE_SECONDS = int(os.getenv("SCHEDULE_MISFIRE_GRACE_SECONDS", 3600))
+
+# ตั้งค่า SSE hub (กระจาย event ต่อเพจผ่าน Redis pub/sub และเก็บย้อนหลังใน Redis stream)
+SSE_CHANNEL_PREFIX = os.getenv("SSE_CHANNEL_PREFIX", "sse:page")
+SSE_CLIENT_QUEUE_SIZE = int(os.getenv("SSE_CLIENT_QUEUE_SIZE", 256))
+SSE_HEARTBEAT_SECONDS = int(os.getenv("SSE_HEARTBEAT_SECONDS", 15))
+SSE_STREAM_PREFIX = os.getenv("SSE_STREAM_PREFIX", "sse:stream")
+SSE_STREAM_MAXLEN = int(os.getenv("SSE_STREAM_MAXLEN", 1000))
+SSE_STREAM_TTL_SECONDS = int(os.getenv("SSE_STREAM_TTL_SECONDS", 86400))
+
+# ตั้งค่า webhook ingest (รับ event เข้า Redis stream แล้วประมวลผลเป็น batch)
+WEBHOOK_STREAM_KEY = os.getenv("WEBHOOK_STREAM_KEY", "webhook:events")
+WEBHOOK_STREAM_MAXLEN = int(os.getenv("WEBHOOK_STREAM_MAXLEN", 100000))
+WEBHOOK_CONSUMER_GROUP = os.getenv("WEBHOOK_CONSUMER_GROUP", "webhook-ingest")
+WEBHOOK_BATCH_SIZE = int(os.getenv("WEBHOOK_BATCH_SIZE", 500))
+WEBHOOK_BLOCK_MS = int(os.getenv("WEBHOOK_BLOCK_MS", 1000))
+WEBHOOK_CLAIM_IDLE_SECONDS = int(os.getenv("WEBHOOK_CLAIM_IDLE_SECONDS", 60))
+WEBHOOK_NEW_USER_LOCK_SECONDS = int(os.getenv("WEBHOOK_NEW_USER_LOCK_SECONDS", 300))
+# event ที่ถูกส่งให้ consumer เกินจำนวนครั้งนี้จะย้ายไป dead-letter stream แล้ว ack (ไม่ค้างทั้ง batch)
+WEBHOOK_MAX_DELIVERIES = int(os.getenv("WEBHOOK_MAX_DELIVERIES", 5))
+WEBHOOK_DEAD_LETTER_KEY = os.getenv("WEBHOOK_DEAD_LETTER_KEY", "webhook:events:dead")
+
+# ตั้งค่า backfill ลูกค้าย้อนหลัง (imported customers)
+BACKFILL_PAGES_PER_TASK = int(os.getenv("BACKFILL_PAGES_PER_TASK", 20))
+BACKFILL_MAX_SLICES = int(os.getenv("BACKFILL_MAX_SLICES", 12))
+BACKFILL_SLICE_LOCK_SECONDS = int(os.getenv("BACKFILL_SLICE_LOCK_SECONDS", 330))
+
+# ตั้งค่า auto sync ใน Celery (ประมวลผลระดับเพจเป็น chunk)
+AUTO_SYNC_CHUNK_SIZE = int(os.getenv("AUTO_SYNC_CHUNK_SIZE", 50))
+AUTO_SYNC_FANOUT_THRESHOLD = int(os.getenv("AUTO_SYNC_FANOUT_THRESHOLD", 200))
+
+# ตั้งค่า cache ในหน่วยความจำ (page token / page lookup) ล้างข้าม process ผ่าน Redis pub/sub
+PAGE_CACHE_TTL_SECONDS = int(os.getenv("PAGE_CACHE_TTL_SECONDS", 300))
+PAGE_CACHE_MAXSIZE = int(os.getenv("PAGE_CACHE_MAXSIZE", 1024))
+TOKEN_CACHE_TTL_SECONDS = int(os.getenv("TOKEN_CACHE_TTL_SECONDS", 60))
+CACHE_INVALIDATION_CHANNEL = os.getenv("CACHE_INVALIDATION_CHANNEL", "cache:invalidate")
+
+# ตั้งค่าการจัดหมวดหมู่ด้วย Gemini (batch prompt + Redis cache)
+CLASSIFICATION_BATCH_SIZE = int(os.getenv("CLASSIFICATION_BATCH_SIZE", 40))
+CLASSIFICATION_CACHE_PREFIX = os.getenv("CLASSIFICATION_CACHE_PREFIX", "llm:cls")
+CLASSIFICATION_CACHE_TTL_SECONDS = int(os.getenv("CLASSIFICATION_CACHE_TTL_SECONDS", 604800))
+CLASSIFICATION_CACHE_MAX_ENTRIES = int(os.getenv("CLASSIFICATION_CACHE_MAX_ENTRIES", 50000))
+CLASSIFICATION_CANDIDATE_CHUNK_SIZE = int(os.getenv("CLASSIFICATION_CANDIDATE_CHUNK_SIZE", 500))
+
+# ตั้งค่า image pipeline สำหรับจัดหมวดหมู่รูปภาพ
+IMAGE_PIPELINE_CONCURRENCY = int(os.getenv("IMAGE_PIPELINE_CONCURRENCY", 4))
+IMAGE_DOWNLOAD_TIMEOUT = int(os.getenv("IMAGE_DOWNLOAD_TIMEOUT", 10))
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", 5 * 1024 * 1024))
+IMAGE_MAX_DIMENSION = int(os.getenv("IMAGE_MAX_DIMENSION", 768))
+IMAGE_CAPTION_CACHE_TTL_SECONDS = int(os.getenv("IMAGE_CAPTION_CACHE_TTL_SECONDS", 2592000))
+
+# ลบแถวซ้ำก่อนสร้าง unique index ตอน startup (ปิดไว้ก่อน ดูจำนวนแถวซ้ำใน log แล้วค่อยเปิด)
+SCHEMA_DEDUPE_ON_STARTUP = os.getenv("SCHEMA_DEDUPE_ON_STARTUP", "false").lower() == "true"
+
+# ตั้งค่า pagination รายชื่อลูกค้า (keyset)
+CUSTOMER_PAGE_SIZE = int(os.getenv("CUSTOMER_PAGE_SIZE", 200))
+CUSTOMER_PAGE_MAX_SIZE = int(os.getenv("CUSTOMER_PAGE_MAX_SIZE", 1000))
\ No newline at end of file
@@ -4,12 +4,18 @@ from app.database.schemas import FacebookPageCreate, FacebookPageUpdate
 from sqlalchemy.exc import IntegrityError
 import app.database.models as models
 import app.database.schemas as schemas
-from sqlalchemy import or_, func
-from datetime import datetime, timedelta
+from app.database import rollups
+from sqlalchemy import or_, func, literal_column, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from datetime import datetime, timezone
 from typing import List, Dict, Optional, Any
 import logging
 import json
+from collections import namedtuple
 from sqlalchemy.orm import Session, joinedload
+from app import config
+from app.utils.local_cache import TTLCache, publish_invalidation
+from app.utils.keyword_matcher import get_custom_group_matcher, invalidate_custom_groups
 
 
 
@@ -22,6 +28,37 @@ def get_page_by_id(db: Session, id: int):
 def get_page_by_page_id(db: Session, page_id: str):
     return db.query(models.FacebookPage).filter(models.FacebookPage.page_id == page_id).first()
 
+# ========== Page lookup cache ==========
+# ข้อมูลเพจแบบอ่านอย่างเดียว (ไม่ผูกกับ session) ใช้แทน ORM object ในงานที่ต้องการแค่ ID/page_id
+PageRef = namedtuple("PageRef", ["ID", "page_id", "page_name", "created_at"])
+
+# key: "pid:<facebook page_id>" และ "id:<database ID>"
+page_ref_cache = TTLCache("page_ref", maxsize=config.PAGE_CACHE_MAXSIZE, ttl=config.PAGE_CACHE_TTL_SECONDS)
+
+def _load_page_ref(db, column: str, value) -> Optional[PageRef]:
+    # ใช้ text SQL เพื่อให้เรียกได้ทั้งจาก Session และ Connection
+    row = db.execute(
+        text(f'SELECT "ID", page_id, page_name, created_at FROM facebook_pages WHERE {column} = :value'),
+        {"value": value}
+    ).first()
+    if row is None:
+        return None
+    ref = PageRef(row.ID, row.page_id, row.page_name, row.created_at)
+    page_ref_cache.set(f"pid:{ref.page_id}", ref)
+    page_ref_cache.set(f"id:{ref.ID}", ref)
+    return ref
+
+def get_page_ref(db, page_id: str) -> Optional[PageRef]:
+    """ดึง PageRef จาก facebook page_id (ผ่าน cache)"""
+    return page_ref_cache.get(f"pid:{page_id}") or _load_page_ref(db, "page_id", page_id)
+
+def get_page_ref_by_db_id(db, id: int) -> Optional[PageRef]:
+    """ดึง PageRef จาก database ID (ผ่าน cache)"""
+    return page_ref_cache.get(f"id:{id}") or _load_page_ref(db, '"ID"', id)
+
+def invalidate_page_ref(page_id: str, id: int):
+    publish_invalidation("page_ref", [f"pid:{page_id}", f"id:{id}"])
+
 def get_pages(db: Session, skip: int = 0, limit: int = 100):
     return db.query(FacebookPage).offset(skip).limit(limit).all()
 
@@ -34,6 +71,7 @@ def create_page(db: Session, page: schemas.FacebookPageCreate):
     db.add(db_page)
     db.commit()
     db.refresh(db_page)
+    invalidate_page_ref(db_page.page_id, db_page.ID)
     return db_page
 
 def update_page(db: Session, id: int, page_update: FacebookPageUpdate):
@@ -44,13 +82,16 @@ def update_page(db: Session, id: int, page_update: FacebookPageUpdate):
         db_page.page_name = page_update.page_name
     db.commit()
     db.refresh(db_page)
+    invalidate_page_ref(db_page.page_id, db_page.ID)
     return db_page
 
 def delete_page(db: Session, id: int):
     db_page = db.query(FacebookPage).filter(FacebookPage.ID == id).first()
     if db_page:
+        page_id, page_db_id = db_page.page_id, db_page.ID
         db.delete(db_page)
         db.commit()
+        invalidate_page_ref(page_id, page_db_id)
     return db_page
 
 def get_all_connected_pages(db: Session):
@@ -171,15 +212,46 @@ def update_customer_interaction(db: Session, page_id: int, customer_psid: str):
     
     return None
 
-def search_customers(db: Session, page_id: int, search_term: str):
-    """ค้นหาลูกค้าจากชื่อหรือ PSID"""
-    return db.query(models.FbCustomer).filter(
-        models.FbCustomer.page_id == page_id,
-        or_(
-            models.FbCustomer.name.ilike(f"%{search_term}%"),
-            models.FbCustomer.customer_psid.ilike(f"%{search_term}%")
+SEARCH_DEFAULT_LIMIT = 50
+
+def escape_like(term: str) -> str:
+    """escape อักขระพิเศษของ LIKE (ใช้คู่กับ ESCAPE '\\')"""
+    return term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+def search_customers(db: Session, page_id: int, search_term: str, limit: int = SEARCH_DEFAULT_LIMIT, skip: int = 0):
+    """
+    ค้นหาลูกค้าจากชื่อหรือ PSID (ใช้ pg_trgm GIN index)
+    - ตัวเลขล้วน: ค้น PSID แบบ prefix ก่อน (btree) ถ้าไม่เจอค่อยค้นแบบ substring
+    - ชื่อ: เรียงตาม ตรงทั้งหมด > ขึ้นต้นด้วย > ความคล้าย (similarity)
+    """
+    term = " ".join((search_term or "").split()).lower()
+    if not term:
+        return []
+    escaped = escape_like(term)
+    base = db.query(models.FbCustomer).filter(models.FbCustomer.page_id == page_id)
+
+    if term.isdigit():
+        # ตัดสินจาก "มี prefix ตรงไหม" ไม่ใช่ผลของหน้านี้ ทุกหน้าจึงใช้เส้นทางเดียวกัน
+        prefix = base.filter(models.FbCustomer.customer_psid.like(f"{escaped}%", escape="\\"))
+        if db.query(prefix.exists()).scalar():
+            return prefix.order_by(models.FbCustomer.customer_psid).offset(skip).limit(limit).all()
+
+    name = func.lower(models.FbCustomer.name)
+    query = base.filter(or_(
+        models.FbCustomer.name.ilike(f"%{escaped}%", escape="\\"),
+        models.FbCustomer.customer_psid.like(f"%{escaped}%", escape="\\")
+    ))
+    if len(term) < 3:
+        # สั้นกว่า trigram ใช้ index ไม่ได้ เอาลูกค้าที่คุยล่าสุดก่อน (หยุดอ่านเมื่อครบ limit)
+        query = query.order_by(models.FbCustomer.last_interaction_at.desc().nullslast(), models.FbCustomer.id.desc())
+    else:
+        query = query.order_by(
+            (name == term).desc(),
+            name.like(f"{escaped}%", escape="\\").desc(),
+            func.similarity(models.FbCustomer.name, term).desc(),
+            models.FbCustomer.id.desc()
         )
-    ).all()
+    return query.offset(skip).limit(limit).all()
 
 def get_customer_with_conversation_data(db: Session, page_id: int):
     """ดึงข้อมูลลูกค้าพร้อมข้อมูล conversation"""
@@ -242,46 +314,115 @@ def get_customers_by_page_with_details(db: Session, page_id: int, skip: int = 0,
     
     return result
 
+# จำนวนแถวต่อ statement ของ bulk upsert
+BULK_UPSERT_CHUNK_SIZE = 2000
+
+def _parse_interaction_time(value):
+    if isinstance(value, str):
+        return datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return value
+
+def _upsert_customer_chunk(db: Session, page_id: int, rows: List[Dict], update_category: bool):
+    """INSERT ... ON CONFLICT DO UPDATE หนึ่งครั้ง คืนแถวที่เขียน (พร้อม flag inserted)"""
+    table = FbCustomer.__table__
+    stmt = pg_insert(table).values(rows)
+    set_ = {
+        # อัพเดทชื่อ / รูป เฉพาะเมื่อมีค่าใหม่
+        'name': func.coalesce(func.nullif(stmt.excluded.name, ''), table.c.name),
+        'profile_pic': func.coalesce(func.nullif(stmt.excluded.profile_pic, ''), table.c.profile_pic),
+        # last_interaction_at เดินหน้าอย่างเดียว (GREATEST ข้าม NULL)
+        'last_interaction_at': func.greatest(table.c.last_interaction_at, stmt.excluded.last_interaction_at),
+        'updated_at': func.now(),
+    }
+    if update_category:
+        set_['current_category_id'] = stmt.excluded.current_category_id
+
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.page_id, table.c.customer_psid],
+        set_=set_
+    ).returning(
+        table.c.id, table.c.customer_psid, table.c.name, table.c.first_interaction_at,
+        table.c.last_interaction_at, table.c.source_type, table.c.current_category_id,
+        literal_column("(xmax = 0)").label("inserted")
+    )
+
+    return db.execute(stmt).fetchall()
+
+def _publish_customer_rows(page_id: int, rows):
+    # ส่ง customer_update ให้ dashboard (lazy import เพื่อเลี่ยง circular import)
+    from app.service.sse_hub import publish_customer_rows
+    try:
+        publish_customer_rows(page_id, rows)
+    except Exception as e:
+        logger.error(f"❌ Error publishing customer updates: {e}")
+
 def bulk_create_or_update_customers(db: Session, page_id: int, customers_data: List[Dict]):
-    """สร้างหรืออัพเดทลูกค้าหลายคนพร้อมกัน"""
+    """สร้างหรืออัพเดทลูกค้าหลายคนพร้อมกัน (upsert ทีละ chunk, commit ครั้งเดียวต่อ chunk)"""
     results = {"created": 0, "updated": 0, "errors": 0}
 
-    try:
-        # ดึง PSID ทั้งหมดในครั้งเดียวเพื่อลดจำนวน query
-        psids = [c.get("customer_psid") for c in customers_data if c.get("customer_psid")]
-        existing_customers = {
-            customer.customer_psid: customer
-            for customer in db.query(FbCustomer)
-            .filter(FbCustomer.page_id == page_id, FbCustomer.customer_psid.in_(psids))
-            .all()
+    # รวม PSID ซ้ำให้เหลือแถวเดียว (ON CONFLICT แก้แถวเดิมซ้ำใน statement เดียวไม่ได้)
+    merged: Dict[str, Dict] = {}
+    for customer_data in customers_data:
+        psid = customer_data.get("customer_psid")
+        if not psid:
+            results["errors"] += 1
+            continue
+        try:
+            first_supplied = _parse_interaction_time(customer_data.get('first_interaction_at'))
+            # ไม่มี last_interaction_at ก็ไม่เลื่อนเวลาคุยล่าสุด (GREATEST ข้าม NULL)
+            last_interaction = _parse_interaction_time(customer_data.get('last_interaction_at')) or first_supplied
+            first_interaction = first_supplied or datetime.now(timezone.utc)
+        except ValueError as e:
+            logger.error(f"❌ Error processing customer {psid}: {e}")
+            results["errors"] += 1
+            continue
+
+        row = {
+            'page_id': page_id,
+            'customer_psid': psid,
+            'name': customer_data.get('name') or '',
+            'profile_pic': customer_data.get('profile_pic') or '',
+            'current_category_id': customer_data.get('current_category_id'),
+            'first_interaction_at': first_interaction,
+            'last_interaction_at': last_interaction,
+            'source_type': customer_data.get('source_type', 'new'),
         }
-
-        for customer_data in customers_data:
+        row['_has_category'] = 'current_category_id' in customer_data
+
+        previous = merged.get(psid)
+        if previous:
+            row['first_interaction_at'] = min(previous['first_interaction_at'], row['first_interaction_at'])
+            row['last_interaction_at'] = max(
+                (t for t in (previous['last_interaction_at'], row['last_interaction_at']) if t is not None),
+                default=None
+            )
+            row['name'] = row['name'] or previous['name']
+            row['profile_pic'] = row['profile_pic'] or previous['profile_pic']
+            if not row['_has_category'] and previous['_has_category']:
+                row['current_category_id'] = previous['current_category_id']
+                row['_has_category'] = True
+        merged[psid] = row
+
+    # แยกแถวที่ส่ง current_category_id มาด้วย (อัพเดท category เฉพาะแถวเหล่านั้น เหมือน create_or_update_customer)
+    groups = {True: [], False: []}
+    for row in merged.values():
+        groups[row.pop('_has_category')].append(row)
+
+    for update_category, rows in groups.items():
+        for i in range(0, len(rows), BULK_UPSERT_CHUNK_SIZE):
+            chunk = rows[i:i + BULK_UPSERT_CHUNK_SIZE]
             try:
-                psid = customer_data.get("customer_psid")
-                if not psid:
-                    results["errors"] += 1
-                    continue
-
-                # ตรวจสอบว่ามีอยู่แล้วหรือไม่
-                if psid in existing_customers:
-                    create_or_update_customer(db, page_id, psid, customer_data)
-                    results["updated"] += 1
-                else:
-                    create_or_update_customer(db, page_id, psid, customer_data)
-                    results["created"] += 1
-
-            except Exception as e:
-                logger.error(f"❌ Error processing customer {customer_data.get('customer_psid')}: {e}")
-                results["errors"] += 1
-
-        db.commit()
+                written = _upsert_customer_chunk(db, page_id, chunk, update_category)
+                db.commit()
+                created = sum(1 for row in written if row.inserted)
+                results["created"] += created
+                results["updated"] += len(written) - created
+                _publish_customer_rows(page_id, written)
+            except Exception:
+                logger.exception(f"❌ Bulk upsert failed for {len(chunk)} customers")
+                db.rollback()
+                results["errors"] += len(chunk)
 
-    except Exception as e:
-        logger.exception("❌ Bulk sync failed")
-        db.rollback()
-        results["errors"] += len(customers_data)  # ถ้า fail ทั้งหมด
-    
     return results
 
 def get_customer_statistics(db: Session, page_id):
@@ -298,36 +439,98 @@ def get_customer_statistics(db: Session, page_id):
             "inactive_customers": 0
         }
     
-    total_customers = db.query(func.count(models.FbCustomer.id)).filter(
-        models.FbCustomer.page_id == db_page_id
-    ).scalar()
-    
-    # ลูกค้าที่ active ใน 7 วันที่ผ่านมา
-    active_7days = db.query(func.count(models.FbCustomer.id)).filter(
-        models.FbCustomer.page_id == db_page_id,
-        models.FbCustomer.last_interaction_at >= datetime.now() - timedelta(days=7)
-    ).scalar()
-    
-    # ลูกค้าที่ active ใน 30 วันที่ผ่านมา
-    active_30days = db.query(func.count(models.FbCustomer.id)).filter(
-        models.FbCustomer.page_id == db_page_id,
-        models.FbCustomer.last_interaction_at >= datetime.now() - timedelta(days=30)
-    ).scalar()
-    
-    # ลูกค้าใหม่ใน 7 วันที่ผ่านมา
-    new_7days = db.query(func.count(models.FbCustomer.id)).filter(
-        models.FbCustomer.page_id == db_page_id,
-        models.FbCustomer.created_at >= datetime.now() - timedelta(days=7)
-    ).scalar()
+    # อ่านจาก rollup ที่ trigger บน fb_customers อัพเดทให้ (ไม่ต้อง COUNT ทั้งตาราง)
+    return rollups.get_page_statistics(db, db_page_id)
     
+# ========== Mining Status ==========
+# สถานะปัจจุบันอยู่ใน fb_customer_mining_current (1 แถวต่อลูกค้า) ประวัติอยู่ใน fb_customer_mining_status
+# เปลี่ยนสถานะลูกค้าหลายคนด้วย statement เดียว (unnest PSID) พร้อมบันทึกประวัติใน statement เดียวกัน
+
+MINING_DEFAULT_STATUS = "ยังไม่ขุด"
+
+_MINING_TARGETS_SQL = """
+    targets AS (
+        SELECT c.id, c.customer_psid
+        FROM fb_customers c
+        JOIN (SELECT DISTINCT psid FROM unnest(CAST(:psids AS text[])) AS p(psid)) p ON c.customer_psid = p.psid
+        WHERE c.page_id = :page_id
+    )
+"""
+
+_SET_MINING_SQL = f"""
+    WITH {_MINING_TARGETS_SQL},
+    changed AS (
+        INSERT INTO fb_customer_mining_current (customer_id, status, note, updated_at)
+        SELECT id, :status, :note, now() FROM targets ORDER BY id
+        ON CONFLICT (customer_id)
+        DO UPDATE SET status = EXCLUDED.status, note = EXCLUDED.note, updated_at = EXCLUDED.updated_at
+        RETURNING customer_id
+    ),
+    history AS (
+        INSERT INTO fb_customer_mining_status (customer_id, status, note)
+        SELECT customer_id, :status, :note FROM changed
+    )
+    SELECT t.customer_psid FROM targets t JOIN changed ch ON ch.customer_id = t.id
+"""
+
+# เปลี่ยนเฉพาะลูกค้าที่สถานะปัจจุบันเป็น :expected_status (เช่น 'ขุดแล้ว' -> 'มีการตอบกลับ')
+_TRANSITION_MINING_SQL = f"""
+    WITH {_MINING_TARGETS_SQL},
+    changed AS (
+        UPDATE fb_customer_mining_current m
+        SET status = :status, note = :note, updated_at = now()
+        FROM targets t
+        WHERE m.customer_id = t.id AND m.status = :expected_status
+        RETURNING m.customer_id, t.customer_psid
+    ),
+    history AS (
+        INSERT INTO fb_customer_mining_status (customer_id, status, note)
+        SELECT customer_id, :status, :note FROM changed
+    )
+    SELECT customer_psid FROM changed
+"""
+
+def set_mining_statuses(db: Session, page_db_id: int, psids: List[str], status: str,
+                        note: Optional[str] = None, expected_status: Optional[str] = None) -> List[str]:
+    """
+    เปลี่ยนสถานะการขุดของลูกค้าหลายคนในเพจ (statement เดียว) แล้ว commit
+    expected_status: เปลี่ยนเฉพาะลูกค้าที่สถานะปัจจุบันตรงกัน
+    คืน PSID ที่ถูกเปลี่ยนจริง
+    """
+    if not psids:
+        return []
+    sql = _TRANSITION_MINING_SQL if expected_status else _SET_MINING_SQL
+    params = {
+        "page_id": page_db_id,
+        "psids": list(psids),
+        "status": status,
+        "note": note or f"Updated at {datetime.now()}",
+    }
+    if expected_status:
+        params["expected_status"] = expected_status
+    updated = [psid for (psid,) in db.execute(text(sql), params).fetchall()]
+    db.commit()
+    return updated
+
+def get_page_mining_statuses(db: Session, page_db_id: int) -> Dict[str, Dict[str, Any]]:
+    """สถานะการขุดปัจจุบันของลูกค้าทุกคนในเพจ {psid: {status, note, created_at}}"""
+    result = db.execute(text("""
+        SELECT c.customer_psid, m.status, m.note, m.updated_at
+        FROM fb_customers c
+        LEFT JOIN fb_customer_mining_current m ON m.customer_id = c.id
+        WHERE c.page_id = :page_id
+        ORDER BY c.customer_psid
+    """), {"page_id": page_db_id})
+
     return {
-        "total_customers": total_customers or 0,
-        "active_7days": active_7days or 0,
-        "active_30days": active_30days or 0,
-        "new_7days": new_7days or 0,
-        "inactive_customers": (total_customers or 0) - (active_30days or 0)
+        psid: {
+            "status": status or MINING_DEFAULT_STATUS,
+            "note": note,
+            "created_at": updated_at
+        }
+        for psid, status, note, updated_at in result
     }
-    
+
 # ========== CustomerTypeCustom CRUD Operations ==========
 
 def create_customer_type_custom(db: Session, page_id: int, type_data: dict):
@@ -354,6 +557,7 @@ def create_customer_type_custom(db: Session, page_id: int, type_data: dict):
     db.add(db_type)
     db.commit()
     db.refresh(db_type)
+    invalidate_custom_groups(page_id)
     return db_type
 
 def get_customer_type_custom_by_id(db: Session, type_id: int):
@@ -409,6 +613,7 @@ def update_customer_type_custom(db: Session, type_id: int, update_data: dict):
     db_type.updated_at = datetime.now()
     db.commit()
     db.refresh(db_type)
+    invalidate_custom_groups(db_type.page_id)
     return db_type
 
 def delete_customer_type_custom(db: Session, type_id: int, hard_delete: bool = False):
@@ -416,6 +621,7 @@ def delete_customer_type_custom(db: Session, type_id: int, hard_delete: bool = F
     db_type = get_customer_type_custom_by_id(db, type_id)
     if not db_type:
         return None
+    page_id = db_type.page_id
     
     if hard_delete:
         # ลบจริงจาก database
@@ -426,31 +632,24 @@ def delete_customer_type_custom(db: Session, type_id: int, hard_delete: bool = F
         db_type.updated_at = datetime.now()
     
     db.commit()
+    invalidate_custom_groups(page_id)
     return db_type
 
 def auto_assign_customer_type(db: Session, page_id: int, customer_psid: str, message_text: str):
     """จัดประเภทลูกค้าอัตโนมัติตาม keywords"""
-    # ดึงประเภททั้งหมดของเพจ
-    types = get_customer_types_by_page(db, page_id, include_inactive=False)
-    
-    if not types:
+    # ตรวจ keywords ของทุกประเภทในเพจด้วย matcher ที่ cache ไว้
+    type_id = get_custom_group_matcher(db, page_id).match(message_text)
+    if not type_id:
         return None
-    
-    message_lower = message_text.lower()
-    
-    for type_obj in types:
-        if type_obj.keywords:
-            keywords = [k.strip().lower() for k in type_obj.keywords.split(",")]
-            for keyword in keywords:
-                if keyword and keyword in message_lower:
-                    # พบ keyword ที่ตรงกัน
-                    customer = get_customer_by_psid(db, page_id, customer_psid)
-                    if customer:
-                        customer.customer_type_custom_id = type_obj.id
-                        customer.updated_at = datetime.now()
-                        db.commit()
-                        return type_obj
-    
+
+    # พบ keyword ที่ตรงกัน
+    customer = get_customer_by_psid(db, page_id, customer_psid)
+    if customer:
+        customer.customer_type_custom_id = type_id
+        customer.updated_at = datetime.now()
+        db.commit()
+        return get_customer_type_custom_by_id(db, type_id)
+
     return None
 
 def get_customer_type_statistics(db: Session, page_id: int):
@@ -458,30 +657,40 @@ def get_customer_type_statistics(db: Session, page_id: int):
     # ดึงจำนวนลูกค้าในแต่ละประเภท
     types = get_customer_types_by_page(db, page_id)
     
+    # ประเภท custom ของลูกค้า = custom classification ล่าสุด (rollup นับตาม knowledge category จึงใช้แทนไม่ได้)
+    # ตั้งใจไม่ทำ rollup: หน้าสถิติเรียกไม่บ่อย ไล่ลูกค้าของเพจครั้งเดียวผ่าน index (customer_id, classified_at)
+    # นับทุกประเภทใน query เดียว (key None = ยังไม่ได้จัดประเภท)
+    counts = {
+        category_id: int(total)
+        for category_id, total in db.execute(text("""
+            SELECT latest.new_category_id, count(*)
+            FROM fb_customers c
+            LEFT JOIN LATERAL (
+                SELECT new_category_id
+                FROM fb_customer_custom_classifications
+                WHERE customer_id = c.id
+                ORDER BY classified_at DESC
+                LIMIT 1
+            ) latest ON TRUE
+            WHERE c.page_id = :page_id
+            GROUP BY latest.new_category_id
+        """), {"page_id": page_id}).fetchall()
+    }
+    
     statistics = []
     for type_obj in types:
-        customer_count = db.query(func.count(models.FbCustomer.id)).filter(
-            models.FbCustomer.page_id == page_id,
-            models.FbCustomer.customer_type_custom_id == type_obj.id
-        ).scalar()
-        
         statistics.append({
             "type_id": type_obj.id,
             "type_name": type_obj.type_name,
-            "customer_count": customer_count,
+            "customer_count": counts.get(type_obj.id, 0),
             "is_active": type_obj.is_active
         })
     
     # เพิ่มลูกค้าที่ยังไม่ได้จัดประเภท
-    unassigned_count = db.query(func.count(models.FbCustomer.id)).filter(
-        models.FbCustomer.page_id == page_id,
-        models.FbCustomer.customer_type_custom_id == None
-    ).scalar()
-    
     statistics.append({
         "type_id": None,
         "type_name": "ยังไม่ได้จัดประเภท",
-        "customer_count": unassigned_count,
+        "customer_count": counts.get(None, 0),
         "is_active": True
     })
     
@@ -741,10 +950,8 @@ def get_page_db_id(db: Session, page_identifier):
         # ถ้าเป็น int แล้ว คือ database ID
         return page_identifier
     elif isinstance(page_identifier, str):
-        # ถ้าเป็น string คือ facebook page_id ต้อง query หา
-        page = db.query(models.FacebookPage).filter(
-            models.FacebookPage.page_id == page_identifier
-        ).first()
+        # ถ้าเป็น string คือ facebook page_id ต้อง query หา (ผ่าน cache)
+        page = get_page_ref(db, page_identifier)
         return page.ID if page else None
     return None
 
@@ -1,5 +1,6 @@
 from sqlalchemy import (Column, String, Integer, TIMESTAMP, ForeignKey, DateTime, 
-                        func, Text, Boolean, Interval, JSON, CheckConstraint, ARRAY, BigInteger, LargeBinary)
+                        func, Text, Boolean, Interval, JSON, CheckConstraint, ARRAY, BigInteger, LargeBinary, Date,
+                        UniqueConstraint, Index)
 from sqlalchemy.orm import relationship
 from app.database.database import Base
 
@@ -42,6 +43,18 @@ class FbCustomer(Base):
             "source_type IN ('new', 'imported')",
             name="fb_customers_source_type_check"
         ),
+        # ลูกค้า 1 คนต่อเพจ (ใช้กับ INSERT ... ON CONFLICT ใน bulk_create_or_update_customers)
+        Index("uq_fb_customers_page_psid", "page_id", "customer_psid", unique=True),
+        # สำหรับค้นหา user ที่หายไปตามช่วงเวลา (MessageScheduler)
+        Index("ix_fb_customers_page_category_last_interaction", "page_id", "current_category_id", "last_interaction_at"),
+        Index("ix_fb_customers_page_last_interaction", "page_id", "last_interaction_at"),
+        Index("ix_fb_customers_page_created", "page_id", "created_at"),
+        # ค้นหาลูกค้า (crud.search_customers): trigram สำหรับ ILIKE '%term%' และ prefix ของ PSID
+        Index("ix_fb_customers_name_trgm", "name", postgresql_using="gin", postgresql_ops={"name": "gin_trgm_ops"}),
+        Index("ix_fb_customers_psid_trgm", "customer_psid", postgresql_using="gin", postgresql_ops={"customer_psid": "gin_trgm_ops"}),
+        Index("ix_fb_customers_page_psid_pattern", "page_id", "customer_psid", postgresql_ops={"customer_psid": "varchar_pattern_ops"}),
+        # จับคู่ชื่อจากไฟล์ (file_search): lower(btrim(name)) = ANY(...)
+        Index("ix_fb_customers_page_name_normalized", "page_id", func.lower(func.btrim(name))),
     )
 
     # Relationships
@@ -50,6 +63,7 @@ class FbCustomer(Base):
     classifications = relationship("FBCustomerClassification", back_populates="customer", foreign_keys="FBCustomerClassification.customer_id")
     custom_classifications = relationship("FBCustomerCustomClassification", back_populates="customer", foreign_keys="FBCustomerCustomClassification.customer_id")
     mining_statuses = relationship("FBCustomerMiningStatus", back_populates="customer", foreign_keys="FBCustomerMiningStatus.customer_id")
+    mining_current = relationship("FBCustomerMiningCurrent", back_populates="customer", uselist=False, foreign_keys="FBCustomerMiningCurrent.customer_id")
     customermessage = relationship("CustomerMessage", back_populates="customer", cascade="all, delete-orphan", foreign_keys="CustomerMessage.customer_id")
     current_category = relationship("CustomerTypeKnowledge", foreign_keys=[current_category_id])
 
@@ -193,7 +207,11 @@ class FBCustomMessage(Base):
 
 class FBCustomerClassification(Base):
     __tablename__ = "fb_customer_classifications"
-    __table_args__ = {"schema": "public"}
+    __table_args__ = (
+        # classification ล่าสุดของลูกค้า (DISTINCT ON ใน classify_and_assign_tier_hybrid)
+        Index("ix_fb_customer_classifications_page_customer_classified", "page_id", "customer_id", "classified_at"),
+        {"schema": "public"},
+    )
 
     id = Column(BigInteger, primary_key=True)
     customer_id = Column(Integer, ForeignKey("fb_customers.id", ondelete="CASCADE"), nullable=False)
@@ -222,6 +240,10 @@ class FBCustomerCustomClassification(Base):
     classified_by = Column(Text)
     page_id = Column(Integer, ForeignKey("facebook_pages.ID", ondelete="CASCADE"), nullable=False)
 
+    __table_args__ = (
+        Index("ix_fb_customer_custom_classifications_customer_classified", "customer_id", "classified_at"),
+    )
+
     customer = relationship("FbCustomer", back_populates="custom_classifications", foreign_keys=[customer_id])
     old_category = relationship("CustomerTypeCustom", foreign_keys=[old_category_id], back_populates="old_custom_classifications")
     new_category = relationship("CustomerTypeCustom", foreign_keys=[new_category_id], back_populates="custom_classifications")
@@ -241,10 +263,31 @@ class FBCustomerMiningStatus(Base):
             "status IN ('ยังไม่ขุด', 'ขุดแล้ว', 'มีการตอบกลับ' , 'รอส่งข้อความ')",
             name="fb_customer_mining_status_check"
         ),
+        # สถานะการขุดล่าสุดของลูกค้า
+        Index("ix_fb_customer_mining_status_customer_created", "customer_id", "created_at"),
     )
 
     customer = relationship("FbCustomer", back_populates="mining_statuses", foreign_keys=[customer_id])
 
+# สถานะการขุดปัจจุบัน 1 แถวต่อลูกค้า (fb_customer_mining_status เก็บเป็นประวัติแบบ append-only)
+# ลูกค้าที่ไม่มีแถวถือว่า 'ยังไม่ขุด' - เขียนผ่าน crud.set_mining_statuses
+class FBCustomerMiningCurrent(Base):
+    __tablename__ = "fb_customer_mining_current"
+
+    customer_id = Column(Integer, ForeignKey("fb_customers.id", ondelete="CASCADE"), primary_key=True)
+    status = Column(String, nullable=False)
+    note = Column(Text)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    __table_args__ = (
+        CheckConstraint(
+            "status IN ('ยังไม่ขุด', 'ขุดแล้ว', 'มีการตอบกลับ' , 'รอส่งข้อความ')",
+            name="fb_customer_mining_current_check"
+        ),
+    )
+
+    customer = relationship("FbCustomer", back_populates="mining_current", foreign_keys=[customer_id])
+
 class RetargetTiersConfig(Base):
     __tablename__ = "retarget_tiers_config"
 
@@ -280,4 +323,119 @@ class CustomerMessage(Base):
     message_type = Column(Text, nullable=False)
     created_at = Column(TIMESTAMP(timezone=True), server_default=func.now())
 
-    customer = relationship("FbCustomer", back_populates="customermessage", foreign_keys=[customer_id])
\ No newline at end of file
+    __table_args__ = (
+        # กันข้อความซ้ำตอน sync (ON CONFLICT DO NOTHING ใน psids_sync)
+        Index("uq_customer_messages_convo_sender_created", "conversation_id", "sender_id", "created_at", unique=True),
+        # ข้อความล่าสุดของลูกค้า
+        Index("ix_customer_messages_customer_created", "customer_id", "created_at"),
+    )
+
+    customer = relationship("FbCustomer", back_populates="customermessage", foreign_keys=[customer_id])
+
+# schedule ที่เปิดใช้งานอยู่ (MessageScheduler claim ด้วย lease)
+class ActiveSchedule(Base):
+    __tablename__ = "active_message_schedules"
+
+    id = Column(Integer, primary_key=True)
+    page_id = Column(String(50), nullable=False)
+    schedule_key = Column(String(100), nullable=False)
+    schedule_type = Column(String(20), nullable=False)
+    is_knowledge_group = Column(Boolean, default=False, nullable=False)
+    payload = Column(JSON, nullable=False)
+    next_run_at = Column(DateTime(timezone=True))
+    last_sent_at = Column(DateTime(timezone=True))
+    lease_owner = Column(String(100))
+    lease_expires_at = Column(DateTime(timezone=True))
+    activated_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    __table_args__ = (
+        UniqueConstraint("page_id", "schedule_key", name="uq_active_schedule_page_key"),
+        Index("ix_active_schedule_due", "next_run_at"),
+    )
+
+    deliveries = relationship("ScheduleDelivery", back_populates="schedule", cascade="all, delete-orphan", passive_deletes=True)
+
+# สถานะการส่งราย user ของแต่ละ schedule (กันส่งซ้ำ)
+class ScheduleDelivery(Base):
+    __tablename__ = "schedule_deliveries"
+
+    id = Column(BigInteger, primary_key=True)
+    active_schedule_id = Column(Integer, ForeignKey("active_message_schedules.id", ondelete="CASCADE"), nullable=False)
+    customer_psid = Column(String(50), nullable=False)
+    status = Column(String(20), nullable=False, default="pending")
+    error = Column(Text)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    __table_args__ = (
+        UniqueConstraint("active_schedule_id", "customer_psid", name="uq_schedule_delivery_recipient"),
+        CheckConstraint(
+            "status IN ('pending', 'sent', 'failed')",
+            name="schedule_deliveries_status_check"
+        ),
+    )
+
+    schedule = relationship("ActiveSchedule", back_populates="deliveries")
+
+# checkpoint ของการ sync ข้อความต่อเพจ (psids_sync)
+# - last_updated_time: updated_time ล่าสุดของ conversation ที่ sync ครบแล้ว
+# - pending_cursor / pending_updated_time: cursor และ updated_time สูงสุดของรอบที่ยังไม่จบ (ใช้ทำต่อหลัง crash)
+class ConversationSyncCheckpoint(Base):
+    __tablename__ = "conversation_sync_checkpoints"
+
+    id = Column(Integer, primary_key=True)
+    page_id = Column(Integer, ForeignKey("facebook_pages.ID", ondelete="CASCADE"), nullable=False, unique=True)
+    last_updated_time = Column(DateTime(timezone=True))
+    pending_cursor = Column(Text)
+    pending_updated_time = Column(DateTime(timezone=True))
+    last_run_at = Column(DateTime(timezone=True))
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+# งาน sync ลูกค้าย้อนหลัง (imported customers) แบ่งเป็นช่วงเวลา 1 แถวต่อ slice
+# cursor เก็บตำแหน่งหน้า conversations ล่าสุดที่บันทึกแล้ว ใช้ทำต่อเมื่อ task ถูกขัดจังหวะ
+class CustomerBackfillSlice(Base):
+    __tablename__ = "customer_backfill_slices"
+
+    id = Column(Integer, primary_key=True)
+    job_id = Column(String(36), nullable=False)
+    page_id = Column(Integer, ForeignKey("facebook_pages.ID", ondelete="CASCADE"), nullable=False)
+    slice_index = Column(Integer, nullable=False)
+    slice_start = Column(DateTime(timezone=True), nullable=False)
+    slice_end = Column(DateTime(timezone=True), nullable=False)
+    cursor = Column(Text)
+    status = Column(String(20), nullable=False, default="pending")
+    conversations = Column(Integer, nullable=False, default=0)
+    created_count = Column(Integer, nullable=False, default=0)
+    updated_count = Column(Integer, nullable=False, default=0)
+    error_count = Column(Integer, nullable=False, default=0)
+    error = Column(Text)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    __table_args__ = (
+        UniqueConstraint("job_id", "slice_index", name="uq_customer_backfill_slice"),
+        CheckConstraint(
+            "status IN ('pending', 'running', 'done', 'failed')",
+            name="customer_backfill_slices_status_check"
+        ),
+    )
+
+
+# rollup สถิติลูกค้าต่อเพจ (อัพเดทโดย trigger บน fb_customers ดู database/rollups.py)
+# จำนวนลูกค้าต่อ current_category_id (0 = ยังไม่จัดกลุ่ม)
+class PageCategoryCount(Base):
+    __tablename__ = "page_category_counts"
+
+    page_id = Column(Integer, ForeignKey("facebook_pages.ID", ondelete="CASCADE"), primary_key=True)
+    category_id = Column(Integer, primary_key=True)
+    customers = Column(BigInteger, nullable=False, default=0)
+
+# จำนวนลูกค้าต่อวัน (เวลาไทย) ตาม created_at และ last_interaction_at
+class PageCustomerDaily(Base):
+    __tablename__ = "page_customer_daily"
+
+    page_id = Column(Integer, ForeignKey("facebook_pages.ID", ondelete="CASCADE"), primary_key=True)
+    day = Column(Date, primary_key=True)
+    created_count = Column(BigInteger, nullable=False, default=0)
+    last_interaction_count = Column(BigInteger, nullable=False, default=0)
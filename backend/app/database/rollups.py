@@ -0,0 +1,204 @@
+# backend/app/database/rollups.py
+"""
+Customer Rollups
+- page_category_counts / page_customer_daily ถูกอัพเดทโดย statement-level trigger บน fb_customers
+  จึงครอบคลุมทุกทางที่เขียนลูกค้า (webhook, sync, bulk upsert, classification, ORM)
+- trigger รวม delta ของทั้ง statement ก่อน upsert (bulk insert หลายพันแถว = upsert ไม่กี่แถว)
+- dashboard อ่านสถิติจาก rollup แทนการ COUNT ทั้งตาราง
+"""
+
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Dict, List
+
+import pytz
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_TIMEZONE = "Asia/Bangkok"
+
+# delta ของแต่ละ statement: แถวใหม่ +1, แถวเดิม -1 (UPDATE ที่ไม่เปลี่ยนค่าจะหักล้างกันเอง)
+_DELTA_SQL = {
+    "insert": "SELECT page_id, current_category_id, created_at, last_interaction_at, 1 AS n FROM new_rows",
+    "update": """SELECT page_id, current_category_id, created_at, last_interaction_at, 1 AS n FROM new_rows
+                 UNION ALL
+                 SELECT page_id, current_category_id, created_at, last_interaction_at, -1 AS n FROM old_rows""",
+    "delete": "SELECT page_id, current_category_id, created_at, last_interaction_at, -1 AS n FROM old_rows",
+}
+
+_TRANSITIONS = {
+    "insert": "REFERENCING NEW TABLE AS new_rows",
+    "update": "REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows",
+    "delete": "REFERENCING OLD TABLE AS old_rows",
+}
+
+# ข้ามเพจที่ถูกลบใน statement เดียวกัน (ON DELETE CASCADE) เพื่อไม่ให้ติด foreign key
+_FUNCTION_SQL = """
+CREATE OR REPLACE FUNCTION fb_customers_rollup_{op}() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    WITH delta AS ({delta})
+    INSERT INTO page_category_counts (page_id, category_id, customers)
+    SELECT d.page_id, COALESCE(d.current_category_id, 0), sum(d.n)
+    FROM delta d JOIN facebook_pages p ON p."ID" = d.page_id
+    GROUP BY 1, 2
+    HAVING sum(d.n) <> 0
+    ORDER BY 1, 2
+    ON CONFLICT (page_id, category_id)
+    DO UPDATE SET customers = page_category_counts.customers + EXCLUDED.customers;
+
+    WITH delta AS ({delta}),
+    buckets AS (
+        SELECT page_id, (created_at AT TIME ZONE '{tz}')::date AS day, n AS created, 0 AS interaction
+        FROM delta WHERE created_at IS NOT NULL
+        UNION ALL
+        SELECT page_id, (last_interaction_at AT TIME ZONE '{tz}')::date, 0, n
+        FROM delta WHERE last_interaction_at IS NOT NULL
+    )
+    INSERT INTO page_customer_daily (page_id, day, created_count, last_interaction_count)
+    SELECT b.page_id, b.day, sum(b.created), sum(b.interaction)
+    FROM buckets b JOIN facebook_pages p ON p."ID" = b.page_id
+    GROUP BY 1, 2
+    HAVING sum(b.created) <> 0 OR sum(b.interaction) <> 0
+    ORDER BY 1, 2
+    ON CONFLICT (page_id, day)
+    DO UPDATE SET created_count = page_customer_daily.created_count + EXCLUDED.created_count,
+                  last_interaction_count = page_customer_daily.last_interaction_count + EXCLUDED.last_interaction_count;
+
+    RETURN NULL;
+END;
+$$;
+"""
+
+_REBUILD_SQL = [
+    "DELETE FROM page_category_counts",
+    "DELETE FROM page_customer_daily",
+    """
+    INSERT INTO page_category_counts (page_id, category_id, customers)
+    SELECT page_id, COALESCE(current_category_id, 0), count(*)
+    FROM fb_customers GROUP BY 1, 2
+    """,
+    f"""
+    INSERT INTO page_customer_daily (page_id, day, created_count, last_interaction_count)
+    SELECT page_id, day, sum(created), sum(interaction) FROM (
+        SELECT page_id, (created_at AT TIME ZONE '{ROLLUP_TIMEZONE}')::date AS day, 1 AS created, 0 AS interaction
+        FROM fb_customers WHERE created_at IS NOT NULL
+        UNION ALL
+        SELECT page_id, (last_interaction_at AT TIME ZONE '{ROLLUP_TIMEZONE}')::date, 0, 1
+        FROM fb_customers WHERE last_interaction_at IS NOT NULL
+    ) b
+    GROUP BY 1, 2
+    """,
+]
+
+
+def ensure_rollup_triggers(engine):
+    """สร้าง/อัพเดท trigger ของ rollup ถ้ายังไม่เคยมีจะคำนวณ rollup จากข้อมูลเดิมทั้งหมดใน transaction เดียวกัน"""
+    with engine.begin() as conn:
+        installed = conn.execute(text(
+            "SELECT count(*) FROM pg_trigger WHERE tgname LIKE 'fb_customers_rollup_%' AND NOT tgisinternal"
+        )).scalar() == len(_DELTA_SQL)
+
+        if not installed:
+            # กันการเขียนลูกค้าระหว่างคำนวณ rollup เริ่มต้น
+            conn.execute(text("LOCK TABLE fb_customers IN SHARE ROW EXCLUSIVE MODE"))
+
+        for op, delta in _DELTA_SQL.items():
+            conn.execute(text(_FUNCTION_SQL.format(op=op, delta=delta, tz=ROLLUP_TIMEZONE)))
+            if not installed:
+                conn.execute(text(f"DROP TRIGGER IF EXISTS fb_customers_rollup_{op} ON fb_customers"))
+                conn.execute(text(
+                    f"CREATE TRIGGER fb_customers_rollup_{op} AFTER {op.upper()} ON fb_customers "
+                    f"{_TRANSITIONS[op]} FOR EACH STATEMENT EXECUTE FUNCTION fb_customers_rollup_{op}()"
+                ))
+
+        if not installed:
+            for statement in _REBUILD_SQL:
+                conn.execute(text(statement))
+            logger.info("✅ Installed customer rollup triggers and rebuilt rollups")
+
+
+def rebuild_rollups(db: Session):
+    """คำนวณ rollup ใหม่ทั้งหมดจาก fb_customers (ใช้เมื่อสงสัยว่าข้อมูลไม่ตรง)"""
+    db.execute(text("LOCK TABLE fb_customers IN SHARE ROW EXCLUSIVE MODE"))
+    for statement in _REBUILD_SQL:
+        db.execute(text(statement))
+    db.commit()
+
+
+def get_page_statistics(db: Session, page_db_id: int) -> Dict[str, int]:
+    """
+    สถิติลูกค้าของเพจจาก rollup
+    ช่วง N วันแบบ rolling: รวม bucket ของวันที่อยู่ในช่วงเต็มวัน + นับตรงเฉพาะวันที่อยู่ที่ขอบ (ใช้ index)
+    """
+    row = db.execute(text(f"""
+        WITH bounds AS (
+            SELECT now() - interval '7 days' AS b7, now() - interval '30 days' AS b30
+        ),
+        days AS (
+            SELECT b7, b30,
+                   (b7 AT TIME ZONE '{ROLLUP_TIMEZONE}')::date AS d7,
+                   (b30 AT TIME ZONE '{ROLLUP_TIMEZONE}')::date AS d30
+            FROM bounds
+        )
+        SELECT
+            (SELECT COALESCE(sum(customers), 0) FROM page_category_counts WHERE page_id = :page_id) AS total,
+            (SELECT COALESCE(sum(last_interaction_count), 0) FROM page_customer_daily
+             WHERE page_id = :page_id AND day > days.d7)
+          + (SELECT count(*) FROM fb_customers
+             WHERE page_id = :page_id AND last_interaction_at >= days.b7
+               AND last_interaction_at < (days.d7 + 1)::timestamp AT TIME ZONE '{ROLLUP_TIMEZONE}') AS active_7days,
+            (SELECT COALESCE(sum(last_interaction_count), 0) FROM page_customer_daily
+             WHERE page_id = :page_id AND day > days.d30)
+          + (SELECT count(*) FROM fb_customers
+             WHERE page_id = :page_id AND last_interaction_at >= days.b30
+               AND last_interaction_at < (days.d30 + 1)::timestamp AT TIME ZONE '{ROLLUP_TIMEZONE}') AS active_30days,
+            (SELECT COALESCE(sum(created_count), 0) FROM page_customer_daily
+             WHERE page_id = :page_id AND day > days.d7)
+          + (SELECT count(*) FROM fb_customers
+             WHERE page_id = :page_id AND created_at >= days.b7
+               AND created_at < (days.d7 + 1)::timestamp AT TIME ZONE '{ROLLUP_TIMEZONE}') AS new_7days
+        FROM days
+    """), {"page_id": page_db_id}).first()
+
+    return {
+        "total_customers": int(row.total),
+        "active_7days": int(row.active_7days),
+        "active_30days": int(row.active_30days),
+        "new_7days": int(row.new_7days),
+        "inactive_customers": int(row.total) - int(row.active_30days)
+    }
+
+
+def get_category_counts(db: Session, page_db_id: int) -> Dict[int, int]:
+    """{current_category_id: จำนวนลูกค้า} (key 0 = ยังไม่จัดกลุ่ม)"""
+    return {
+        category_id: int(customers)
+        for category_id, customers in db.execute(
+            text("SELECT category_id, customers FROM page_category_counts WHERE page_id = :page_id"),
+            {"page_id": page_db_id}
+        ).fetchall()
+    }
+
+
+def get_daily_activity(db: Session, page_db_id: int, days: int = 30) -> List[Dict[str, Any]]:
+    """จำนวนลูกค้าใหม่ / ลูกค้าที่คุยล่าสุดในแต่ละวัน ย้อนหลัง N วัน (วันที่ไม่มีข้อมูลเป็น 0)"""
+    start = datetime.now(pytz.timezone(ROLLUP_TIMEZONE)).date() - timedelta(days=days - 1)
+    rows = {
+        row.day: row
+        for row in db.execute(text("""
+            SELECT day, created_count, last_interaction_count
+            FROM page_customer_daily
+            WHERE page_id = :page_id AND day >= :start
+        """), {"page_id": page_db_id, "start": start}).fetchall()
+    }
+    return [
+        {
+            "date": (start + timedelta(days=offset)).isoformat(),
+            "new_customers": int(rows[day].created_count) if day in rows else 0,
+            "last_active_customers": int(rows[day].last_interaction_count) if day in rows else 0,
+        }
+        for offset in range(days)
+        for day in [start + timedelta(days=offset)]
+    ]
@@ -0,0 +1,186 @@
+# backend/app/database/schema_sync.py
+"""
+Schema Sync
+สร้าง extension ก่อน Base.metadata.create_all (index gin_trgm_ops ต้องมี pg_trgm ก่อน)
+create_all สร้างเฉพาะตารางที่ยังไม่มี ไฟล์นี้เพิ่ม index ที่ประกาศใน models ให้กับตารางที่มีอยู่แล้ว (รันซ้ำได้)
+"""
+
+import logging
+
+from sqlalchemy import text
+
+from app import config
+from app.database.database import Base
+from app.database.rollups import ensure_rollup_triggers
+
+logger = logging.getLogger(__name__)
+
+# extension ที่ index ใน models ต้องใช้ (pg_trgm: gin_trgm_ops)
+EXTENSIONS = ["pg_trgm"]
+
+# เติมตารางใหม่จากข้อมูลเดิม (รันเฉพาะตอนที่ตารางยังว่าง)
+BACKFILLS = {
+    # สถานะการขุดปัจจุบัน = record ล่าสุดของแต่ละลูกค้าในประวัติ
+    "fb_customer_mining_current": """
+        INSERT INTO fb_customer_mining_current (customer_id, status, note, updated_at)
+        SELECT DISTINCT ON (customer_id) customer_id, status, note, created_at
+        FROM fb_customer_mining_status
+        ORDER BY customer_id, created_at DESC
+        ON CONFLICT (customer_id) DO NOTHING
+    """,
+}
+
+
+def _dedupe_customers(conn):
+    """รวมลูกค้าที่ซ้ำ (page_id, customer_psid) เข้ากับแถวที่ id ต่ำสุด แล้วลบแถวที่เหลือ"""
+    conn.execute(text("""
+        CREATE TEMP TABLE customer_duplicates ON COMMIT DROP AS
+        SELECT id AS dup_id, keep_id FROM (
+            SELECT id, min(id) OVER (PARTITION BY page_id, customer_psid) AS keep_id FROM fb_customers
+        ) x
+        WHERE id <> keep_id
+    """))
+    conn.execute(text("""
+        UPDATE fb_customers k
+        SET first_interaction_at = LEAST(k.first_interaction_at, m.first_interaction_at),
+            last_interaction_at = GREATEST(k.last_interaction_at, m.last_interaction_at),
+            name = COALESCE(k.name, m.name)
+        FROM (
+            SELECT d.keep_id, min(c.first_interaction_at) AS first_interaction_at,
+                   max(c.last_interaction_at) AS last_interaction_at, max(c.name) AS name
+            FROM customer_duplicates d JOIN fb_customers c ON c.id = d.dup_id
+            GROUP BY d.keep_id
+        ) m
+        WHERE k.id = m.keep_id
+    """))
+
+    # ย้ายข้อมูลที่อ้างถึงแถวซ้ำไปที่แถวที่เก็บไว้ (ตารางที่ customer_id เป็น key ลบแถวของตัวซ้ำทิ้ง)
+    for table in Base.metadata.sorted_tables:
+        for fk in table.foreign_keys:
+            if fk.column.table.name != "fb_customers" or table.name == "fb_customers":
+                continue
+            column = fk.parent.name
+            if fk.parent.primary_key or fk.parent.unique:
+                conn.execute(text(
+                    f"DELETE FROM {table.name} t USING customer_duplicates d WHERE t.{column} = d.dup_id"
+                ))
+            else:
+                conn.execute(text(
+                    f"UPDATE {table.name} t SET {column} = d.keep_id FROM customer_duplicates d WHERE t.{column} = d.dup_id"
+                ))
+
+    return conn.execute(text(
+        "DELETE FROM fb_customers c USING customer_duplicates d WHERE c.id = d.dup_id"
+    )).rowcount
+
+
+def _dedupe_customer_messages(conn):
+    """ลบข้อความซ้ำ (conversation_id, sender_id, created_at) เก็บแถวที่ id ต่ำสุด"""
+    return conn.execute(text("""
+        DELETE FROM customer_messages m
+        USING (
+            SELECT id, row_number() OVER (
+                PARTITION BY conversation_id, sender_id, created_at ORDER BY id
+            ) AS rn
+            FROM customer_messages
+        ) ranked
+        WHERE m.id = ranked.id AND ranked.rn > 1
+    """)).rowcount
+
+
+# unique index ที่ INSERT ... ON CONFLICT ต้องใช้: ตารางเดิมอาจมีแถวซ้ำ
+# ลบแถวซ้ำเฉพาะเมื่อเปิด SCHEMA_DEDUPE_ON_STARTUP ถ้ายังสร้างไม่ได้ให้หยุด startup เพราะการ upsert จะ error ทุกครั้ง
+UNIQUE_INDEX_DEDUPES = {
+    "uq_fb_customers_page_psid": _dedupe_customers,
+    "uq_customer_messages_convo_sender_created": _dedupe_customer_messages,
+}
+
+
+def _index_exists(conn, name: str) -> bool:
+    return conn.execute(text("SELECT to_regclass(:name) IS NOT NULL"), {"name": name}).scalar()
+
+
+def _count_duplicates(conn, index) -> int:
+    """จำนวนแถวที่จะถูกลบถ้าเก็บไว้แค่แถวเดียวต่อ key ของ index"""
+    columns = ", ".join(column.name for column in index.columns)
+    return conn.execute(text(f"""
+        SELECT COALESCE(sum(n - 1), 0) FROM (
+            SELECT count(*) AS n FROM {index.table.name} GROUP BY {columns} HAVING count(*) > 1
+        ) d
+    """)).scalar()
+
+
+def _ensure_unique_indexes(engine, dedupe: bool):
+    indexes = {
+        index.name: index
+        for table in Base.metadata.sorted_tables
+        for index in table.indexes
+        if index.name in UNIQUE_INDEX_DEDUPES
+    }
+    for name, remove_duplicates in UNIQUE_INDEX_DEDUPES.items():
+        with engine.begin() as conn:
+            if _index_exists(conn, name):
+                continue
+            # หลาย process startup พร้อมกัน: ทำทีละ process แล้วตรวจซ้ำหลังได้ lock
+            conn.execute(text("SELECT pg_advisory_xact_lock(hashtext(:name))"), {"name": name})
+            if _index_exists(conn, name):
+                continue
+            index = indexes[name]
+            # กันแถวซ้ำใหม่ระหว่างลบแถวซ้ำและสร้าง index
+            conn.execute(text(f"LOCK TABLE {index.table.name} IN SHARE ROW EXCLUSIVE MODE"))
+            duplicates = _count_duplicates(conn, index)
+            if duplicates:
+                logger.warning(f"⚠️ {index.table.name} has {duplicates} duplicate rows blocking {name}")
+                if not dedupe:
+                    raise RuntimeError(
+                        f"{index.table.name} has {duplicates} duplicate rows; "
+                        f"set SCHEMA_DEDUPE_ON_STARTUP=true to merge them and create {name}"
+                    )
+                removed = remove_duplicates(conn)
+                logger.info(f"✅ Removed {removed} duplicate rows from {index.table.name}")
+            index.create(bind=conn)
+            logger.info(f"✅ Created {name}")
+
+
+def ensure_schema(engine, dedupe: bool = None):
+    """
+    สร้าง extension, ตาราง, index, trigger ของ rollup และเติมข้อมูลตารางใหม่ที่ยังไม่มีในฐานข้อมูล
+    - dedupe: ลบแถวซ้ำที่ขวาง unique index (ค่าเริ่มต้นตาม SCHEMA_DEDUPE_ON_STARTUP)
+    """
+    if dedupe is None:
+        dedupe = config.SCHEMA_DEDUPE_ON_STARTUP
+    for extension in EXTENSIONS:
+        try:
+            with engine.begin() as conn:
+                conn.execute(text(f"CREATE EXTENSION IF NOT EXISTS {extension}"))
+        except Exception as e:
+            logger.error(f"❌ Cannot create extension {extension}: {e}")
+
+    Base.metadata.create_all(bind=engine)
+
+    try:
+        _ensure_unique_indexes(engine, dedupe)
+    except Exception as e:
+        logger.error(f"❌ Cannot create unique indexes: {e}")
+        raise RuntimeError(f"Required unique index is missing: {e}") from e
+
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                index.create(bind=engine, checkfirst=True)
+            except Exception as e:
+                logger.error(f"❌ Cannot create index {index.name}: {e}")
+
+    try:
+        ensure_rollup_triggers(engine)
+    except Exception as e:
+        logger.error(f"❌ Cannot install customer rollup triggers: {e}")
+
+    for table, statement in BACKFILLS.items():
+        try:
+            with engine.begin() as conn:
+                if not conn.execute(text(f"SELECT EXISTS (SELECT 1 FROM {table})")).scalar():
+                    result = conn.execute(text(statement))
+                    logger.info(f"✅ Backfilled {result.rowcount} rows into {table}")
+        except Exception as e:
+            logger.error(f"❌ Cannot backfill {table}: {e}")
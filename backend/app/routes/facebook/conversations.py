@@ -12,7 +12,7 @@ from fastapi.responses import JSONResponse
 from sqlalchemy.orm import Session
 
 from app.database.database import get_db
-from app.service.facebook_api import fb_get
+from app.service.facebook_api import fb_get, fb_batch_get
 from .auth import get_page_tokens
 
 router = APIRouter()
@@ -64,39 +64,27 @@ def get_conversations_with_participants(page_id, access_token: str = None):
     print(f"✅ พบ conversations จำนวน: {len(result.get('data', []))}")
     return result
 
-# API สำหรับดึงข้อมูลผู้ใช้จาก PSID
-def get_user_info_from_psid(psid, access_token):
-    """ดึงข้อมูลผู้ใช้จาก PSID"""
-    methods = [
-        {
-            "endpoint": f"{psid}",
-            "params": {"fields": "name,first_name,last_name,profile_pic"}
-        },
-        {
-            "endpoint": f"me",
-            "params": {
-                "fields": f"{psid}.name,{psid}.first_name,{psid}.last_name",
-                "ids": psid
-            }
-        }
+# ช่องทางดึงข้อมูลผู้ใช้จาก PSID (ลองตามลำดับ)
+def _user_info_requests(psid):
+    return [
+        (f"{psid}", {"fields": "name,first_name,last_name,profile_pic"}),
+        ("me", {"fields": f"{psid}.name,{psid}.first_name,{psid}.last_name", "ids": psid}),
     ]
 
-    for method in methods:
-        try:
-            result = fb_get(method["endpoint"], method["params"], access_token)
-            if "error" not in result:
-                name = result.get("name") or result.get("first_name", "")
-                if name:
-                    return {
-                        "name": name,
-                        "first_name": result.get("first_name", ""),
-                        "last_name": result.get("last_name", ""),
-                        "profile_pic": result.get("profile_pic", "")
-                    }
-        except Exception as e:
-            print(f"⚠️ Method failed: {e}")
-            continue
+def _parse_user_info(result):
+    if not result or "error" in result:
+        return None
+    name = result.get("name") or result.get("first_name", "")
+    if not name:
+        return None
+    return {
+        "name": name,
+        "first_name": result.get("first_name", ""),
+        "last_name": result.get("last_name", ""),
+        "profile_pic": result.get("profile_pic", "")
+    }
 
+def _fallback_user_info(psid):
     fallback_name = f"User...{psid[-8:]}" if len(psid) > 8 else f"User {psid}"
     return {
         "name": fallback_name,
@@ -105,41 +93,137 @@ def get_user_info_from_psid(psid, access_token):
         "profile_pic": ""
     }
 
+# API สำหรับดึงข้อมูลผู้ใช้จาก PSID หลายคนพร้อมกัน (Graph Batch)
+def get_user_infos_from_psids(psids, access_token):
+    """ดึงข้อมูลผู้ใช้จากหลาย PSID ด้วย batch request คืน dict {psid: info}"""
+    infos = {}
+    pending = list(dict.fromkeys(psids))
+    for method_index in range(len(_user_info_requests(""))):
+        if not pending:
+            break
+        requests = [_user_info_requests(psid)[method_index] for psid in pending]
+        results = fb_batch_get(requests, access_token)
+        still_pending = []
+        for psid, result in zip(pending, results):
+            info = _parse_user_info(result)
+            if info:
+                infos[psid] = info
+            else:
+                still_pending.append(psid)
+        pending = still_pending
+
+    for psid in pending:
+        infos[psid] = _fallback_user_info(psid)
+    return infos
+
+# API สำหรับดึงข้อมูลผู้ใช้จาก PSID
+def get_user_info_from_psid(psid, access_token):
+    """ดึงข้อมูลผู้ใช้จาก PSID"""
+    for endpoint, params in _user_info_requests(psid):
+        try:
+            info = _parse_user_info(fb_get(endpoint, params, access_token))
+            if info:
+                return info
+        except Exception as e:
+            print(f"⚠️ Method failed: {e}")
+            continue
+
+    return _fallback_user_info(psid)
+
+def _messages_name_request(conversation_id):
+    return (f"{conversation_id}/messages", {"fields": "from,message", "limit": 10})
+
+def _extract_sender_name(result, page_id):
+    if result and "data" in result:
+        for message in result["data"]:
+            sender = message.get("from", {})
+            sender_name = sender.get("name")
+            sender_id = sender.get("id")
+            if sender_id != page_id and sender_name:
+                return sender_name
+    return None
+
+# API สำหรับดึงชื่อจากข้อความของหลาย conversation พร้อมกัน (Graph Batch)
+def get_names_from_messages(conversation_ids, access_token, page_id):
+    """ดึงชื่อผู้ใช้จากข้อความของหลาย conversation คืน dict {conversation_id: name|None}"""
+    conversation_ids = list(dict.fromkeys(conversation_ids))
+    if not conversation_ids:
+        return {}
+    results = fb_batch_get([_messages_name_request(cid) for cid in conversation_ids], access_token)
+    return {
+        cid: _extract_sender_name(result, page_id)
+        for cid, result in zip(conversation_ids, results)
+    }
+
 # API สำหรับดึงชื่อจากข้อความใน conversation
 def get_name_from_messages(conversation_id, access_token, page_id):
     """ดึงชื่อผู้ใช้จากข้อความใน conversation"""
     try:
-        endpoint = f"{conversation_id}/messages"
-        params = {
-            "fields": "from,message",
-            "limit": 10
-        }
-        result = fb_get(endpoint, params, access_token)
-        if "data" in result:
-            for message in result["data"]:
-                sender = message.get("from", {})
-                sender_name = sender.get("name")
-                sender_id = sender.get("id")
-                if sender_id != page_id and sender_name:
-                    return sender_name
-        return None
+        endpoint, params = _messages_name_request(conversation_id)
+        return _extract_sender_name(fb_get(endpoint, params, access_token), page_id)
     except Exception as e:
         print(f"❌ Error getting name from messages: {e}")
         return None
 
+def _first_message_request(conversation_id):
+    return (f"{conversation_id}/messages", {"fields": "created_time", "limit": 1, "order": "chronological"})
+
+def _extract_first_message_time(result):
+    if result and "data" in result and result["data"]:
+        return result["data"][0].get("created_time")
+    return None
+
+# API สำหรับดึงเวลาของข้อความแรกในหลาย conversation พร้อมกัน (Graph Batch)
+def get_first_message_times(conversation_ids, access_token):
+    """ดึงเวลาของข้อความแรก คืน dict {conversation_id: created_time|None}"""
+    conversation_ids = list(dict.fromkeys(conversation_ids))
+    if not conversation_ids:
+        return {}
+    results = fb_batch_get([_first_message_request(cid) for cid in conversation_ids], access_token)
+    return {
+        cid: _extract_first_message_time(result)
+        for cid, result in zip(conversation_ids, results)
+    }
+
 # API สำหรับดึงเวลาของข้อความแรกใน conversation
 def get_first_message_time(conversation_id, access_token):
     """ดึงเวลาของข้อความแรกใน conversation"""
-    endpoint = f"{conversation_id}/messages"
-    params = {
-        "fields": "created_time",
-        "limit": 1,
-        "order": "chronological"
-    }
-    result = fb_get(endpoint, params, access_token)
-    if "data" in result and result["data"]:
-        return result["data"][0].get("created_time")
-    return None
+    endpoint, params = _first_message_request(conversation_id)
+    return _extract_first_message_time(fb_get(endpoint, params, access_token))
+
+# API สำหรับหาชื่อ participants ทั้งหมดใน conversations ด้วย batch request
+def resolve_participant_names(conversations, access_token, page_id):
+    """
+    คืน dict {psid: name} ของทุก participant (ยกเว้นเพจ)
+    - ใช้ชื่อจาก participants ก่อน
+    - ที่ไม่มีชื่อ → batch ดึงจาก PSID แล้วจากข้อความใน conversation
+    """
+    names = {}
+    convo_of = {}
+    for convo in conversations:
+        for participant in convo.get("participants", {}).get("data", []):
+            participant_id = participant.get("id")
+            if participant_id and participant_id != page_id:
+                names[participant_id] = participant.get("name") or None
+                convo_of.setdefault(participant_id, convo.get("id"))
+
+    missing = [psid for psid, name in names.items() if not name]
+    if missing:
+        for psid, info in get_user_infos_from_psids(missing, access_token).items():
+            names[psid] = info.get("name")
+
+    unresolved = [psid for psid, name in names.items() if not name or name.startswith("User")]
+    if unresolved:
+        message_names = get_names_from_messages([convo_of[psid] for psid in unresolved], access_token, page_id)
+        for psid in unresolved:
+            message_name = message_names.get(convo_of[psid])
+            if message_name:
+                names[psid] = message_name
+
+    for psid, name in names.items():
+        if not name:
+            names[psid] = f"User...{psid[-8:]}"
+    return names
 
 # API สำหรับแปลงข้อมูล conversations เป็นรูปแบบที่ frontend ต้องการ
 def extract_psids_with_conversation_id(conversations_data, access_token, page_id):
@@ -149,11 +233,15 @@ def extract_psids_with_conversation_id(conversations_data, access_token, page_id
         print("❌ ไม่มีข้อมูล conversations")
         return result
 
-    for convo in conversations_data.get("data", []):
+    conversations = conversations_data.get("data", [])
+    first_message_times = get_first_message_times([c.get("id") for c in conversations], access_token)
+    participant_names = resolve_participant_names(conversations, access_token, page_id)
+
+    for convo in conversations:
         convo_id = convo.get("id")
         updated_time = convo.get("updated_time")
         participants = convo.get("participants", {}).get("data", [])
-        created_time = get_first_message_time(convo_id, access_token)
+        created_time = first_message_times.get(convo_id)
         user_psids = []
         user_names = []
 
@@ -161,20 +249,7 @@ def extract_psids_with_conversation_id(conversations_data, access_token, page_id
             participant_id = participant.get("id")
             if participant_id and participant_id != page_id:
                 user_psids.append(participant_id)
-                user_name = participant.get("name") or None
-
-                if not user_name:
-                    user_info = get_user_info_from_psid(participant_id, access_token)
-                    user_name = user_info.get("name")
-
-                if not user_name or user_name.startswith("User"):
-                    message_name = get_name_from_messages(convo_id, access_token, page_id)
-                    if message_name:
-                        user_name = message_name
-
-                if not user_name:
-                    user_name = f"User...{participant_id[-8:]}"
-                user_names.append(user_name)
+                user_names.append(participant_names[participant_id])
 
         if user_psids:
             result.append({
@@ -13,13 +13,14 @@ from fastapi.responses import JSONResponse
 from sqlalchemy.orm import Session
 from datetime import datetime, timedelta
 from typing import Optional
+import asyncio
 import pytz
 
 from app.database import crud
 from app.database.database import get_db
-from app.service.facebook_api import fb_get
+from app.service.facebook_api import async_fb_get
 from .auth import get_page_tokens
-from .conversations import get_user_info_from_psid, get_name_from_messages
+from .conversations import get_user_info_from_psid, get_name_from_messages, resolve_participant_names
 from .utils import fix_isoformat,calculate_filter_dates, parse_iso_datetime, build_customer_data
 
 router = APIRouter()
@@ -44,7 +45,7 @@ async def get_customers(
         )
     
     if search:
-        customers = crud.search_customers(db, page.ID, search)
+        customers = crud.search_customers(db, page.ID, search, limit=limit, skip=skip)
     else:
         customers = crud.get_customers_by_page(db, page.ID, skip, limit)
     
@@ -168,7 +169,7 @@ async def sync_facebook_customers_enhanced(
             "limit": 100
         }
         
-        conversations = fb_get(endpoint, params, access_token)
+        conversations = await async_fb_get(endpoint, params, access_token)
         if "error" in conversations:
             return JSONResponse(status_code=500, content={"error": "ไม่สามารถดึง conversations ได้"})
 
@@ -178,6 +179,11 @@ async def sync_facebook_customers_enhanced(
         customers_to_sync = []
         filtered_count, error_count = 0, 0
 
+        # หาชื่อ participants ทั้งหมดด้วย batch request แทนการเรียกทีละคน
+        participant_names = await asyncio.to_thread(
+            resolve_participant_names, conversations.get("data", []), access_token, page_id
+        )
+
         for convo in conversations.get("data", []):
             updated_time = convo.get("updated_time")
             convo_time = parse_iso_datetime(updated_time)
@@ -207,14 +213,15 @@ async def sync_facebook_customers_enhanced(
                 
                 customer_data = build_fn(
                     participant_id=participant_id,
-                    user_name=participant.get("name"),
+                    user_name=participant_names.get(participant_id),
                     first_msg_time=first_msg_time,
                     last_msg_time=last_msg_time,
                     updated_time=updated_time,
                     installed_at=installed_at,
                     page_id=page_id,
                     access_token=access_token,
-                    convo_id=convo.get("id")
+                    convo_id=convo.get("id"),
+                    resolve_name=False
                 )
 
                 if customer_data:
@@ -1,23 +1,129 @@
 # ไว้ในการตรวจสอบและค้นหา customers จากรายชื่อในไฟล์ ใน database
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request
 from sqlalchemy.orm import Session
-from sqlalchemy import or_, func
-from typing import List
+from sqlalchemy import text
+from typing import Dict, Iterable, List, Set
 from pydantic import BaseModel
+import codecs
+import csv
 import logging
 
 from app.database import crud
 from app.database.database import get_db
-from app.database.models import FbCustomer, FacebookPage
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
+# ชื่อที่สั้นกว่านี้ใช้ trigram index ไม่ได้ จึงค้นเฉพาะแบบตรงทั้งคำ
+MIN_SUBSTRING_LENGTH = 3
+
+_CUSTOMER_COLUMNS = "c.id, c.customer_psid, c.name, c.first_interaction_at, c.last_interaction_at, c.source_type"
+
 class FileSearchRequest(BaseModel):
     page_id: str
     user_names: List[str]
 
+def normalize_name(name: str) -> str:
+    return name.strip().lower()
+
+def name_spans(name: str) -> Set[str]:
+    """ทุกช่วงคำที่ต่อกันในชื่อ เช่น 'a b c' -> a, b, c, a b, b c, a b c (ใช้หาลูกค้าที่ชื่ออยู่ในชื่อจากไฟล์)"""
+    tokens = name.split()
+    spans = {name}
+    for start in range(len(tokens)):
+        for end in range(start + 1, len(tokens) + 1):
+            spans.add(" ".join(tokens[start:end]))
+    return spans
+
+def match_customers_by_names(db: Session, page_db_id: int, names: Iterable[str]):
+    """
+    จับคู่รายชื่อกับลูกค้าของเพจ คืน (rows ของลูกค้าที่พบ, ชื่อ normalize ที่พบ)
+    - ชื่อตรงกัน / ชื่อลูกค้าเป็นช่วงคำในชื่อจากไฟล์: query เดียวด้วย = ANY(...) (expression index)
+    - ชื่อจากไฟล์อยู่ในชื่อลูกค้า: join กับ unnest ให้แต่ละชื่อใช้ trigram index
+    """
+    terms = {normalize_name(name) for name in names if name and name.strip()}
+    if not terms:
+        return [], set()
+
+    span_to_terms: Dict[str, Set[str]] = {}
+    for term in terms:
+        for span in name_spans(term):
+            span_to_terms.setdefault(span, set()).add(term)
+
+    customers = {}
+    found_terms = set()
+
+    rows = db.execute(text(f"""
+        SELECT {_CUSTOMER_COLUMNS}, lower(btrim(c.name)) AS normalized
+        FROM fb_customers c
+        WHERE c.page_id = :page_db_id AND lower(btrim(c.name)) = ANY(:spans)
+    """), {"page_db_id": page_db_id, "spans": list(span_to_terms)}).fetchall()
+    for row in rows:
+        customers[row.id] = row
+        found_terms.update(span_to_terms.get(row.normalized, ()))
+
+    long_terms = [term for term in terms if len(term) >= MIN_SUBSTRING_LENGTH]
+    if long_terms:
+        rows = db.execute(text(f"""
+            SELECT {_CUSTOMER_COLUMNS}, p.term
+            FROM unnest(CAST(:terms AS text[]), CAST(:patterns AS text[])) AS p(term, pattern)
+            JOIN fb_customers c ON c.page_id = :page_db_id AND c.name ILIKE p.pattern
+        """), {
+            "page_db_id": page_db_id,
+            "terms": long_terms,
+            "patterns": [f"%{crud.escape_like(term)}%" for term in long_terms],
+        }).fetchall()
+        for row in rows:
+            customers[row.id] = row
+            found_terms.add(row.term)
+
+    ordered = sorted(
+        customers.values(),
+        key=lambda row: (row.last_interaction_at is not None, row.last_interaction_at),
+        reverse=True
+    )
+    return ordered, found_terms
+
+def build_search_response(db: Session, page_id: str, user_names: List[str]):
+    # ตรวจสอบ page
+    page = crud.get_page_ref(db, page_id)
+    if not page:
+        raise HTTPException(status_code=404, detail="Page not found")
+
+    logger.info(f"🔍 ค้นหา {len(user_names)} รายชื่อใน database")
+    found_customers, found_names = match_customers_by_names(db, page.ID, user_names)
+
+    # หารายชื่อที่ไม่พบ
+    not_found_names = [name for name in user_names
+                      if name.strip() and normalize_name(name) not in found_names]
+
+    logger.info(f"✅ พบ {len(found_customers)} คน จากทั้งหมด {len(user_names)} คน")
+
+    # Format ข้อมูล
+    customers_data = []
+    for idx, customer in enumerate(found_customers):
+        customers_data.append({
+            "id": idx + 1,
+            "conversation_id": customer.customer_psid,
+            "conversation_name": customer.name or f"User...{customer.customer_psid[-8:]}",
+            "user_name": customer.name or f"User...{customer.customer_psid[-8:]}",
+            "raw_psid": customer.customer_psid,
+            "updated_time": customer.last_interaction_at.isoformat() if customer.last_interaction_at else None,
+            "created_time": customer.first_interaction_at.isoformat() if customer.first_interaction_at else None,
+            "last_user_message_time": customer.last_interaction_at.isoformat() if customer.last_interaction_at else None,
+            "first_interaction_at": customer.first_interaction_at.isoformat() if customer.first_interaction_at else None,
+            "source_type": customer.source_type,
+            "from_file_search": True
+        })
+
+    return {
+        "found_count": len(found_customers),
+        "not_found_count": len(not_found_names),
+        "customers": customers_data,
+        "not_found_names": not_found_names[:10]
+    }
+
 # API สำหรับค้นหา customers จากรายชื่อในไฟล์
 @router.post("/search-customers-by-file")
 async def search_customers_by_file(
@@ -26,66 +132,45 @@ async def search_customers_by_file(
 ):
     """ค้นหา customers จากรายชื่อในไฟล์"""
     try:
-        # ตรวจสอบ page
-        page = crud.get_page_by_page_id(db, request.page_id)
-        if not page:
-            raise HTTPException(status_code=404, detail="Page not found")
-        
-        # Normalize รายชื่อ
-        normalized_names = [name.strip().lower() for name in request.user_names if name.strip()]
-        
-        logger.info(f"🔍 ค้นหา {len(normalized_names)} รายชื่อใน database")
-        
-        # ค้นหา customers ทั้งหมดของ page นี้
-        all_customers = db.query(FbCustomer).filter(
-            FbCustomer.page_id == page.ID
-        ).all()
-        
-        found_customers = []
-        found_names = set()
-        
-        # เปรียบเทียบชื่อ
-        for customer in all_customers:
-            customer_name_lower = (customer.name or "").strip().lower()
-            
-            for search_name in normalized_names:
-                if (customer_name_lower == search_name or 
-                    search_name in customer_name_lower or 
-                    customer_name_lower in search_name):
-                    found_customers.append(customer)
-                    found_names.add(search_name)
-                    break
-        
-        # หารายชื่อที่ไม่พบ
-        not_found_names = [name for name in request.user_names 
-                          if name.strip().lower() not in found_names]
-        
-        logger.info(f"✅ พบ {len(found_customers)} คน จากทั้งหมด {len(normalized_names)} คน")
-        
-        # Format ข้อมูล
-        customers_data = []
-        for idx, customer in enumerate(found_customers):
-            customers_data.append({
-                "id": idx + 1,
-                "conversation_id": customer.customer_psid,
-                "conversation_name": customer.name or f"User...{customer.customer_psid[-8:]}",
-                "user_name": customer.name or f"User...{customer.customer_psid[-8:]}",
-                "raw_psid": customer.customer_psid,
-                "updated_time": customer.last_interaction_at.isoformat() if customer.last_interaction_at else None,
-                "created_time": customer.first_interaction_at.isoformat() if customer.first_interaction_at else None,
-                "last_user_message_time": customer.last_interaction_at.isoformat() if customer.last_interaction_at else None,
-                "first_interaction_at": customer.first_interaction_at.isoformat() if customer.first_interaction_at else None,
-                "source_type": customer.source_type,
-                "from_file_search": True
-            })
-        
-        return {
-            "found_count": len(found_customers),
-            "not_found_count": len(not_found_names),
-            "customers": customers_data,
-            "not_found_names": not_found_names[:10]
-        }
-        
+        return build_search_response(db, request.page_id, request.user_names)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"❌ Error searching customers: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+# API สำหรับค้นหา customers จากไฟล์รายชื่อ (CSV/ข้อความ 1 ชื่อต่อบรรทัด ใช้คอลัมน์แรก) ส่งเป็น body แบบ stream
+@router.post("/search-customers-by-file/upload")
+async def search_customers_by_file_upload(
+    page_id: str,
+    request: Request,
+    db: Session = Depends(get_db)
+):
+    """ค้นหา customers จากไฟล์ที่ upload แบบ stream (อ่านทีละ chunk ไม่ต้องแปลงเป็น JSON ฝั่ง client)"""
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    user_names = []
+    seen = set()
+    pending = ""
+
+    def collect(lines):
+        for row in csv.reader(lines):
+            name = row[0].strip() if row else ""
+            if name and name not in seen:
+                seen.add(name)
+                user_names.append(name)
+
+    async for chunk in request.stream():
+        pending += decoder.decode(chunk)
+        lines = pending.split("\n")
+        pending = lines.pop()
+        collect(lines)
+    pending += decoder.decode(b"", final=True)
+    collect([pending])
+
+    try:
+        return build_search_response(db, page_id, user_names)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"❌ Error searching customers: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
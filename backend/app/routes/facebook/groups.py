@@ -15,8 +15,9 @@ from datetime import datetime
 from pydantic import BaseModel
 import logging
 
-from app.database import crud, models
+from app.database import crud, models, rollups
 from app.database.database import get_db
+from app.utils.keyword_matcher import get_custom_group_matcher, invalidate_custom_groups, invalidate_knowledge
 
 # ==================== Configuration ====================
 router = APIRouter()
@@ -105,14 +106,11 @@ async def get_customer_groups(
         
         groups = query.order_by(models.CustomerTypeCustom.created_at.desc()).all()
         
+        # จำนวนลูกค้าต่อกลุ่ม (current_category_id) จาก rollup ใน query เดียว
+        counts = rollups.get_category_counts(db, page_id)
+        
         result = []
         for group in groups:
-            # นับจำนวนลูกค้าโดยใช้ query แทนการเข้าถึง relationship โดยตรง
-            customer_count = db.query(models.FbCustomer).filter(
-                models.FbCustomer.page_id == page_id,
-                models.FbCustomer.current_category_id == group.id  # ใช้ current_category_id
-            ).count()
-            
             result.append({
                 "id": group.id,
                 "page_id": group.page_id,
@@ -123,7 +121,7 @@ async def get_customer_groups(
                 "is_active": group.is_active,
                 "created_at": group.created_at,
                 "updated_at": group.updated_at,
-                "customer_count": customer_count  # ใช้ค่าที่นับมา
+                "customer_count": counts.get(group.id, 0)
             })
         
         return result
@@ -214,6 +212,7 @@ async def delete_customer_group(
         raise HTTPException(status_code=404, detail="Group not found")
     
     try:
+        page_id = group.page_id
         if hard_delete:
             db.delete(group)
         else:
@@ -221,6 +220,7 @@ async def delete_customer_group(
             group.updated_at = datetime.now()
         
         db.commit()
+        invalidate_custom_groups(page_id)
         
         return {
             "status": "success", 
@@ -246,25 +246,9 @@ async def auto_group_customer(
     if not page:
         raise HTTPException(status_code=404, detail="Page not found")
     
-    # ดึงกลุ่มที่ active ทั้งหมดของเพจ
-    groups = db.query(models.CustomerTypeCustom).filter(
-        models.CustomerTypeCustom.page_id == page.ID,
-        models.CustomerTypeCustom.is_active == True
-    ).all()
-    
-    # ตรวจสอบ keywords
-    detected_group = None
-    message_lower = message_text.lower()
-    
-    for group in groups:
-        if group.keywords:
-            keywords = [k.strip().lower() for k in group.keywords.split(",")]
-            for keyword in keywords:
-                if keyword and keyword in message_lower:
-                    detected_group = group
-                    break
-        if detected_group:
-            break
+    # ตรวจสอบ keywords ของกลุ่มที่ active ทั้งหมดของเพจ (matcher ที่ cache ไว้)
+    group_id = get_custom_group_matcher(db, page.ID).match(message_text)
+    detected_group = crud.get_customer_type_custom_by_id(db, group_id) if group_id else None
     
     if detected_group:
         # อัพเดทกลุ่มของลูกค้า
@@ -412,15 +396,7 @@ async def toggle_page_knowledge_type(
             removed_count = 0
             
             # ลบ schedules ที่ active อยู่
-            if page_id in message_scheduler.active_schedules:
-                schedules_to_remove = []
-                for schedule in message_scheduler.active_schedules[page_id]:
-                    if group_id in schedule.get('groups', []):
-                        schedules_to_remove.append(schedule['id'])
-                
-                for schedule_id in schedules_to_remove:
-                    message_scheduler.remove_schedule(page_id, schedule_id)
-                    removed_count += 1
+            removed_count += len(message_scheduler.remove_schedules_for_group(page_id, group_id))
             
             logger.info(f"Disabled knowledge group {knowledge_id} and deactivated {removed_count} schedules")
         else:
@@ -561,6 +537,7 @@ async def update_customer_type_knowledge(
             
             result = db.execute(query, params)
             db.commit()
+            invalidate_knowledge()
             
             # ดึงข้อมูลที่อัพเดทแล้ว
             updated_row = result.fetchone()
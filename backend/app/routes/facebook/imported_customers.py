@@ -10,6 +10,9 @@ from .auth import get_page_tokens
 from .conversations import get_user_info_from_psid, get_name_from_messages
 from .utils import fix_isoformat, build_historical_customer_data
 from app.utils.redis_helper import get_page_token
+from app.service.customer_backfill import create_backfill_job, job_progress, unfinished_slice_ids
+from app.celery_task.backfill_tasks import backfill_customers_slice_task
+from app import config
 import pytz
 
 router = APIRouter()
@@ -22,6 +25,7 @@ async def sync_imported_customers_by_years(
     page_id: str,
     years: int = Query(..., ge=1, le=10, description="จำนวนปีที่ต้องการดึงข้อมูลย้อนหลัง"),
     compare_to: str = Query("installed_at", regex="^(now|installed_at)$", description="เลือกจุดเปรียบเทียบ: now หรือ installed_at"),
+    parallel: int = Query(1, ge=1, le=config.BACKFILL_MAX_SLICES, description="จำนวนช่วงเวลาที่แบ่งให้ worker ทำพร้อมกัน"),
     db: Session = Depends(get_db)
 ):
 
@@ -91,4 +95,40 @@ async def sync_imported_customers_by_years(
 
     except Exception as e:
         print(f"❌ Error while fetching page token: {e}")
-        access_token = None
\ No newline at end of file
+        access_token = None
+
+    if not access_token:
+        return JSONResponse(
+            status_code=400,
+            content={"error": f"ไม่พบ access_token สำหรับ page_id: {page_id}"}
+        )
+
+    # สร้าง job แล้วให้ Celery ทำงานเบื้องหลัง (แต่ละ slice ทำคู่ขนานกันได้)
+    job_id, slice_ids = create_backfill_job(db, page.ID, start_time, end_time, slices=parallel)
+    for slice_id in slice_ids:
+        backfill_customers_slice_task.delay(slice_id)
+
+    print(f"🚀 เริ่ม backfill job {job_id} ({len(slice_ids)} slices)")
+    return {
+        "status": "started",
+        "job_id": job_id,
+        "slices": len(slice_ids),
+        "start_time": start_time.isoformat(),
+        "end_time": end_time.isoformat()
+    }
+
+# API สำหรับดูความคืบหน้าของการ sync ย้อนหลัง
+@router.get("/sync/facebook/imported_customers/{page_id}/jobs/{job_id}")
+async def get_imported_customers_job(page_id: str, job_id: str, db: Session = Depends(get_db)):
+    progress = job_progress(db, job_id)
+    if not progress:
+        return JSONResponse(status_code=404, content={"error": f"ไม่พบ job {job_id}"})
+    return progress
+
+# API สำหรับสั่งทำต่อ slice ที่ยังไม่เสร็จ (เช่น หลัง worker ถูกปิด)
+@router.post("/sync/facebook/imported_customers/{page_id}/jobs/{job_id}/resume")
+async def resume_imported_customers_job(page_id: str, job_id: str, db: Session = Depends(get_db)):
+    slice_ids = unfinished_slice_ids(db, job_id)
+    for slice_id in slice_ids:
+        backfill_customers_slice_task.delay(slice_id)
+    return {"status": "resumed" if slice_ids else "done", "job_id": job_id, "slices": len(slice_ids)}
@@ -1,7 +1,9 @@
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Iterator, Tuple
 from datetime import datetime, timedelta
 import pytz
 import json
+import csv
+import io
 
 from fastapi import APIRouter, Depends
 from fastapi.responses import JSONResponse
@@ -9,7 +11,9 @@ from sqlalchemy import text
 from sqlalchemy.orm import Session
 
 from app.database.database import get_db
-from app.service.facebook_api import fb_get
+from app.database import models
+from app.service.facebook_api import fb_get, fb_batch_get
+from app.service.graph_client import GRAPH_BATCH_LIMIT
 from .auth import get_page_tokens
 from app.utils.redis_helper import get_page_token
 
@@ -53,69 +57,86 @@ def to_bkk(dt_utc: Optional[datetime]) -> Optional[datetime]:
         dt_utc = pytz.utc.localize(dt_utc)
     return dt_utc.astimezone(bangkok_tz)
 
-def get_recent_conversations(page_id: str, access_token: str, since_iso: str) -> List[Dict[str, Any]]:
+CONVERSATION_FIELDS_PARAMS = {"fields": "participants,updated_time,id", "limit": 100}
+
+def iter_conversation_pages(
+    page_id: str,
+    access_token: str,
+    since_dt: Optional[datetime],
+    after: Optional[str] = None
+) -> Iterator[Tuple[List[Dict[str, Any]], Optional[str]]]:
     """
-    Return list of conversation dicts updated >= since_iso.
-    Uses fb_get and follows basic paging.
+    Yield (conversations updated >= since_dt, cursor for the next page) one Graph page at a time.
+    Conversations come newest-first, so paging stops at the first conversation older than since_dt.
+    The cursor is None on the last page; pass it back as `after` to resume.
     """
     endpoint = f"{page_id}/conversations"
-    params = {
-        "fields": "participants,updated_time,id",
-        "limit": 100
-    }
-
-    try:
-        page = fb_get(endpoint, params, access_token)
-    except Exception as e:
-        print("❌ fb_get failed for conversations:", e)
-        return []
 
-    if not page or "error" in page:
-        print("❌ Error getting conversations:", page.get("error") if page else "no result")
-        return []
-
-    all_convos = []
-    since_dt = parse_fb_time_to_dt(since_iso)
-
-    # iterate pages
     while True:
+        params = {**CONVERSATION_FIELDS_PARAMS, "after": after} if after else CONVERSATION_FIELDS_PARAMS
+        try:
+            page = fb_get(endpoint, params, access_token)
+        except Exception as e:
+            raise RuntimeError(f"fb_get failed for conversations: {e}")
+        if not page or "error" in page:
+            raise RuntimeError(f"Error getting conversations: {page.get('error') if page else 'no result'}")
+
         data = page.get("data", []) if isinstance(page, dict) else []
+        convos = []
+        reached_older = False
         for convo in data:
-            ut = convo.get("updated_time")
-            ut_dt = parse_fb_time_to_dt(ut)
-            if ut_dt and since_dt and ut_dt >= since_dt:
-                all_convos.append(convo)
+            ut_dt = parse_fb_time_to_dt(convo.get("updated_time"))
+            if since_dt and ut_dt and ut_dt < since_dt:
+                reached_older = True
+                break
+            convos.append(convo)
+
         paging = page.get("paging", {}) if isinstance(page, dict) else {}
-        next_url = paging.get("next")
-        if not next_url:
-            break
-        # assume fb_get accepts full next-url
-        page = fb_get(next_url, {}, access_token)
-        if not page or "error" in page:
-            print("❌ Error paging conversations:", page.get("error") if page else "no page")
+        after = (paging.get("cursors") or {}).get("after") if paging.get("next") else None
+        if reached_older or not data:
+            after = None
+
+        yield convos, after
+        if not after:
             break
 
-    print(f"✅ Found {len(all_convos)} conversations updated since {since_iso}")
-    return all_convos
+MESSAGE_FIELDS_PARAMS = {"fields": "created_time,from,message,attachments", "limit": 50}
 
-def fetch_all_messages_for_conversation(convo_id: str, access_token: str, since_dt_utc: Optional[datetime] = None) -> List[Dict[str, Any]]:
+def fetch_first_message_pages(convo_ids: List[str], access_token: str) -> Dict[str, Dict[str, Any]]:
+    """
+    Fetch the first page of messages for many conversations with Graph batch requests
+    (up to 50 conversations per HTTP call). Returns {convo_id: page}.
+    """
+    results = fb_batch_get([(f"{cid}/messages", MESSAGE_FIELDS_PARAMS) for cid in convo_ids], access_token)
+    return dict(zip(convo_ids, results))
+
+def fetch_all_messages_for_conversation(
+    convo_id: str,
+    access_token: str,
+    since_dt_utc: Optional[datetime] = None,
+    first_page: Optional[Dict[str, Any]] = None
+) -> List[Dict[str, Any]]:
     """
     Fetch messages for a conversation (paginate), but try to stop early when pages are older than since_dt_utc.
     - since_dt_utc should be an aware datetime in UTC (or None to fetch all)
+    - first_page: already-fetched first page (from fetch_first_message_pages); only later pages are requested
+    - raises RuntimeError when any page cannot be loaded (including rate-limit errors),
+      so callers never treat a partial result as complete
     """
     messages: List[Dict[str, Any]] = []
     endpoint = f"{convo_id}/messages"
-    params = {"fields": "created_time,from,message,attachments", "limit": 50}
+    params = MESSAGE_FIELDS_PARAMS
 
-    try:
-        page = fb_get(endpoint, params, access_token)
-    except Exception as e:
-        print("❌ fb_get failed for messages:", e)
-        return messages
+    # batch sub-request that failed is retried as a normal single request
+    page = first_page if first_page and "error" not in first_page else None
+    if page is None:
+        try:
+            page = fb_get(endpoint, params, access_token)
+        except Exception as e:
+            raise RuntimeError(f"fb_get failed for messages of {convo_id}: {e}")
 
     if not page or "error" in page:
-        print("❌ Error fetching messages for convo", convo_id, page.get("error") if page else "no result")
-        return messages
+        raise RuntimeError(f"Error fetching messages for convo {convo_id}: {page.get('error') if page else 'no result'}")
 
     while True:
         data = page.get("data", []) if isinstance(page, dict) else []
@@ -153,145 +174,195 @@ def fetch_all_messages_for_conversation(convo_id: str, access_token: str, since_
         try:
             page = fb_get(endpoint, {**params, "after": after}, access_token)
         except Exception as e:
-            print("❌ paging fallback failed:", e)
-            break
+            raise RuntimeError(f"fb_get failed while paging messages of {convo_id}: {e}")
 
         if not page or "error" in page:
-            print("❌ Error paging messages:", page.get("error") if page else "no page")
-            break
+            raise RuntimeError(f"Error paging messages for convo {convo_id}: {page.get('error') if page else 'no page'}")
 
     return messages
 
-def lookup_customer_id(db: Session, page_db_id: int, customer_psid: str) -> Optional[int]:
+MESSAGE_COPY_COLUMNS = ("conversation_id", "sender_id", "sender_name", "message_text", "message_type", "created_at")
+
+def copy_customer_messages(db: Session, page_db_id: int, page_id_str: str, rows: List[tuple]) -> int:
     """
-    Lookup fb_customers.id by (page_id (DB PK), customer_psid).
-    Returns None if not found.
+    Bulk load message rows (in MESSAGE_COPY_COLUMNS order) with COPY into a temp staging table,
+    then merge into customer_messages in one statement:
+    - customer_id resolved with a single join on fb_customers
+    - duplicates (conversation_id, sender_id, created_at) skipped by ON CONFLICT DO NOTHING
+    Returns number of rows actually inserted. Caller commits.
     """
-    sql = text(
-        'SELECT id FROM fb_customers WHERE page_id = :page_db_id AND customer_psid = :psid LIMIT 1'
-    )
-    r = db.execute(sql, {"page_db_id": page_db_id, "psid": customer_psid}).fetchone()
-    return int(r[0]) if r else None
+    if not rows:
+        return 0
+
+    db.execute(text("""
+        CREATE TEMP TABLE IF NOT EXISTS customer_messages_staging (
+            conversation_id TEXT, sender_id TEXT, sender_name TEXT,
+            message_text TEXT, message_type TEXT, created_at TIMESTAMPTZ
+        ) ON COMMIT DELETE ROWS
+    """))
+
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    cursor = db.connection().connection.cursor()
+    try:
+        cursor.copy_expert(
+            # csv เขียน "" เป็นช่องว่างซึ่ง COPY อ่านเป็น NULL จึงบังคับคอลัมน์ข้อความให้เป็น '' (NOT NULL)
+            f"COPY customer_messages_staging ({', '.join(MESSAGE_COPY_COLUMNS)}) FROM STDIN "
+            f"WITH (FORMAT csv, FORCE_NOT_NULL (sender_name, message_text, message_type))",
+            buffer
+        )
+    finally:
+        cursor.close()
+
+    result = db.execute(text("""
+        INSERT INTO customer_messages
+        (customer_id, conversation_id, sender_id, sender_name, message_text, message_type, created_at)
+        SELECT c.id, s.conversation_id, s.sender_id, s.sender_name, s.message_text, s.message_type, s.created_at
+        FROM (
+            SELECT DISTINCT ON (conversation_id, sender_id, created_at) *
+            FROM customer_messages_staging
+            ORDER BY conversation_id, sender_id, created_at
+        ) s
+        LEFT JOIN fb_customers c
+               ON c.page_id = :page_db_id AND c.customer_psid = s.sender_id AND s.sender_id <> :page_id
+        -- insert oldest first so timeline order makes sense
+        ORDER BY s.created_at
+        ON CONFLICT (conversation_id, sender_id, created_at) DO NOTHING
+    """), {"page_db_id": page_db_id, "page_id": page_id_str})
+    return result.rowcount
+
+def get_sync_checkpoint(db: Session, page_db_id: int) -> models.ConversationSyncCheckpoint:
+    checkpoint = db.query(models.ConversationSyncCheckpoint).filter(
+        models.ConversationSyncCheckpoint.page_id == page_db_id
+    ).first()
+    if not checkpoint:
+        checkpoint = models.ConversationSyncCheckpoint(page_id=page_db_id)
+        db.add(checkpoint)
+        db.flush()
+    return checkpoint
 
 def insert_customer_messages_from_conversations(
     db: Session,
     page_id_str: str,
     access_token: str,
     since_iso: str,
-    batch_size: int = 200
+    batch_size: int = 5000
 ) -> Dict[str, int]:
-
+    """
+    Incremental message sync using the page's checkpoint:
+    - only conversations updated since the last completed run are fetched (since_iso is used on the first run)
+    - after every Graph page the messages are committed together with the paging cursor,
+      so an interrupted run resumes from that cursor
+    - a conversation counts toward the high-water mark only after all its messages are loaded;
+      if any fetch fails the run aborts with the checkpoint unchanged, so the next run retries it
+    """
     page_row = db.execute(text('SELECT "ID", page_id FROM facebook_pages WHERE page_id = :pid LIMIT 1'), {"pid": page_id_str}).fetchone()
     if not page_row:
         raise RuntimeError(f"page_id {page_id_str} not found in facebook_pages")
     page_db_id = int(page_row[0])
 
-    convos = get_recent_conversations(page_id_str, access_token, since_iso)
-    if not convos:
-        return {"inserted_messages": 0, "skipped_existing": 0, "conversations": 0}
-
-    # convert once
-    since_dt_utc = parse_fb_time_to_dt(since_iso)
+    checkpoint = get_sync_checkpoint(db, page_db_id)
+    since_dt_utc = checkpoint.last_updated_time or parse_fb_time_to_dt(since_iso)
+    resume_cursor = checkpoint.pending_cursor
+    high_water = checkpoint.pending_updated_time if resume_cursor else None
+    if resume_cursor:
+        print(f"↩️ Resuming message sync for page {page_id_str} from saved cursor")
 
     inserted_messages = 0
     skipped_existing = 0
-    batch_values: List[Dict[str, Any]] = []
-
-    for convo in convos:
-        convo_id = convo.get("id")
-
-        # pass since_dt_utc into fetch_all_messages_for_conversation so it only returns messages >= since_dt_utc
-        msgs = fetch_all_messages_for_conversation(convo_id, access_token, since_dt_utc)
-        if not msgs:
-            continue
-
-        # process chronologically (oldest first) so timeline insert order makes sense
-        msgs_sorted = sorted(msgs, key=lambda m: m.get("created_time") or "")
-
-        for m in msgs_sorted:
-            created_raw = m.get("created_time")
-            created_dt_utc = parse_fb_time_to_dt(created_raw)
-            if not created_dt_utc:
-                continue
-
-            # final safety: skip messages older than since_dt_utc
-            if since_dt_utc and created_dt_utc < since_dt_utc:
-                continue
-
-            created_bkk = to_bkk(created_dt_utc)
-
-            sender = m.get("from") or {}
-            sender_id = sender.get("id")
-            sender_name = sender.get("name") or (f"User...{sender_id[-8:]}" if sender_id else "Unknown")
-
-            message_text = get_message_content(m) or ""
-            # determine message_type: text vs attachment vs unknown
-            if m.get("message"):
-                message_type = "text"
-            elif message_text:
-                message_type = "attachment"
-            else:
-                message_type = "unknown"
-
-            customer_id = None
-            if sender_id and sender_id != page_id_str:
-                customer_id = lookup_customer_id(db, page_db_id, sender_id)
-
-            # dedupe check: conversation_id + sender_id + created_at
-            check_sql = text("""
-                SELECT 1 FROM customer_messages
-                WHERE conversation_id = :convo_id
-                AND sender_id = :sender_id
-                AND created_at = :created_at
-                LIMIT 1
-            """)
-            exists = db.execute(check_sql, {
-                "convo_id": convo_id,
-                "sender_id": sender_id,
-                "created_at": created_bkk
-            }).fetchone()
-            if exists:
-                skipped_existing += 1
-                continue
+    conversations = 0
+    batch_rows: List[tuple] = []
 
-            batch_values.append({
-                "customer_id": customer_id,
-                "conversation_id": convo_id,
-                "sender_id": sender_id,
-                "sender_name": sender_name,
-                "message_text": message_text,
-                "message_type": message_type,
-                "created_at": created_bkk
-            })
-
-            if len(batch_values) >= batch_size:
-                insert_sql = text("""
-                    INSERT INTO customer_messages
-                    (customer_id, conversation_id, sender_id, sender_name, message_text, message_type, created_at)
-                    VALUES
-                    (:customer_id, :conversation_id, :sender_id, :sender_name, :message_text, :message_type, :created_at)
-                """)
-                db.execute(insert_sql, batch_values)
-                db.commit()
-                inserted_messages += len(batch_values)
-                batch_values = []
-
-    # final flush
-    if batch_values:
-        insert_sql = text("""
-            INSERT INTO customer_messages
-            (customer_id, conversation_id, sender_id, sender_name, message_text, message_type, created_at)
-            VALUES
-            (:customer_id, :conversation_id, :sender_id, :sender_name, :message_text, :message_type, :created_at)
-        """)
-        db.execute(insert_sql, batch_values)
+    def flush():
+        nonlocal inserted_messages, skipped_existing, batch_rows
+        inserted = copy_customer_messages(db, page_db_id, page_id_str, batch_rows)
         db.commit()
-        inserted_messages += len(batch_values)
+        inserted_messages += inserted
+        skipped_existing += len(batch_rows) - inserted
+        batch_rows = []
+
+    for convos, next_cursor in iter_conversation_pages(page_id_str, access_token, since_dt_utc, after=resume_cursor):
+        conversations += len(convos)
+
+        # first page of every conversation is fetched with batch requests (50 per call)
+        for index in range(0, len(convos), GRAPH_BATCH_LIMIT):
+            chunk = convos[index:index + GRAPH_BATCH_LIMIT]
+            first_pages = fetch_first_message_pages([c.get("id") for c in chunk], access_token)
+
+            for convo in chunk:
+                convo_id = convo.get("id")
+
+                # pass since_dt_utc into fetch_all_messages_for_conversation so it only returns messages >= since_dt_utc
+                try:
+                    msgs = fetch_all_messages_for_conversation(
+                        convo_id, access_token, since_dt_utc, first_page=first_pages.get(convo_id)
+                    )
+                except RuntimeError:
+                    # keep rows of fully loaded conversations (duplicates are skipped on retry);
+                    # the checkpoint is left as is, so the next run retries this page
+                    flush()
+                    raise
+
+                updated_dt = parse_fb_time_to_dt(convo.get("updated_time"))
+                if updated_dt and (high_water is None or updated_dt > high_water):
+                    high_water = updated_dt
+                if not msgs:
+                    continue
+
+                # process chronologically (oldest first) so timeline insert order makes sense
+                msgs_sorted = sorted(msgs, key=lambda m: m.get("created_time") or "")
+
+                for m in msgs_sorted:
+                    created_dt_utc = parse_fb_time_to_dt(m.get("created_time"))
+                    if not created_dt_utc:
+                        continue
+
+                    # final safety: skip messages older than since_dt_utc
+                    if since_dt_utc and created_dt_utc < since_dt_utc:
+                        continue
+
+                    sender = m.get("from") or {}
+                    sender_id = sender.get("id")
+                    if not sender_id:
+                        continue
+                    sender_name = sender.get("name") or f"User...{sender_id[-8:]}"
+
+                    message_text = get_message_content(m) or ""
+                    # determine message_type: text vs attachment vs unknown
+                    if m.get("message"):
+                        message_type = "text"
+                    elif message_text:
+                        message_type = "attachment"
+                    else:
+                        message_type = "unknown"
+
+                    batch_rows.append((
+                        convo_id, sender_id, sender_name, message_text, message_type,
+                        to_bkk(created_dt_utc).isoformat()
+                    ))
+
+                    if len(batch_rows) >= batch_size:
+                        flush()
+
+        # commit this Graph page together with the cursor of the next one
+        if next_cursor:
+            checkpoint.pending_cursor = next_cursor
+            checkpoint.pending_updated_time = high_water
+        flush()
+
+    # run completed: move the high-water mark forward and clear the resume cursor
+    if high_water and (not checkpoint.last_updated_time or high_water > checkpoint.last_updated_time):
+        checkpoint.last_updated_time = high_water
+    checkpoint.pending_cursor = None
+    checkpoint.pending_updated_time = None
+    checkpoint.last_run_at = datetime.now(pytz.utc)
+    db.commit()
 
     return {
         "inserted_messages": inserted_messages,
         "skipped_existing": skipped_existing,
-        "conversations": len(convos)
+        "conversations": conversations
     }
 
 def get_message_content(message: Dict[str, Any]) -> Optional[str]:
@@ -373,6 +444,7 @@ async def do_sync_messages_for_page(page_id: str, db: Session):
     if not access_token:
         raise ValueError(f"access_token not found for page_id {page_id}")
 
+    # ใช้เฉพาะรอบแรกของเพจ รอบถัดไปเริ่มจาก checkpoint
     now_bkk = datetime.now(bangkok_tz)
     since_dt = now_bkk - timedelta(hours=2)
     since_utc = since_dt.astimezone(pytz.utc)
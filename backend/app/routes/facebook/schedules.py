@@ -40,18 +40,19 @@ async def activate_schedule(request: Request):
     
     # Reset sent tracking สำหรับ schedule นี้
     schedule_id = str(schedule['id'])
-    message_scheduler.sent_tracking[schedule_id] = set()
+    message_scheduler.reset_tracking(page_id, schedule_id)
     
     # ตรวจสอบและแก้ไขข้อมูล schedule
     if 'pageId' not in schedule and page_id:
         schedule['pageId'] = page_id
     
-    # เพิ่ม schedule เข้าระบบ
-    message_scheduler.add_schedule(page_id, schedule)
+    # เพิ่ม schedule เข้าระบบ (immediate ถือ lease ไว้เพื่อส่งเองใน request นี้)
+    is_immediate = schedule.get('type') == 'immediate'
+    stored_schedule = message_scheduler.add_schedule(page_id, schedule, hold_lease=is_immediate)
     
     # ถ้าเป็นแบบส่งทันที ให้ process ทันที
-    if schedule.get('type') == 'immediate':
-        await message_scheduler.process_schedule(page_id, schedule)
+    if is_immediate:
+        await message_scheduler.run_immediate(page_id, stored_schedule)
         return {"status": "success", "message": "Immediate schedule processed"}
     
     # สำหรับ scheduled และ user-inactive จะรอให้ scheduler ทำงานตามเวลา
@@ -114,17 +115,22 @@ async def test_user_inactivity(page_id: str, minutes: int = 1):
     }
     
     # Reset tracking สำหรับการทดสอบ
-    message_scheduler.sent_tracking["999"] = set()
+    message_scheduler.reset_tracking(page_id, "999")
     
     # อัพเดท page tokens ก่อนทดสอบ
     page_tokens = get_page_tokens()
     message_scheduler.set_page_tokens(page_tokens)
     
-    # รันการตรวจสอบ
-    await message_scheduler.check_user_inactivity(page_id, test_schedule)
-    
-    # ดึงผลลัพธ์
-    sent_users = list(message_scheduler.sent_tracking.get("999", set()))
+    # บันทึก schedule ทดสอบชั่วคราว (ถือ lease ไว้ไม่ให้ monitor หยิบไปทำ)
+    stored_schedule = message_scheduler.add_schedule(page_id, test_schedule, hold_lease=True)
+    try:
+        # รันการตรวจสอบ
+        await message_scheduler.check_user_inactivity_v2(page_id, stored_schedule, "TEST")
+        
+        # ดึงผลลัพธ์
+        sent_users = message_scheduler.store.delivered_recipients(stored_schedule['_row_id'])
+    finally:
+        message_scheduler.remove_schedule(page_id, test_schedule["id"])
     
     return {
         "status": "success", 
@@ -134,28 +140,26 @@ async def test_user_inactivity(page_id: str, minutes: int = 1):
     }
 
 # API สำหรับรีเซ็ต tracking ของ schedule
-@router.post("/schedule/reset-tracking/{schedule_id}")
-async def reset_schedule_tracking(schedule_id: str):
+@router.post("/schedule/reset-tracking/{page_id}/{schedule_id}")
+async def reset_schedule_tracking(page_id: str, schedule_id: str):
     """Reset tracking data ของ schedule"""
-    message_scheduler.sent_tracking[schedule_id] = set()
+    message_scheduler.reset_tracking(page_id, schedule_id)
     return {"status": "success", "message": f"Reset tracking for schedule {schedule_id}"}
 
 # API สำหรับดูสถานะของระบบ scheduler
 @router.get("/schedule/system-status")
 async def get_system_status():
     """ดูสถานะของระบบ scheduler"""
+    active_schedules = message_scheduler.get_all_active_schedules()
     return {
         "is_running": message_scheduler.is_running,
-        "active_pages": list(message_scheduler.active_schedules.keys()),
-        "total_schedules": sum(len(schedules) for schedules in message_scheduler.active_schedules.values()),
+        "active_pages": list(active_schedules.keys()),
+        "total_schedules": sum(len(schedules) for schedules in active_schedules.values()),
         "schedules_by_page": {
             page_id: len(schedules) 
-            for page_id, schedules in message_scheduler.active_schedules.items()
+            for page_id, schedules in active_schedules.items()
         },
-        "tracking_info": {
-            schedule_id: len(users) 
-            for schedule_id, users in message_scheduler.sent_tracking.items()
-        }
+        "tracking_info": message_scheduler.store.tracking_counts()
     }
 
 # API สำหรับอัพเดทข้อมูลระยะเวลาที่หายไปของ users
@@ -344,15 +348,9 @@ async def deactivate_knowledge_group_schedules(request: Request):
         # สร้าง group_id ในรูปแบบที่ scheduler ใช้
         group_id = f"knowledge_{knowledge_id}"
         
-        # หา schedules ทั้งหมดที่เกี่ยวข้องกับ group นี้
-        schedules_to_remove = []
-        for schedule_id, schedule in message_scheduler.active_schedules.get(page_id, {}).items():
-            if group_id in schedule.get('groups', []):
-                schedules_to_remove.append(schedule_id)
-        
-        # ลบ schedules ออกจาก active schedules
+        # หาและลบ schedules ทั้งหมดที่เกี่ยวข้องกับ group นี้
+        schedules_to_remove = message_scheduler.remove_schedules_for_group(page_id, group_id)
         for schedule_id in schedules_to_remove:
-            message_scheduler.remove_schedule(page_id, schedule_id)
             logger.info(f"Deactivated schedule {schedule_id} for knowledge group {knowledge_id}")
         
         return {
@@ -1,108 +1,62 @@
 # backend/app/routes/facebook/sse.py
-from fastapi import APIRouter, Request, Depends
+from fastapi import APIRouter, Request, Header, Query
 from fastapi.responses import StreamingResponse
-from sqlalchemy.orm import Session
-from app.database.database import get_db
-from app.database import crud
+from app import config
+from app.service.sse_hub import sse_hub, publish_customer_type_update, read_since, stream_id_key, RESYNC
 import asyncio
 import json
 from datetime import datetime
-from typing import AsyncGenerator
+from typing import AsyncGenerator, Optional
 import logging
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
-# Store active connections
-active_connections = {}
+def format_event(event_id: str, payload: str) -> str:
+    return f"id: {event_id}\ndata: {payload}\n\n"
 
-# เพิ่ม queue สำหรับ customer type updates
-customer_type_update_queue = asyncio.Queue()
+def resync_frame() -> str:
+    return f"data: {json.dumps({'type': 'resync', 'timestamp': datetime.now().isoformat()})}\n\n"
+
+async def event_generator(page_id: str, request: Request, last_event_id: Optional[str] = None) -> AsyncGenerator:
+    """Generate SSE events for real-time updates (รับ event จาก sse_hub ไม่ต้อง poll DB)"""
+    # subscribe ก่อนอ่านย้อนหลัง เพื่อไม่ให้ event ที่เข้ามาระหว่างนั้นหลุด
+    queue = sse_hub.subscribe(page_id)
+    logger.info(f"SSE connection opened for page {page_id} ({sse_hub.subscriber_count(page_id)} clients)")
+    last_sent = None
 
-async def event_generator(page_id: str, db: Session) -> AsyncGenerator:
-    """Generate SSE events for real-time updates"""
-    client_id = f"{page_id}_{datetime.now().timestamp()}"
-    active_connections[client_id] = True
-    
     try:
-        last_check = datetime.now()
-        
-        while active_connections.get(client_id, False):
+        # ✅ ส่ง event ที่ client พลาดไประหว่างหลุดการเชื่อมต่อ
+        if last_event_id:
+            missed, complete = await asyncio.to_thread(read_since, page_id, last_event_id)
+            if not complete:
+                yield resync_frame()
+                logger.info(f"SSE replay gap for page {page_id} after {last_event_id}, asked client to resync")
+            for event_id, payload in missed:
+                yield format_event(event_id, payload)
+                last_sent = stream_id_key(event_id)
+            if missed:
+                logger.info(f"Replayed {len(missed)} SSE events for page {page_id}")
+
+        while not await request.is_disconnected():
             try:
-                try:
-                    # ✅ ตรวจสอบ queue updates ตาม page_id
-                    try:
-                        update = await asyncio.wait_for(
-                            customer_type_update_queue.get(), 
-                            timeout=1.0
-                        )
-                        
-                        # ✅ ส่งเฉพาะข้อมูลที่ตรงกับ page_id
-                        if update.get('page_id') == page_id:
-                            yield f"data: {json.dumps({'type': 'customer_type_update', 'data': [update]})}\n\n"
-                            logger.info(f"Sent customer type update for {update['psid']} on page {page_id}")
-                            
-                    except asyncio.TimeoutError:
-                        pass
-                    
-                    # Check for new/updated customers
-                    page = crud.get_page_by_page_id(db, page_id)
-                    if page:
-                        customers = crud.get_customers_updated_after(
-                            db, page.ID, last_check
-                        )
-                        
-                        if customers:
-                            updates = []
-                            for customer in customers:
-                                knowledge_name = None
-                                if customer.current_category:
-                                    knowledge_name = customer.current_category.type_name
-                                
-                                update_data = {
-                                    'id': customer.id,
-                                    'psid': customer.customer_psid,
-                                    'name': customer.name or f"User...{customer.customer_psid[-8:]}",
-                                    'first_interaction': customer.first_interaction_at.isoformat() if customer.first_interaction_at else None,
-                                    'last_interaction': customer.last_interaction_at.isoformat() if customer.last_interaction_at else None,
-                                    'source_type': customer.source_type,
-                                    'current_category_id': customer.current_category_id,
-                                    'current_category_name': knowledge_name,
-                                    'mining_status': customer.mining_statuses[0].status if customer.mining_statuses else 'ยังไม่ขุด',
-                                    'action': 'update'
-                                }
-                                updates.append(update_data)
-                            
-                            yield f"data: {json.dumps({'type': 'customer_update', 'data': updates})}\n\n"
-                            last_check = datetime.now()
-                    
-                    db.commit()
-                    
-                except Exception as e:
-                    db.rollback()
-                    logger.error(f"Database error in SSE for page {page_id}: {e}")
-                
+                event = await asyncio.wait_for(queue.get(), timeout=config.SSE_HEARTBEAT_SECONDS)
+                if event == RESYNC:
+                    # คิวล้นจนมี event หาย
+                    yield resync_frame()
+                    continue
+                event_id, payload = event
+                # ข้าม event ที่ส่งไปแล้วตอน replay
+                if last_sent and stream_id_key(event_id) <= last_sent:
+                    continue
+                yield format_event(event_id, payload)
+            except asyncio.TimeoutError:
                 # Send heartbeat
                 yield f"data: {json.dumps({'type': 'heartbeat', 'timestamp': datetime.now().isoformat()})}\n\n"
-                
-                await asyncio.sleep(5)
-                
-            except Exception as e:
-                logger.error(f"Error in SSE generator for page {page_id}: {e}")
-                try:
-                    db.rollback()
-                except:
-                    pass
-                yield f"data: {json.dumps({'type': 'error', 'message': 'Connection error'})}\n\n"
-                await asyncio.sleep(5)
-                
+
     finally:
-        active_connections.pop(client_id, None)
-        logger.info(f"SSE connection closed for {client_id}")
-        try:
-            db.rollback()
-        except:
-            pass
+        sse_hub.unsubscribe(page_id, queue)
+        logger.info(f"SSE connection closed for page {page_id}")
 
 # Helper function สำหรับส่ง customer type update
 async def send_customer_type_update(page_id: str, psid: str, customer_type_name: str = None, customer_type_custom_id: int = None, customer_type_knowledge_name: str = None, customer_type_knowledge_id: int = None):
@@ -112,47 +66,41 @@ async def send_customer_type_update(page_id: str, psid: str, customer_type_name:
         'psid': psid,
         'timestamp': datetime.now().isoformat()
     }
-    
+
     # เพิ่มข้อมูล User Group ถ้ามี
     if customer_type_name is not None:
         update['customer_type_name'] = customer_type_name
     if customer_type_custom_id is not None:
         update['customer_type_custom_id'] = customer_type_custom_id
-    
+
     # เพิ่มข้อมูล Knowledge Group ถ้ามี
     if customer_type_knowledge_name is not None:
         update['customer_type_knowledge_name'] = customer_type_knowledge_name
     if customer_type_knowledge_id is not None:
         update['customer_type_knowledge_id'] = customer_type_knowledge_id
-    
-    await customer_type_update_queue.put(update)
-    logger.info(f"Queued customer type update for {psid}")
+
+    publish_customer_type_update(update)
+    logger.info(f"Published customer type update for {psid}")
 
 @router.get("/sse/customers/{page_id}")
 async def customer_updates_stream(
     page_id: str,
     request: Request,
-    db: Session = Depends(get_db)
+    last_event_id_header: Optional[str] = Header(None, alias="Last-Event-ID"),
+    last_event_id: Optional[str] = Query(None)
 ):
-    """SSE endpoint for real-time customer updates"""
-    
-    # สร้าง generator function ใหม่ที่จัดการ db session อย่างถูกต้อง
+    """
+    SSE endpoint for real-time customer updates
+    - ส่ง Last-Event-ID (header) หรือ ?last_event_id= เพื่อรับเฉพาะ event ที่พลาดไป
+    """
+
     async def safe_event_stream():
         try:
-            async for event in event_generator(page_id, db):
-                if await request.is_disconnected():
-                    break
+            async for event in event_generator(page_id, request, last_event_id_header or last_event_id):
                 yield event
         except Exception as e:
             logger.error(f"SSE stream error: {e}")
-        finally:
-            # ทำ cleanup
-            try:
-                db.rollback()
-                db.close()
-            except:
-                pass
-    
+
     return StreamingResponse(
         safe_event_stream(),
         media_type="text/event-stream",
@@ -161,4 +109,4 @@ async def customer_updates_stream(
             "Connection": "keep-alive",
             "X-Accel-Buffering": "no"
         }
-    )
\ No newline at end of file
+    )
@@ -7,9 +7,9 @@ API นี้คือ จุดศูนย์กลาง สำหรับ f
 - การแบ่งกลุ่มลูกค้าตาม type/knowledge
 
 """
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Query
 from sqlalchemy.orm import Session
-from app.database import crud
+from app.database import crud, rollups
 from app.database.database import get_db
 from datetime import datetime
 from fastapi.responses import JSONResponse
@@ -35,4 +35,25 @@ async def get_customer_statistics(page_id: str, db: Session = Depends(get_db)):
         "page_name": page.page_name,
         "statistics": stats,
         "generated_at": datetime.now().isoformat()
-    }
\ No newline at end of file
+    }
+
+@router.get("/customer-statistics/{page_id}/daily")
+async def get_customer_daily_statistics(
+    page_id: str,
+    days: int = Query(30, ge=1, le=365),
+    db: Session = Depends(get_db)
+):
+    """จำนวนลูกค้าใหม่ / ลูกค้าที่คุยล่าสุดรายวัน (จาก rollup)"""
+    page = crud.get_page_ref(db, page_id)
+    if not page:
+        return JSONResponse(
+            status_code=404,
+            content={"error": f"ไม่พบเพจ {page_id} ในระบบ"}
+        )
+    
+    return {
+        "page_id": page_id,
+        "page_name": page.page_name,
+        "days": rollups.get_daily_activity(db, page.ID, days),
+        "generated_at": datetime.now().isoformat()
+    }
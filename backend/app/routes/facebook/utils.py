@@ -93,10 +93,12 @@ def parse_iso_datetime(date_str: str) -> Optional[datetime]:
 
 # API สำหรับสร้างข้อมูลลูกค้า
 def build_customer_data(participant_id, user_name, first_msg_time, last_msg_time, 
-                       updated_time, installed_at, page_id, access_token, convo_id) -> Optional[dict]:
+                       updated_time, installed_at, page_id, access_token, convo_id,
+                       resolve_name: bool = True) -> Optional[dict]:
     """
     สร้างข้อมูลลูกค้าพร้อมกำหนด source_type
     ✅ ไม่กรอง user เก่าออก - เก็บทุกคน
+    resolve_name=False เมื่อผู้เรียกหาชื่อมาแล้วด้วย batch (resolve_participant_names)
     """
     first_interaction = parse_iso_datetime(first_msg_time) if first_msg_time else None
     last_interaction = parse_iso_datetime(last_msg_time) if last_msg_time else None
@@ -111,12 +113,15 @@ def build_customer_data(participant_id, user_name, first_msg_time, last_msg_time
     # ถ้าต้องการกรองให้ทำที่ frontend แทน
 
     # ดึงชื่อ User
-    if not user_name:
-        user_info = get_user_info_from_psid(participant_id, access_token)
-        user_name = user_info.get("name")
+    if not resolve_name:
+        user_name = user_name or f"User...{participant_id[-8:]}"
+    else:
+        if not user_name:
+            user_info = get_user_info_from_psid(participant_id, access_token)
+            user_name = user_info.get("name")
 
-    if not user_name or user_name.startswith("User"):
-        user_name = get_name_from_messages(convo_id, access_token, page_id) or f"User...{participant_id[-8:]}"
+        if not user_name or user_name.startswith("User"):
+            user_name = get_name_from_messages(convo_id, access_token, page_id) or f"User...{participant_id[-8:]}"
 
     # ✅ แก้ไข: ตรวจสอบ timezone ให้ชัดเจน
     if installed_at.tzinfo is None:
@@ -146,7 +151,8 @@ def build_historical_customer_data(
     installed_at: datetime,
     page_id: str,
     access_token: str,
-    convo_id: str
+    convo_id: str,
+    resolve_name: bool = True
 ) -> Optional[dict]:
     """
     สร้างข้อมูลลูกค้าที่มาจากการ sync ย้อนหลัง
@@ -164,12 +170,15 @@ def build_historical_customer_data(
         last_interaction = first_interaction
 
     # ดึงชื่อ ถ้ายังไม่มี
-    if not user_name:
-        user_info = get_user_info_from_psid(participant_id, access_token)
-        user_name = user_info.get("name")
-
-    if not user_name or user_name.startswith("User"):
-        user_name = get_name_from_messages(convo_id, access_token, page_id) or f"User...{participant_id[-8:]}"
+    if not resolve_name:
+        user_name = user_name or f"User...{participant_id[-8:]}"
+    else:
+        if not user_name:
+            user_info = get_user_info_from_psid(participant_id, access_token)
+            user_name = user_info.get("name")
+
+        if not user_name or user_name.startswith("User"):
+            user_name = get_name_from_messages(convo_id, access_token, page_id) or f"User...{participant_id[-8:]}"
     
     # ✅ กำหนด source_type ตามเวลาติดตั้งเว็บ
     # สำหรับการ sync ย้อนหลัง ถ้า first_interaction < installed_at = imported
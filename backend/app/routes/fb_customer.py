@@ -1,11 +1,16 @@
 # backend/app/routes/fb_customer.py
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session, joinedload
-from typing import List, Dict, Any, Optional
-from sqlalchemy import or_, and_
-from app.database.models import FbCustomer, FacebookPage, FBCustomerCustomClassification
-from app.database.database import get_db
+from typing import List, Dict, Any, Optional, Tuple
+from sqlalchemy import text
+from app import config
+from app.database import crud
+from app.database.models import FbCustomer, FacebookPage
+from app.database.database import get_db, SessionLocal
 from app.database.schemas import FbCustomerSchema
+import base64
+import json
 import logging
 from datetime import datetime
 
@@ -13,73 +18,86 @@ router = APIRouter()
 logger = logging.getLogger(__name__)
 
 # =============== Helper Functions ===============
-def get_customer_data(customer: FbCustomer) -> dict:
-    """Format customer data for response"""
-    # Get latest custom classification
-    latest_custom = None
-    if customer.custom_classifications:
-        latest_custom = max(
-            customer.custom_classifications,
-            key=lambda x: x.classified_at,
-            default=None
-        )
-    
-    # Get latest mining status
-    mining_status = "ยังไม่ขุด"
-    mining_updated_at = None
-    
-    if customer.mining_statuses:
-        latest_mining = max(
-            customer.mining_statuses,
-            key=lambda x: x.created_at,
-            default=None
-        )
-        if latest_mining:
-            mining_status = latest_mining.status
-            mining_updated_at = latest_mining.created_at.isoformat()
-    
+# เลือกเฉพาะคอลัมน์ที่ dashboard ใช้ จำนวน classification มาจาก subquery สถานะการขุดจาก fb_customer_mining_current
+# เรียงด้วย (last_interaction_at, id) ใช้เป็น keyset cursor
+_CUSTOMER_LIST_SQL = """
+    SELECT c.id, c.page_id, c.customer_psid, c.name, c.first_interaction_at, c.last_interaction_at,
+           c.created_at, c.updated_at, c.source_type, c.current_category_id,
+           k.type_name AS current_category_name,
+           cc.new_category_id AS custom_category_id, ctc.type_name AS custom_category_name,
+           COALESCE(cls.total, 0) AS classifications_count,
+           COALESCE(cc.total, 0) AS custom_classifications_count,
+           ms.status AS mining_status, ms.updated_at AS mining_status_updated_at
+    FROM fb_customers c
+    LEFT JOIN customer_type_knowledge k ON k.id = c.current_category_id
+    LEFT JOIN LATERAL (
+        SELECT count(*) AS total
+        FROM fb_customer_classifications
+        WHERE page_id = c.page_id AND customer_id = c.id
+    ) cls ON TRUE
+    LEFT JOIN LATERAL (
+        SELECT new_category_id, count(*) OVER () AS total
+        FROM fb_customer_custom_classifications
+        WHERE customer_id = c.id
+        ORDER BY classified_at DESC
+        LIMIT 1
+    ) cc ON TRUE
+    LEFT JOIN customer_type_custom ctc ON ctc.id = cc.new_category_id
+    LEFT JOIN fb_customer_mining_current ms ON ms.customer_id = c.id
+    WHERE c.page_id = :page_db_id
+      AND c.first_interaction_at IS NOT NULL
+      AND c.last_interaction_at IS NOT NULL
+      AND (c.source_type = 'new' OR (c.source_type = 'imported' AND c.last_interaction_at > :install_date))
+      {keyset}
+    ORDER BY c.last_interaction_at DESC, c.id DESC
+    LIMIT :limit
+"""
+
+def encode_cursor(last_interaction_at: datetime, customer_id: int) -> str:
+    raw = json.dumps([last_interaction_at.isoformat(), customer_id])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        last_interaction_at, customer_id = json.loads(raw)
+        return datetime.fromisoformat(last_interaction_at), int(customer_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def get_customer_data(row) -> dict:
+    """Format projected customer row for response"""
     return {
-        "id": customer.id,
-        "page_id": customer.page_id,
-        "customer_psid": customer.customer_psid,
-        "name": customer.name,
-        "first_interaction_at": customer.first_interaction_at.isoformat() if customer.first_interaction_at else None,
-        "last_interaction_at": customer.last_interaction_at.isoformat() if customer.last_interaction_at else None,
-        "created_at": customer.created_at.isoformat() if customer.created_at else None,
-        "updated_at": customer.updated_at.isoformat() if customer.updated_at else None,
-        "source_type": customer.source_type,
-        
-        # Knowledge Category
-        "current_category_id": customer.current_category_id,
-        "current_category_name": customer.current_category.type_name if customer.current_category else None,
-        
-        # Custom Category
-        "custom_category_id": latest_custom.new_category_id if latest_custom else None,
-        "custom_category_name": (
-            latest_custom.new_category.type_name 
-            if latest_custom and latest_custom.new_category 
-            else None
-        ),
-        
-        # Classifications count
-        "classifications_count": len(customer.classifications),
-        "custom_classifications_count": len(customer.custom_classifications),
-        
-        # Mining status
-        "mining_status": mining_status,
-        "mining_status_updated_at": mining_updated_at
+        "id": row.id,
+        "page_id": row.page_id,
+        "customer_psid": row.customer_psid,
+        "name": row.name,
+        "first_interaction_at": row.first_interaction_at.isoformat() if row.first_interaction_at else None,
+        "last_interaction_at": row.last_interaction_at.isoformat() if row.last_interaction_at else None,
+        "created_at": row.created_at.isoformat() if row.created_at else None,
+        "updated_at": row.updated_at.isoformat() if row.updated_at else None,
+        "source_type": row.source_type,
+        "current_category_id": row.current_category_id,
+        "current_category_name": row.current_category_name,
+        "custom_category_id": row.custom_category_id,
+        "custom_category_name": row.custom_category_name,
+        "classifications_count": row.classifications_count,
+        "custom_classifications_count": row.custom_classifications_count,
+        "mining_status": row.mining_status or "ยังไม่ขุด",
+        "mining_status_updated_at": row.mining_status_updated_at.isoformat() if row.mining_status_updated_at else None
     }
 
-def build_customer_query(db: Session, page_id: int):
-    """Build optimized query with eager loading"""
-    return db.query(FbCustomer).options(
-        joinedload(FbCustomer.current_category),
-        joinedload(FbCustomer.classifications),
-        joinedload(FbCustomer.custom_classifications).joinedload(
-            FBCustomerCustomClassification.new_category
-        ),
-        joinedload(FbCustomer.mining_statuses)
-    ).filter(FbCustomer.page_id == page_id)
+def fetch_customer_page(db: Session, page, limit: int, cursor: Optional[str] = None) -> Tuple[List[dict], Optional[str]]:
+    """ดึงลูกค้า 1 หน้า (keyset) คืน (items, cursor ของหน้าถัดไป)"""
+    params = {"page_db_id": page.ID, "install_date": page.created_at, "limit": limit}
+    keyset = ""
+    if cursor:
+        params["cursor_at"], params["cursor_id"] = decode_cursor(cursor)
+        keyset = "AND (c.last_interaction_at, c.id) < (:cursor_at, :cursor_id)"
+
+    rows = db.execute(text(_CUSTOMER_LIST_SQL.format(keyset=keyset)), params).fetchall()
+    next_cursor = encode_cursor(rows[-1].last_interaction_at, rows[-1].id) if len(rows) == limit else None
+    return [get_customer_data(row) for row in rows], next_cursor
 
 # =============== API Endpoints ===============
 @router.get("/fb-customers", response_model=List[FbCustomerSchema])
@@ -95,36 +113,47 @@ def get_customer_by_id(customer_id: int, db: Session = Depends(get_db)):
         raise HTTPException(status_code=404, detail="Customer not found")
     return customer
 
+@router.get("/fb-customers/page/{page_id}")
+def get_customers_page(
+    page_id: str,
+    limit: int = Query(config.CUSTOMER_PAGE_SIZE, ge=1, le=config.CUSTOMER_PAGE_MAX_SIZE),
+    cursor: Optional[str] = None,
+    db: Session = Depends(get_db)
+):
+    """Get customers by Facebook page, keyset-paginated (ส่ง next_cursor กลับมาเพื่อดึงหน้าถัดไป)"""
+    page = crud.get_page_ref(db, page_id)
+    if not page:
+        raise HTTPException(status_code=404, detail=f"Page not found: {page_id}")
+
+    items, next_cursor = fetch_customer_page(db, page, limit, cursor)
+    return {"items": items, "next_cursor": next_cursor}
+
 @router.get("/fb-customers/by-page/{page_id}")
 def get_customers_by_page(page_id: str, db: Session = Depends(get_db)):
-    """Get customers by Facebook page with optimized query"""
-    # Get page
-    page = db.query(FacebookPage).filter(FacebookPage.page_id == page_id).first()
+    """Get customers by Facebook page (ทั้งหมด) - stream JSON array ทีละหน้า ไม่โหลดทั้งเพจเข้า memory"""
+    page = crud.get_page_ref(db, page_id)
     if not page:
         raise HTTPException(status_code=404, detail=f"Page not found: {page_id}")
 
-    install_date = page.created_at
-
-    # Build optimized query with eager loading
-    customers_query = build_customer_query(db, page.ID)
-    
-    # Apply filters
-    customers = customers_query.filter(
-        and_(
-            FbCustomer.first_interaction_at.isnot(None),
-            FbCustomer.last_interaction_at.isnot(None),
-            or_(
-                FbCustomer.source_type == 'new',
-                and_(
-                    FbCustomer.source_type == 'imported',
-                    FbCustomer.last_interaction_at > install_date
-                )
-            )
-        )
-    ).order_by(FbCustomer.last_interaction_at.desc()).all()
-
-    # Format response using helper function
-    return [get_customer_data(customer) for customer in customers]
+    def stream_customers():
+        # session แยกเพราะ session ของ dependency ถูกปิดก่อน stream จบ
+        stream_db = SessionLocal()
+        try:
+            yield "["
+            cursor = None
+            first = True
+            while True:
+                items, cursor = fetch_customer_page(stream_db, page, config.CUSTOMER_PAGE_MAX_SIZE, cursor)
+                for item in items:
+                    yield ("" if first else ",") + json.dumps(item, ensure_ascii=False)
+                    first = False
+                if not cursor:
+                    break
+            yield "]"
+        finally:
+            stream_db.close()
+
+    return StreamingResponse(stream_customers(), media_type="application/json")
 
 @router.get("/debug/customer-types/{page_id}")
 def debug_customer_types(page_id: str, db: Session = Depends(get_db)):
@@ -5,13 +5,12 @@ Mining Status Management API
 
 from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.orm import Session
-from sqlalchemy import text
 from datetime import datetime
-from typing import List, Optional, Dict, Any
+from typing import List, Optional
 from pydantic import BaseModel
 
 from app.database.database import get_db
-from app.database import models, crud
+from app.database import crud
 from app.celery_task.mining_tasks import (
     update_mining_status_task,
     reset_mining_status_task,
@@ -34,54 +33,6 @@ class MiningStatusResponse(BaseModel):
     note: Optional[str]
     created_at: datetime
 
-# =============== Helper Functions ===============
-def update_customer_mining_status(
-    db: Session,
-    customer: models.FbCustomer,
-    status: str,
-    note: Optional[str] = None
-) -> models.FBCustomerMiningStatus:
-    """Update mining status for a customer"""
-    # Delete old status records
-    db.query(models.FBCustomerMiningStatus).filter(
-        models.FBCustomerMiningStatus.customer_id == customer.id
-    ).delete()
-    
-    # Create new status
-    new_status = models.FBCustomerMiningStatus(
-        customer_id=customer.id,
-        status=status,
-        note=note or f"Updated at {datetime.now()}"
-    )
-    db.add(new_status)
-    return new_status
-
-def get_page_mining_statuses(db: Session, page_id: int) -> Dict[str, Dict[str, Any]]:
-    """Get mining statuses for all customers in a page"""
-    query = """
-        SELECT 
-            c.customer_psid,
-            ms.status,
-            ms.note,
-            ms.created_at
-        FROM fb_customers c
-        LEFT JOIN fb_customer_mining_status ms ON c.id = ms.customer_id
-        WHERE c.page_id = :page_id
-        ORDER BY c.customer_psid
-    """
-    
-    result = db.execute(text(query), {"page_id": page_id})
-    
-    statuses = {}
-    for row in result:
-        statuses[row[0]] = {
-            "status": row[1] or "ยังไม่ขุด",
-            "note": row[2],
-            "created_at": row[3]
-        }
-    
-    return statuses
-
 # =============== API Endpoints ===============
 @router.post("/mining-status/update/{page_id}")
 async def update_mining_status(
@@ -116,11 +67,11 @@ async def get_mining_statuses(
 ):
     """Get current mining statuses for all customers in a page"""
     try:
-        page = crud.get_page_by_page_id(db, page_id)
+        page = crud.get_page_ref(db, page_id)
         if not page:
             raise HTTPException(status_code=404, detail="Page not found")
         
-        statuses = get_page_mining_statuses(db, page.ID)
+        statuses = crud.get_page_mining_statuses(db, page.ID)
         
         return {
             "success": True,
@@ -1,15 +1,15 @@
-from fastapi import APIRouter, Request, Depends, BackgroundTasks
+from fastapi import APIRouter, Request, BackgroundTasks
 from fastapi.responses import PlainTextResponse
 from app.database import crud, models
-from app.database.database import get_db
 from sqlalchemy.orm import Session
 from datetime import datetime
 import os
-from app.service.facebook_api import fb_get
+from app.service.facebook_api import async_fb_get
 import logging
 import asyncio
 from typing import Dict, List, Optional, Any
-from app.celery_task.webhook_task import sync_new_user_data_task
+import redis
+from app.service.webhook_ingest import enqueue_webhook
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
@@ -65,7 +65,7 @@ async def sync_new_user_data(
         
         # Fetch user profile
         user_fields = "id,name,first_name,last_name,profile_pic,gender,locale,timezone"
-        user_info = fb_get(sender_id, {"fields": user_fields}, access_token)
+        user_info = await async_fb_get(sender_id, {"fields": user_fields}, access_token)
         
         # Get user name
         user_name = user_info.get("name", "")
@@ -80,7 +80,7 @@ async def sync_new_user_data(
             "limit": 1
         }
         
-        conversations = fb_get(endpoint, params, access_token)
+        conversations = await async_fb_get(endpoint, params, access_token)
         
         # Determine interaction times
         first_interaction = datetime.now()
@@ -158,7 +158,7 @@ async def send_sse_update(
 ):
     """Send SSE update for customer changes"""
     try:
-        from app.routes.facebook.sse import customer_type_update_queue
+        from app.service.sse_hub import publish_customer_type_update
         
         update_data = {
             'page_id': page_id,
@@ -171,7 +171,7 @@ async def send_sse_update(
             'timestamp': datetime.now().isoformat()
         }
         
-        await customer_type_update_queue.put(update_data)
+        publish_customer_type_update(update_data)
         logger.info(f"📡 Sent SSE update for {action}: {sender_id}")
         
     except Exception as e:
@@ -188,37 +188,19 @@ async def verify_webhook(request: Request):
     return PlainTextResponse(content="Verification failed", status_code=403)
 
 @router.post("/webhook")
-async def webhook_post(request: Request, db: Session = Depends(get_db)):
+async def webhook_post(request: Request):
+    """
+    รับ event จาก Facebook แล้วใส่ queue ทันที
+    การอัพเดท DB และ sync user ใหม่ทำใน webhook_ingestor เป็น batch
+    """
     body = await request.json()
 
-    for entry in body.get("entry", []):
-        page_id = entry.get("id")
-        if not page_id:
-            continue
-
-        page = crud.get_page_by_page_id(db, page_id)
-        if not page:
-            continue
-
-        for msg_event in entry.get("messaging", []):
-            sender_id = msg_event["sender"]["id"]
-            if sender_id == page_id:
-                continue
-
-            try:
-                existing_customer = crud.get_customer_by_psid(db, page.ID, sender_id)
-
-                if not existing_customer:
-                    # ✅ ใช้ Celery แทน BackgroundTasks
-                    logger.info(f"🆕 New user detected: {sender_id} in page {page.page_name}")
-                    sync_new_user_data_task.delay(page_id, sender_id, page.ID)
-
-                else:
-                    crud.update_customer_interaction(db, page.ID, sender_id)
-                    logger.info(f"📝 Updated interaction for: {existing_customer.name}")
-
-            except Exception as e:
-                logger.error(f"Error processing webhook: {e}")
+    try:
+        enqueue_webhook(body)
+    except redis.RedisError as e:
+        # ตอบ error เพื่อให้ Facebook ส่ง event ซ้ำภายหลัง
+        logger.error(f"Error queueing webhook event: {e}")
+        return PlainTextResponse("QUEUE_UNAVAILABLE", status_code=503)
 
     return PlainTextResponse("EVENT_RECEIVED", status_code=200)
 
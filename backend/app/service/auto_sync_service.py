@@ -4,7 +4,7 @@ import logging
 from typing import Dict, List, Set, Optional
 from app.database import crud, models
 from app.database.database import SessionLocal
-from app.service.facebook_api import fb_get
+from app.service.facebook_api import async_fb_get, async_fb_batch_get
 import pytz
 
 logger = logging.getLogger(__name__)
@@ -24,6 +24,9 @@ class AutoSyncService:
         self.user_last_interaction_cache: Dict[str, datetime] = {}
         self.update_queue: List[Dict] = []
         self.queue_lock = asyncio.Lock()
+        # ผลลัพธ์ที่ดึงล่วงหน้าด้วย batch request (ใช้แล้วลบทิ้ง)
+        self.prefetched_user_info: Dict[str, tuple] = {}
+        self.prefetched_first_messages: Dict[tuple, Optional[datetime]] = {}
         
     def set_page_tokens(self, tokens: Dict[str, str]):
         """อัพเดท page tokens"""
@@ -157,7 +160,7 @@ class AutoSyncService:
         """Sync conversations ของเพจเดียว"""
         db = SessionLocal()
         try:
-            page = crud.get_page_by_page_id(db, page_id)
+            page = crud.get_page_ref(db, page_id)
             if not page:
                 return
             
@@ -178,13 +181,24 @@ class AutoSyncService:
             if not conversations:
                 return
             
+            # ดึงข้อมูล user ใหม่ล่วงหน้าด้วย batch request
+            prefetched_keys = await self._prefetch_new_customer_info(
+                conversations, page, page_id, access_token, db
+            )
+            
             # Process แต่ละ conversation
             stats = {'new': 0, 'updated': 0, 'status_updated': 0}
             
-            for convo in conversations:
-                await self._process_conversation(
-                    convo, page, page_id, access_token, installed_at, db, stats
-                )
+            try:
+                for convo in conversations:
+                    await self._process_conversation(
+                        convo, page, page_id, access_token, installed_at, db, stats
+                    )
+            finally:
+                # ลบข้อมูลที่ดึงล่วงหน้าแต่ไม่ได้ใช้ (เช่นข้อความไม่ใช่ข้อความใหม่)
+                for psid, convo_id in prefetched_keys:
+                    self.prefetched_user_info.pop(psid, None)
+                    self.prefetched_first_messages.pop((convo_id, psid), None)
             
             self._log_sync_summary(stats)
                     
@@ -213,7 +227,7 @@ class AutoSyncService:
             "limit": 50
         }
         
-        result = fb_get(endpoint, params, access_token)
+        result = await async_fb_get(endpoint, params, access_token)
         
         if "error" in result:
             logger.error(f"❌ Error getting conversations: {result['error']}")
@@ -229,6 +243,58 @@ class AutoSyncService:
         
         return conversations
     
+    async def _prefetch_new_customer_info(self, conversations: List, page, page_id: str,
+                                          access_token: str, db):
+        """
+        ดึงชื่อ/รูป และเวลาข้อความแรกของ user ที่ยังไม่มีในระบบ
+        ด้วย Graph batch request (50 sub-requests ต่อ 1 call) แทนการเรียกทีละคน
+        คืน list ของ (psid, convo_id) ที่ดึงล่วงหน้าไว้
+        """
+        candidates = []
+        for convo in conversations:
+            messages = convo.get("messages", {}).get("data", [])
+            for participant in convo.get("participants", {}).get("data", []):
+                participant_id = participant.get("id")
+                if not participant_id or participant_id == page_id:
+                    continue
+                if self._get_latest_user_message(messages, participant_id):
+                    candidates.append((participant_id, participant, convo.get("id")))
+        
+        if not candidates:
+            return []
+        
+        existing = {
+            psid for (psid,) in db.query(models.FbCustomer.customer_psid).filter(
+                models.FbCustomer.page_id == page.ID,
+                models.FbCustomer.customer_psid.in_([c[0] for c in candidates])
+            ).all()
+        }
+        new_candidates = [c for c in candidates if c[0] not in existing]
+        if not new_candidates:
+            return []
+        
+        nameless = [c[0] for c in new_candidates if not c[1].get("name")]
+        if nameless:
+            results = await async_fb_batch_get(
+                [(psid, {"fields": "name,profile_pic"}) for psid in nameless], access_token
+            )
+            for psid, user_info in zip(nameless, results):
+                if "error" not in user_info:
+                    self.prefetched_user_info[psid] = (
+                        user_info.get("name", f"User...{psid[-8:]}"),
+                        user_info.get("profile_pic", "")
+                    )
+        
+        results = await async_fb_batch_get(
+            [(f"{convo_id}/messages", self._first_message_params()) for _, _, convo_id in new_candidates],
+            access_token
+        )
+        for (psid, _, convo_id), result in zip(new_candidates, results):
+            if "error" not in result:
+                self.prefetched_first_messages[(convo_id, psid)] = self._find_first_message_time(result, psid)
+        
+        return [(psid, convo_id) for psid, _, convo_id in new_candidates]
+    
     async def _process_conversation(self, convo: Dict, page, page_id: str, 
                                    access_token: str, installed_at: datetime, 
                                    db, stats: Dict):
@@ -401,8 +467,12 @@ class AutoSyncService:
         user_name = participant.get("name")
         profile_pic = ""
         
+        prefetched = self.prefetched_user_info.pop(participant_id, None)
+        if not user_name and prefetched:
+            user_name, profile_pic = prefetched
+        
         if not user_name:
-            user_info = fb_get(participant_id, {"fields": "name,profile_pic"}, access_token)
+            user_info = await async_fb_get(participant_id, {"fields": "name,profile_pic"}, access_token)
             user_name = user_info.get("name", f"User...{participant_id[-8:]}")
             profile_pic = user_info.get("profile_pic", "")
         
@@ -410,24 +480,17 @@ class AutoSyncService:
     
     async def _create_initial_mining_status(self, db, customer):
         """สร้าง mining status เริ่มต้นสำหรับ customer ใหม่"""
-        db.query(models.FBCustomerMiningStatus).filter(
-            models.FBCustomerMiningStatus.customer_id == customer.id
-        ).delete()
-        
-        initial_mining_status = models.FBCustomerMiningStatus(
-            customer_id=customer.id,
-            status="ยังไม่ขุด",
+        crud.set_mining_statuses(
+            db, customer.page_id, [customer.customer_psid], crud.MINING_DEFAULT_STATUS,
             note=f"New user added at {datetime.now()}"
         )
-        db.add(initial_mining_status)
-        db.commit()
     
     async def _send_new_customer_sse(self, page_id: str, participant_id: str,
                                      user_name: str, profile_pic: str,
                                      source_type: str):
         """ส่ง SSE notification สำหรับ customer ใหม่"""
         try:
-            from app.routes.facebook.sse import customer_type_update_queue
+            from app.service.sse_hub import publish_customer_type_update
             
             update_data = {
                 'page_id': page_id,
@@ -440,7 +503,7 @@ class AutoSyncService:
                 'source_type': source_type
             }
             
-            await customer_type_update_queue.put(update_data)
+            publish_customer_type_update(update_data)
             logger.info(f"📡 Sent SSE new user notification: {user_name} ({source_type})")
             
         except Exception as e:
@@ -450,29 +513,18 @@ class AutoSyncService:
                                               participant_id: str,
                                               page_id: str) -> bool:
         """อัพเดท mining status ถ้า customer ตอบกลับ"""
-        current_mining_status = db.query(models.FBCustomerMiningStatus).filter(
-            models.FBCustomerMiningStatus.customer_id == customer.id
-        ).order_by(models.FBCustomerMiningStatus.created_at.desc()).first()
-        
-        if current_mining_status and current_mining_status.status == "ขุดแล้ว":
-            # ลบ status เก่า
-            db.query(models.FBCustomerMiningStatus).filter(
-                models.FBCustomerMiningStatus.customer_id == customer.id
-            ).delete()
-            
-            # สร้าง status ใหม่
-            new_status = models.FBCustomerMiningStatus(
-                customer_id=customer.id,
-                status="มีการตอบกลับ",
-                note=f"User replied via auto-sync at {datetime.now()}"
-            )
-            db.add(new_status)
-            db.commit()
-            
-            logger.info(f"💬 ✅ Updated mining status to 'มีการตอบกลับ' for: {customer.name}")
+        customer_name = customer.name
+        replied = crud.set_mining_statuses(
+            db, customer.page_id, [customer.customer_psid], "มีการตอบกลับ",
+            note=f"User replied via auto-sync at {datetime.now()}",
+            expected_status="ขุดแล้ว"
+        )
+        
+        if replied:
+            logger.info(f"💬 ✅ Updated mining status to 'มีการตอบกลับ' for: {customer_name}")
             
             # ส่ง SSE
-            await self._send_mining_status_sse(page_id, participant_id, customer.name)
+            await self._send_mining_status_sse(page_id, participant_id, customer_name)
             
             return True
         
@@ -482,7 +534,7 @@ class AutoSyncService:
                                       customer_name: str):
         """ส่ง SSE notification สำหรับการอัพเดท mining status"""
         try:
-            from app.routes.facebook.sse import customer_type_update_queue
+            from app.service.sse_hub import publish_customer_type_update
             
             update_data = {
                 'page_id': page_id,
@@ -493,7 +545,7 @@ class AutoSyncService:
                 'timestamp': datetime.now().isoformat()
             }
             
-            await customer_type_update_queue.put(update_data)
+            publish_customer_type_update(update_data)
             logger.info(f"📡 Sent SSE mining status update for: {customer_name}")
             
         except Exception as e:
@@ -521,7 +573,7 @@ class AutoSyncService:
                 "limit": 20
             }
             
-            result = fb_get(endpoint, params, access_token)
+            result = await async_fb_get(endpoint, params, access_token)
             if "error" in result:
                 return
             
@@ -566,29 +618,36 @@ class AutoSyncService:
     async def get_first_message_time(self, conversation_id: str, user_id: str, 
                                     access_token: str) -> Optional[datetime]:
         """ดึงเวลาข้อความแรกของ user"""
+        key = (conversation_id, user_id)
+        if key in self.prefetched_first_messages:
+            return self.prefetched_first_messages.pop(key)
+        
         try:
             endpoint = f"{conversation_id}/messages"
-            params = {
-                "fields": "created_time,from",
-                "limit": 100,
-                "order": "chronological"
-            }
-            
-            result = fb_get(endpoint, params, access_token)
-            
-            if "data" in result:
-                for msg in result["data"]:
-                    if msg.get("from", {}).get("id") == user_id:
-                        time_str = msg.get("created_time")
-                        if time_str:
-                            return self.parse_facebook_time(time_str)
-            
-            return None
+            result = await async_fb_get(endpoint, self._first_message_params(), access_token)
+            return self._find_first_message_time(result, user_id)
             
         except Exception as e:
             logger.error(f"⚠️ Error getting first message time: {e}")
             return None
     
+    def _first_message_params(self) -> Dict:
+        return {
+            "fields": "created_time,from",
+            "limit": 100,
+            "order": "chronological"
+        }
+    
+    def _find_first_message_time(self, result: Dict, user_id: str) -> Optional[datetime]:
+        """หาเวลาข้อความแรกของ user จากผลลัพธ์ของ messages endpoint"""
+        if "data" in result:
+            for msg in result["data"]:
+                if msg.get("from", {}).get("id") == user_id:
+                    time_str = msg.get("created_time")
+                    if time_str:
+                        return self.parse_facebook_time(time_str)
+        return None
+    
     def stop(self):
         """หยุดระบบ auto sync"""
         self.is_running = False
@@ -0,0 +1,159 @@
+# backend/app/service/broadcast_sender.py
+"""
+Broadcast Sender
+จัดการ:
+- ส่งข้อความหา users จำนวนมากแบบขนานด้วย worker pool ที่จำกัดจำนวน
+- จำกัด concurrency ต่อเพจ (ใช้ร่วมกันทุก broadcast ของเพจเดียวกันใน event loop เดียวกัน)
+- ข้อความของแต่ละ user ส่งตามลำดับ (order) และหยุดเมื่อข้อความใดล้มเหลว
+- เก็บผลลัพธ์ราย user
+ความเร็วจริงถูกคุมโดย graph_rate_limiter ใน graph_client
+"""
+
+import asyncio
+import logging
+import time
+import weakref
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from app import config
+from app.service.facebook_api import async_send_message, send_image_binary_from_db, send_video_binary
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class RecipientResult:
+    psid: str
+    success: bool
+    sent: int = 0
+    error: Optional[Dict[str, Any]] = None
+    elapsed: float = 0.0
+
+
+@dataclass
+class BroadcastReport:
+    page_id: str
+    results: List[RecipientResult] = field(default_factory=list)
+    elapsed: float = 0.0
+
+    @property
+    def succeeded(self) -> List[str]:
+        return [r.psid for r in self.results if r.success]
+
+    @property
+    def failed(self) -> List[RecipientResult]:
+        return [r for r in self.results if not r.success]
+
+
+async def send_single_message(psid: str, message: Dict[str, Any], access_token: str) -> Optional[Dict[str, Any]]:
+    """ส่งข้อความ 1 ชิ้นตามประเภท (text / image / video) คืน None ถ้าเป็นประเภทที่ไม่รองรับ"""
+    message_type = message.get('type', 'text')
+    content = message.get('content', '')
+
+    if message_type == 'text':
+        return await async_send_message(psid, content, access_token)
+    if message_type == 'image':
+        clean_content = content.replace('[IMAGE] ', '')
+        image_path = f"{config.image_dir}/{clean_content}"
+        return await asyncio.to_thread(send_image_binary_from_db, psid, image_path, access_token)
+    if message_type == 'video':
+        clean_content = content.replace('[VIDEO] ', '')
+        video_path = f"{config.vid_dir}/{clean_content}"
+        return await asyncio.to_thread(send_video_binary, psid, video_path, access_token)
+    return None
+
+
+class BroadcastSender:
+    def __init__(self, max_workers: int = None, page_concurrency: int = None):
+        self.max_workers = max_workers or config.BROADCAST_MAX_WORKERS
+        self.page_concurrency = page_concurrency or config.BROADCAST_PAGE_CONCURRENCY
+        # asyncio.Semaphore ผูกกับ event loop จึงแยกตาม loop
+        self._page_semaphores: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, asyncio.Semaphore]]" = weakref.WeakKeyDictionary()
+
+    def _page_semaphore(self, page_id: str) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        semaphores = self._page_semaphores.setdefault(loop, {})
+        if page_id not in semaphores:
+            semaphores[page_id] = asyncio.Semaphore(self.page_concurrency)
+        return semaphores[page_id]
+
+    async def send_to_recipient(self, psid: str, messages: List[Dict[str, Any]], access_token: str,
+                                log_prefix: str = "") -> RecipientResult:
+        """ส่งทุกข้อความให้ user คนเดียวตามลำดับ"""
+        started = time.monotonic()
+        result = RecipientResult(psid=psid, success=True)
+
+        for message in messages:
+            try:
+                response = await send_single_message(psid, message, access_token)
+            except Exception as e:
+                response = {"error": {"message": str(e), "type": e.__class__.__name__}}
+
+            if response is None:
+                continue
+            if 'error' in response:
+                logger.error(f"{log_prefix} Error sending message to {psid}: {response}")
+                result.success = False
+                result.error = response['error']
+                break
+            result.sent += 1
+
+        result.elapsed = time.monotonic() - started
+        return result
+
+    async def broadcast(
+        self,
+        page_id: str,
+        psids: List[str],
+        messages: List[Dict[str, Any]],
+        access_token: str,
+        on_result: Callable[[RecipientResult], Awaitable[None]] = None,
+        log_prefix: str = "",
+    ) -> BroadcastReport:
+        """
+        ส่งข้อความหาหลาย users พร้อมกัน
+        - on_result ถูกเรียกทันทีที่ user แต่ละคนส่งเสร็จ (สำเร็จหรือล้มเหลว)
+        """
+        report = BroadcastReport(page_id=page_id)
+        psids = list(dict.fromkeys(psids))
+        if not psids or not messages:
+            return report
+
+        ordered_messages = sorted(messages, key=lambda x: x.get('order', 0))
+        queue: asyncio.Queue = asyncio.Queue()
+        for psid in psids:
+            queue.put_nowait(psid)
+
+        semaphore = self._page_semaphore(page_id)
+        started = time.monotonic()
+
+        async def worker():
+            while True:
+                try:
+                    psid = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                async with semaphore:
+                    result = await self.send_to_recipient(psid, ordered_messages, access_token, log_prefix)
+                report.results.append(result)
+                if on_result:
+                    try:
+                        await on_result(result)
+                    except Exception as e:
+                        logger.error(f"{log_prefix} on_result callback failed for {psid}: {e}")
+
+        workers = min(self.max_workers, len(psids))
+        logger.info(f"{log_prefix} Broadcasting to {len(psids)} users on page {page_id} with {workers} workers")
+        await asyncio.gather(*(worker() for _ in range(workers)))
+
+        report.elapsed = time.monotonic() - started
+        logger.info(
+            f"{log_prefix} Broadcast done: {len(report.succeeded)} success, "
+            f"{len(report.failed)} failed in {report.elapsed:.1f}s"
+        )
+        return report
+
+
+# สร้าง instance กลาง
+broadcast_sender = BroadcastSender()
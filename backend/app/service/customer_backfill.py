@@ -0,0 +1,283 @@
+# backend/app/service/customer_backfill.py
+"""
+Customer Backfill
+จัดการ:
+- sync ลูกค้าย้อนหลังหลายปี (imported customers) เป็น job ที่แบ่งช่วงเวลาออกเป็น slice
+- แต่ละ slice ไล่หน้า conversations ทีละหน้า -> process_conversation -> bulk upsert (ใช้ memory คงที่)
+- บันทึก cursor หลังทุกหน้า ทำต่อจากจุดเดิมได้เมื่อ task ถูกขัดจังหวะ
+- รันทีละไม่เกิน BACKFILL_PAGES_PER_TASK หน้าต่อ task แล้วส่ง task ต่อ (ไม่ชน time limit ของ Celery)
+"""
+
+import logging
+import uuid
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import pytz
+from celery.exceptions import SoftTimeLimitExceeded
+
+from app import config
+from app.database import crud, models
+from app.database.database import SessionLocal
+from app.routes.facebook.conversations import resolve_participant_names
+from app.service.facebook_api import fb_get, fb_batch_get
+from app.service.graph_client import GRAPH_BATCH_LIMIT
+from app.utils.fb_helpers import process_conversation, parse_datetime_bangkok
+from app.utils.redis_helper import get_page_token, r
+
+logger = logging.getLogger(__name__)
+bangkok_tz = pytz.timezone("Asia/Bangkok")
+
+CONVERSATION_LIST_PARAMS = {"fields": "participants,updated_time,id", "limit": 100}
+CONVERSATION_MESSAGES_PARAMS = {"fields": "messages.limit(100){created_time,from}"}
+
+# ลบ lock เฉพาะเมื่อยังเป็น token ของเรา (กันลบ lock ของ task อื่นหลัง lock เดิมหมดอายุ)
+_RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+_release_lock = r.register_script(_RELEASE_LOCK_SCRIPT)
+
+
+def split_time_range(start_time: datetime, end_time: datetime, slices: int) -> List[Tuple[datetime, datetime]]:
+    """แบ่งช่วงเวลาเป็น slice เท่า ๆ กัน (เรียงจากใหม่ไปเก่า เพราะ conversations เรียงแบบนั้น)"""
+    step = (end_time - start_time) / slices
+    ranges = [(start_time + step * i, start_time + step * (i + 1)) for i in range(slices)]
+    ranges[-1] = (ranges[-1][0], end_time)
+    return list(reversed(ranges))
+
+
+def create_backfill_job(db, page_db_id: int, start_time: datetime, end_time: datetime, slices: int = 1) -> Tuple[str, List[int]]:
+    """สร้าง job และ slice ทั้งหมด คืน (job_id, slice ids)"""
+    job_id = str(uuid.uuid4())
+    rows = [
+        models.CustomerBackfillSlice(
+            job_id=job_id,
+            page_id=page_db_id,
+            slice_index=index,
+            slice_start=slice_start,
+            slice_end=slice_end,
+            status="pending"
+        )
+        for index, (slice_start, slice_end) in enumerate(split_time_range(start_time, end_time, slices))
+    ]
+    db.add_all(rows)
+    db.commit()
+    return job_id, [row.id for row in rows]
+
+
+def unfinished_slice_ids(db, job_id: str) -> List[int]:
+    return [
+        row.id for row in db.query(models.CustomerBackfillSlice.id).filter(
+            models.CustomerBackfillSlice.job_id == job_id,
+            models.CustomerBackfillSlice.status != "done"
+        ).all()
+    ]
+
+
+def job_progress(db, job_id: str) -> Optional[Dict[str, Any]]:
+    """สรุปความคืบหน้าของ job (None ถ้าไม่พบ)"""
+    rows = db.query(models.CustomerBackfillSlice).filter(
+        models.CustomerBackfillSlice.job_id == job_id
+    ).order_by(models.CustomerBackfillSlice.slice_index).all()
+    if not rows:
+        return None
+
+    statuses = [row.status for row in rows]
+    if all(status == "done" for status in statuses):
+        status = "done"
+    elif "failed" in statuses:
+        status = "failed"
+    elif "running" in statuses or "done" in statuses:
+        status = "running"
+    else:
+        status = "pending"
+
+    return {
+        "job_id": job_id,
+        "status": status,
+        "slices_done": statuses.count("done"),
+        "slices_total": len(rows),
+        "conversations": sum(row.conversations for row in rows),
+        "created": sum(row.created_count for row in rows),
+        "updated": sum(row.updated_count for row in rows),
+        "errors": sum(row.error_count for row in rows),
+        "slices": [
+            {
+                "index": row.slice_index,
+                "start": row.slice_start.isoformat(),
+                "end": row.slice_end.isoformat(),
+                "status": row.status,
+                "conversations": row.conversations,
+                "error": row.error,
+                "updated_at": row.updated_at.isoformat() if row.updated_at else None,
+            }
+            for row in rows
+        ],
+    }
+
+
+def iter_slice_pages(
+    page_id: str,
+    access_token: str,
+    slice_start: datetime,
+    slice_end: datetime,
+    after: Optional[str] = None
+) -> Iterator[Tuple[List[Dict[str, Any]], Optional[str]]]:
+    """
+    Yield (conversations ในช่วง slice, cursor ของหน้าถัดไป) ทีละหน้า
+    conversations เรียงจากใหม่ไปเก่า จึงหยุดทันทีที่เจอ conversation เก่ากว่า slice_start
+    """
+    endpoint = f"{page_id}/conversations"
+
+    while True:
+        params = {**CONVERSATION_LIST_PARAMS, "after": after} if after else CONVERSATION_LIST_PARAMS
+        page = fb_get(endpoint, params, access_token)
+        if not page or "error" in page:
+            raise RuntimeError(f"Error getting conversations: {page.get('error') if page else 'no result'}")
+
+        data = page.get("data", [])
+        convos = []
+        reached_older = False
+        for convo in data:
+            updated_time = parse_datetime_bangkok(convo.get("updated_time") or "")
+            if updated_time is None or updated_time > slice_end:
+                continue
+            if updated_time < slice_start:
+                reached_older = True
+                break
+            convos.append(convo)
+
+        paging = page.get("paging", {})
+        after = (paging.get("cursors") or {}).get("after") if paging.get("next") else None
+        if reached_older or not data:
+            after = None
+
+        yield convos, after
+        if not after:
+            break
+
+
+def build_customers_for_page(convos: List[Dict[str, Any]], page_id: str, access_token: str,
+                             slice_start: datetime, slice_end: datetime,
+                             installed_at: datetime) -> Tuple[List[Dict[str, Any]], int]:
+    """ดึงข้อความ + ชื่อแบบ batch แล้วแปลง conversations ของหน้าเดียวเป็นข้อมูลลูกค้า คืน (rows, errors)"""
+    for index in range(0, len(convos), GRAPH_BATCH_LIMIT):
+        chunk = convos[index:index + GRAPH_BATCH_LIMIT]
+        results = fb_batch_get([(convo["id"], CONVERSATION_MESSAGES_PARAMS) for convo in chunk], access_token)
+        for convo, result in zip(chunk, results):
+            convo["messages"] = result.get("messages", {}) if "error" not in result else {}
+
+    names = resolve_participant_names(convos, access_token, page_id)
+    for convo in convos:
+        for participant in convo.get("participants", {}).get("data", []):
+            if participant.get("id") in names:
+                participant["name"] = names[participant["id"]]
+
+    rows = []
+    errors = 0
+    for convo in convos:
+        result = process_conversation(
+            convo, page_id, access_token,
+            filter_start_date=slice_start, filter_end_date=slice_end, resolve_name=False
+        )
+        if result.get("error"):
+            errors += 1
+        elif "data" in result:
+            data = result["data"]
+            # ก่อนติดตั้งเว็บ = imported
+            data["source_type"] = "new" if data["first_interaction_at"] >= installed_at else "imported"
+            rows.append(data)
+    return rows, errors
+
+
+def run_backfill_slice(slice_id: int, max_pages: int = None) -> Dict[str, Any]:
+    """
+    ทำงาน slice ต่อจาก cursor ล่าสุดไม่เกิน max_pages หน้า
+    คืน {"done": bool, ...} - ถ้ายังไม่เสร็จ ผู้เรียกต้องส่ง task ต่อ
+    ข้อจำกัด:
+    - Graph ไม่มี filter ตามเวลาสำหรับ /conversations ทุก slice จึงเริ่มไล่จากหน้าบนสุด (ใหม่สุด)
+      slice ที่เก่ากว่าต้องอ่านหน้ารายการของช่วงที่ใหม่กว่าทั้งหมดก่อนถึงช่วงของตัวเอง
+    - ทุก slice ของเพจใช้ rate bucket เดียวกัน (graph_rate_limiter) การแบ่ง slice จึงไม่เพิ่มจำนวน call ที่ทำได้
+    - ถ้าชน soft time limit จะคงสถานะ running ไว้ ให้ task ถัดไปทำต่อจาก cursor
+    """
+    max_pages = max_pages or config.BACKFILL_PAGES_PER_TASK
+    lock_key = f"backfill:slice:{slice_id}"
+    lock_token = uuid.uuid4().hex
+    if not r.set(lock_key, lock_token, nx=True, ex=config.BACKFILL_SLICE_LOCK_SECONDS):
+        logger.info(f"Backfill slice {slice_id} is already running")
+        return {"done": False, "skipped": True}
+
+    db = SessionLocal()
+    try:
+        backfill_slice = db.query(models.CustomerBackfillSlice).filter(
+            models.CustomerBackfillSlice.id == slice_id
+        ).first()
+        if not backfill_slice or backfill_slice.status == "done":
+            return {"done": True}
+
+        page = crud.get_page_by_id(db, backfill_slice.page_id)
+        access_token = get_page_token(page.page_id) if page else None
+        if not access_token:
+            backfill_slice.status = "failed"
+            backfill_slice.error = "No access token for page"
+            db.commit()
+            return {"done": True, "error": backfill_slice.error}
+
+        installed_at = page.created_at or datetime.now(bangkok_tz)
+        if installed_at.tzinfo is None:
+            installed_at = bangkok_tz.localize(installed_at)
+        slice_start = backfill_slice.slice_start.astimezone(bangkok_tz)
+        slice_end = backfill_slice.slice_end.astimezone(bangkok_tz)
+
+        backfill_slice.status = "running"
+        backfill_slice.error = None
+        db.commit()
+
+        pages_done = 0
+        finished = True
+        try:
+            for convos, next_cursor in iter_slice_pages(page.page_id, access_token, slice_start, slice_end,
+                                                        after=backfill_slice.cursor):
+                if convos:
+                    rows, errors = build_customers_for_page(convos, page.page_id, access_token,
+                                                            slice_start, slice_end, installed_at)
+                    results = crud.bulk_create_or_update_customers(db, page.ID, rows) if rows else {}
+                    backfill_slice.conversations += len(convos)
+                    backfill_slice.created_count += results.get("created", 0)
+                    backfill_slice.updated_count += results.get("updated", 0)
+                    backfill_slice.error_count += errors + results.get("errors", 0)
+
+                # บันทึก cursor พร้อมผลของหน้านี้
+                backfill_slice.cursor = next_cursor
+                db.commit()
+
+                pages_done += 1
+                if next_cursor and pages_done >= max_pages:
+                    finished = False
+                    break
+        except SoftTimeLimitExceeded:
+            # ไม่ใช่ความผิดพลาด หน้าที่เสร็จแล้วบันทึก cursor ไว้ task ถัดไปทำต่อได้
+            db.rollback()
+            raise
+        except Exception as e:
+            db.rollback()
+            backfill_slice.status = "failed"
+            backfill_slice.error = str(e)
+            db.commit()
+            raise
+
+        if finished:
+            backfill_slice.status = "done"
+            backfill_slice.cursor = None
+            db.commit()
+            logger.info(
+                f"✅ Backfill slice {slice_id} done: {backfill_slice.conversations} conversations, "
+                f"{backfill_slice.created_count} created, {backfill_slice.updated_count} updated"
+            )
+        return {"done": finished, "pages": pages_done}
+    finally:
+        db.close()
+        _release_lock(keys=[lock_key], args=[lock_token])
@@ -1,4 +1,3 @@
-import requests
 from urllib.parse import urlparse
 import json
 import os
@@ -6,7 +5,9 @@ from tempfile import NamedTemporaryFile
 import logging
 import io
 
-FB_API_URL = "https://graph.facebook.com/v14.0"
+from app.service.graph_client import graph_client, build_batch_item
+
+FB_API_URL = graph_client.base_url
 
 logger = logging.getLogger(__name__)
 
@@ -24,28 +25,37 @@ clean_url = fix_nested_image_url(bad_url)
 
 # API สำหรับส่ง POST request ไปยัง Facebook Graph API
 def fb_post(endpoint: str, payload: dict, access_token: str = None):
-    url = f"{FB_API_URL}/{endpoint}"
-    params = {"access_token": access_token}
-    print(f"🔍 POST to: {url}")
-    print(f"🔍 Payload: {payload}")
-    response = requests.post(url, params=params, json=payload)
-    return response.json()
-
-# API สำหรับแก้ไขรูปแบบ ISO datetime ให้ถูกต้อง
-def fb_get(endpoint: str, params: dict = {}, access_token: str = None):
-    params["access_token"] = access_token
-    url = f"{FB_API_URL}/{endpoint}"
-    print(f"🔍 GET from: {url}")
-    print(f"🔍 Params: {params}")
-    response = requests.get(url, params=params)
-    return response.json()
+    logger.debug(f"🔍 POST to: {endpoint}")
+    return graph_client.post_sync(endpoint, payload, access_token)
+
+# API สำหรับส่ง GET request ไปยัง Facebook Graph API
+def fb_get(endpoint: str, params: dict = None, access_token: str = None):
+    logger.debug(f"🔍 GET from: {endpoint} params={params}")
+    return graph_client.get_sync(endpoint, params, access_token)
+
+# เวอร์ชัน async สำหรับเรียกจาก event loop (ไม่ block loop)
+async def async_fb_post(endpoint: str, payload: dict, access_token: str = None):
+    logger.debug(f"🔍 POST to: {endpoint}")
+    return await graph_client.post(endpoint, payload, access_token)
+
+async def async_fb_get(endpoint: str, params: dict = None, access_token: str = None):
+    logger.debug(f"🔍 GET from: {endpoint} params={params}")
+    return await graph_client.get(endpoint, params, access_token)
+
+# API สำหรับรวมหลาย GET เป็น Graph Batch Request
+# requests = [(endpoint, params), ...] → คืนผลลัพธ์ตามลำดับเดียวกัน
+def fb_batch_get(requests: list, access_token: str = None) -> list:
+    logger.debug(f"🔍 BATCH GET {len(requests)} requests")
+    items = [build_batch_item(endpoint, params) for endpoint, params in requests]
+    return graph_client.batch_sync(items, access_token)
+
+async def async_fb_batch_get(requests: list, access_token: str = None) -> list:
+    logger.debug(f"🔍 BATCH GET {len(requests)} requests")
+    items = [build_batch_item(endpoint, params) for endpoint, params in requests]
+    return await graph_client.batch(items, access_token)
 
 # API สำหรับดึงข้อมูลผู้ใช้จาก PSID
 def send_image_file_from_db(recipient_id: str, image_binary: bytes, filename: str, access_token: str):
-    url = f"https://graph.facebook.com/v14.0/me/messages"
-    params = {
-        "access_token": access_token
-    }
     data = {
         "recipient": '{"id":"%s"}' % recipient_id,
         "message": '{"attachment":{"type":"image", "payload":{}}}'
@@ -53,40 +63,30 @@ def send_image_file_from_db(recipient_id: str, image_binary: bytes, filename: st
     files = {
         'filedata': (filename, image_binary, 'image/jpeg')  # เปลี่ยน content type ตามไฟล์จริง
     }
-    response = requests.post(url, params=params, data=data, files=files)
-    print(f"Response Status: {response.status_code}")
-    print(f"Response: {response.text}")
-    return response.json()
+    result = graph_client.request_sync("POST", "me/messages", access_token, data=data, files=files)
+    logger.info(f"Response: {result}")
+    return result
 
 # API สำหรับส่งข้อความไปยังผู้ใช้
-def send_message(recipient_id: str, message_text: str, access_token: str = None):
-    payload = {
+def build_text_message_payload(recipient_id: str, message_text: str) -> dict:
+    return {
         "messaging_type": "MESSAGE_TAG",
         "recipient": {"id": recipient_id},
         "message": {"text": message_text},
         "tag": "CONFIRMED_EVENT_UPDATE"
     }
-    return fb_post("me/messages", payload, access_token)
+
+def send_message(recipient_id: str, message_text: str, access_token: str = None):
+    return fb_post("me/messages", build_text_message_payload(recipient_id, message_text), access_token)
+
+async def async_send_message(recipient_id: str, message_text: str, access_token: str = None):
+    return await async_fb_post("me/messages", build_text_message_payload(recipient_id, message_text), access_token)
 
 # API สำหรับส่งข้อความแบบ binary (image/video)
 def send_image_binary_from_db(recipient_id: str, image_binary: bytes, access_token: str):
     """
     ส่งภาพจาก database (binary) ไปยัง Facebook Messenger โดยตรง
     """
-    url = f"https://graph.facebook.com/v14.0/me/messages?access_token={access_token}"
-
-    payload = {
-        "recipient": {"id": recipient_id},
-        "message": {
-            "attachment": {
-                "type": "image",
-                "payload": {}
-            }
-        },
-        "messaging_type": "MESSAGE_TAG",
-        "tag": "CONFIRMED_EVENT_UPDATE"
-    }
-
     # เตรียมข้อมูล multipart
     data = {
         'recipient': '{"id":"%s"}' % recipient_id,
@@ -99,14 +99,14 @@ def send_image_binary_from_db(recipient_id: str, image_binary: bytes, access_tok
         'filedata': ('image.jpg', io.BytesIO(image_binary), 'image/jpeg')
     }
 
-    response = requests.post(url, data=data, files=files)
+    result = graph_client.request_sync("POST", "me/messages", access_token, data=data, files=files)
 
-    if not response.ok:
-        logger.error(f"❌ Error sending image: {response.status_code} {response.text}")
+    if "error" in result:
+        logger.error(f"❌ Error sending image: {result['error']}")
     else:
         logger.info(f"✅ Image sent successfully to PSID={recipient_id}")
 
-    return response.json()
+    return result
 
 # API สำหรับส่งข้อความแบบ binary (image/video) โดยใช้ URL
 def send_image(recipient_id: str, filename: str, access_token: str):
@@ -139,7 +139,6 @@ def send_video_binary(recipient_id: str, filepath: str, access_token: str):
 
     print("เปิดไฟล์จาก:", full_path)
 
-    url = f"https://graph.facebook.com/v14.0/me/messages?access_token={access_token}"
     filename = os.path.basename(full_path)
 
     payload = {
@@ -165,9 +164,9 @@ def send_video_binary(recipient_id: str, filepath: str, access_token: str):
         files = {
             'filedata': (filename, f, 'video/mp4')  # MIME type video/mp4
         }
-        response = requests.post(url, data=data, files=files)
+        result = graph_client.request_sync("POST", "me/messages", access_token, data=data, files=files)
 
-    return response.json()
+    return result
 
 # API สำหรับส่งวิดีโอแบบ URL
 def send_video(recipient_id: str, video_url: str, access_token: str):
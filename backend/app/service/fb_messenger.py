@@ -2,7 +2,7 @@ import logging
 from app.service.facebook_api import send_image_binary_from_db
 from app.config import image_dir, vid_dir
 from app.database import crud
-import requests
+from app.service.graph_client import graph_client
 import json
 import io
 
@@ -22,8 +22,6 @@ def send_facebook_message(
     """
     ส่งข้อความหรือรูป (binary) ไปยัง Facebook Messenger API
     """
-    url = f"https://graph.facebook.com/v14.0/me/messages?access_token={access_token}"
-
     if msg_type == "image":
         # ✅ ส่งรูปแบบ binary โดยตรง
         if not image_binary:
@@ -43,7 +41,7 @@ def send_facebook_message(
         }
 
         logger.info(f"🖼 Sending image ({len(image_binary)} bytes) to PSID={psid}")
-        response = requests.post(url, data=data, files=files)
+        result = graph_client.request_sync("POST", "me/messages", access_token, data=data, files=files)
 
     else:
         # ✅ ส่งข้อความธรรมดา
@@ -54,8 +52,7 @@ def send_facebook_message(
             "tag": message_tag
         }
         logger.info(f"💬 Sending text: '{message}' to PSID={psid}")
-        response = requests.post(url, json=payload)
+        result = graph_client.post_sync("me/messages", payload, access_token)
 
-    result = response.json()
     logger.info(f"📩 Facebook response: {result}")
     return result
\ No newline at end of file
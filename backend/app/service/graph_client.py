@@ -0,0 +1,345 @@
+# backend/app/service/graph_client.py
+"""
+Graph API Client
+จัดการ:
+- connection pool แบบ keep-alive สำหรับ Facebook Graph API (ใช้ร่วมกันทั้ง process)
+- client แบบ async สำหรับ FastAPI / background services
+- sync wrappers สำหรับ Celery tasks และโค้ดเดิมที่ยังเป็น sync
+- Batch Request (รวมสูงสุด 50 sub-requests ต่อ 1 HTTP call)
+- ทุก request ผ่าน graph_rate_limiter (token bucket ใน Redis)
+"""
+
+import asyncio
+import json as jsonlib
+import logging
+import threading
+import time
+import weakref
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlencode
+
+import httpx
+
+from app import config
+from app.service.graph_rate_limiter import graph_rate_limiter, rate_limited_error
+
+logger = logging.getLogger(__name__)
+
+# Graph API รับได้สูงสุด 50 sub-requests ต่อ batch
+GRAPH_BATCH_LIMIT = 50
+
+
+def _build_timeout() -> httpx.Timeout:
+    return httpx.Timeout(
+        connect=config.GRAPH_CONNECT_TIMEOUT,
+        read=config.GRAPH_READ_TIMEOUT,
+        write=config.GRAPH_READ_TIMEOUT,
+        pool=config.GRAPH_POOL_TIMEOUT,
+    )
+
+
+def _build_limits() -> httpx.Limits:
+    # ทุก request วิ่งไปที่ graph.facebook.com host เดียว
+    # limit ของ pool จึงเท่ากับ limit ต่อ host
+    return httpx.Limits(
+        max_connections=config.GRAPH_MAX_CONNECTIONS,
+        max_keepalive_connections=config.GRAPH_MAX_KEEPALIVE,
+        keepalive_expiry=config.GRAPH_KEEPALIVE_EXPIRY,
+    )
+
+
+def _transport_error(e: Exception) -> Dict[str, Any]:
+    """แปลง network error ให้อยู่ในรูปแบบเดียวกับ error ของ Graph API"""
+    return {
+        "error": {
+            "message": str(e) or e.__class__.__name__,
+            "type": "GraphTransportError",
+            "code": -1,
+        }
+    }
+
+
+def _parse_response(response: httpx.Response) -> Dict[str, Any]:
+    try:
+        return response.json()
+    except ValueError:
+        return {
+            "error": {
+                "message": response.text[:500],
+                "type": "GraphInvalidResponse",
+                "code": response.status_code,
+            }
+        }
+
+
+def _batch_incomplete() -> Dict[str, Any]:
+    # Graph ตอบ null กลับมาเมื่อ sub-request ทำไม่ทันใน batch เดียว
+    return {
+        "error": {
+            "message": "Batch sub-request was not completed",
+            "type": "GraphBatchIncomplete",
+            "code": -2,
+        }
+    }
+
+
+def build_batch_item(endpoint: str, params: Dict[str, Any] = None, method: str = "GET") -> Dict[str, Any]:
+    """แปลง endpoint + params เป็น sub-request ของ batch"""
+    relative_url = endpoint.lstrip("/")
+    if params:
+        relative_url = f"{relative_url}?{urlencode(params)}"
+    return {"method": method, "relative_url": relative_url}
+
+
+def _parse_batch_item(item: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """แปลงผลลัพธ์ของแต่ละ sub-request (คืน None ถ้าต้อง retry)"""
+    if item is None:
+        return None
+    body = item.get("body")
+    try:
+        parsed = jsonlib.loads(body) if body else {}
+    except ValueError:
+        parsed = None
+    if not isinstance(parsed, dict):
+        parsed = {"data": parsed} if parsed is not None else {}
+    if item.get("code") != 200 and "error" not in parsed:
+        return {
+            "error": {
+                "message": (body or "")[:500],
+                "type": "GraphBatchItemError",
+                "code": item.get("code"),
+            }
+        }
+    return parsed
+
+
+def _split_batch_result(result: Any, size: int) -> List[Optional[Dict[str, Any]]]:
+    """แยกผลลัพธ์ของ batch call ออกเป็นรายการตามลำดับ request"""
+    if isinstance(result, dict) and "error" in result:
+        # ทั้ง batch ล้มเหลว → ทุก sub-request ได้ error เดียวกัน
+        return [result] * size
+    if not isinstance(result, list) or len(result) != size:
+        return [_batch_incomplete() for _ in range(size)]
+    return [_parse_batch_item(item) for item in result]
+
+
+def _chunk(items: List[Any], size: int = GRAPH_BATCH_LIMIT) -> List[List[Any]]:
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+class GraphClient:
+    """
+    Client กลางสำหรับเรียก Graph API
+    - sync client ตัวเดียว (thread-safe) สำหรับ Celery / โค้ด sync
+    - async client แยกตาม event loop เพราะ app นี้มีหลาย loop
+      (uvicorn, scheduler thread, auto sync thread, loop ชั่วคราวใน Celery)
+    """
+
+    def __init__(self, base_url: str = None):
+        self.base_url = (base_url or config.GRAPH_API_URL).rstrip("/")
+        self._sync_client: Optional[httpx.Client] = None
+        self._sync_lock = threading.Lock()
+        self._async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = weakref.WeakKeyDictionary()
+        self._async_lock = threading.Lock()
+
+    def build_url(self, endpoint: str) -> str:
+        """รองรับทั้ง endpoint แบบ relative และ full URL (เช่น paging.next)"""
+        if endpoint.startswith("http://") or endpoint.startswith("https://"):
+            return endpoint
+        return f"{self.base_url}/{endpoint.lstrip('/')}"
+
+    # ---------- client factories ----------
+
+    def _get_sync_client(self) -> httpx.Client:
+        if self._sync_client is None:
+            with self._sync_lock:
+                if self._sync_client is None:
+                    self._sync_client = httpx.Client(
+                        timeout=_build_timeout(),
+                        limits=_build_limits(),
+                    )
+                    logger.info("🔌 Created pooled sync Graph client")
+        return self._sync_client
+
+    def _get_async_client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None or client.is_closed:
+            with self._async_lock:
+                client = self._async_clients.get(loop)
+                if client is None or client.is_closed:
+                    client = httpx.AsyncClient(
+                        timeout=_build_timeout(),
+                        limits=_build_limits(),
+                    )
+                    self._async_clients[loop] = client
+                    logger.info("🔌 Created pooled async Graph client for event loop")
+        return client
+
+    # ---------- async API ----------
+
+    async def request(
+        self,
+        method: str,
+        endpoint: str,
+        access_token: str = None,
+        params: Dict[str, Any] = None,
+        json: Any = None,
+        data: Any = None,
+        files: Any = None,
+        cost: int = 1,
+    ) -> Dict[str, Any]:
+        params = dict(params or {})
+        if access_token:
+            params["access_token"] = access_token
+        url = self.build_url(endpoint)
+
+        # รอ token จาก rate limiter (cost = จำนวน call ที่นับกับ quota, batch นับตามจำนวน sub-request)
+        # limiter ใช้ Redis แบบ sync จึงเรียกใน thread เพื่อไม่ให้ block event loop
+        waited = 0.0
+        while True:
+            wait = await asyncio.to_thread(graph_rate_limiter.try_acquire, access_token, cost)
+            if wait <= 0:
+                break
+            if waited + wait > config.GRAPH_RATE_MAX_WAIT:
+                return rate_limited_error(wait)
+            waited += wait
+            await asyncio.sleep(wait)
+
+        try:
+            response = await self._get_async_client().request(
+                method, url, params=params, json=json, data=data, files=files
+            )
+        except httpx.HTTPError as e:
+            logger.error(f"❌ Graph {method} {endpoint} failed: {e}")
+            return _transport_error(e)
+        result = _parse_response(response)
+        await asyncio.to_thread(graph_rate_limiter.observe, access_token, response.headers, result)
+        return result
+
+    async def get(self, endpoint: str, params: Dict[str, Any] = None, access_token: str = None) -> Dict[str, Any]:
+        return await self.request("GET", endpoint, access_token, params=params)
+
+    async def post(self, endpoint: str, payload: Any = None, access_token: str = None, **kwargs) -> Dict[str, Any]:
+        return await self.request("POST", endpoint, access_token, json=payload, **kwargs)
+
+    async def _batch_call(self, items: List[Dict[str, Any]], access_token: str) -> List[Optional[Dict[str, Any]]]:
+        result = await self.request(
+            "POST", "", access_token,
+            data={"batch": jsonlib.dumps(items), "include_headers": "false"},
+            cost=len(items),
+        )
+        return _split_batch_result(result, len(items))
+
+    async def batch(self, items: List[Dict[str, Any]], access_token: str = None) -> List[Dict[str, Any]]:
+        """
+        ส่ง sub-requests แบบ batch (แบ่งทีละ 50) แล้วคืนผลลัพธ์ตามลำดับเดิม
+        - sub-request ที่ล้มเหลวจะได้ dict ที่มี key "error" เหมือนเรียกเดี่ยว
+        - sub-request ที่ Graph ทำไม่ทัน (null) จะถูก retry อีก 1 รอบ
+        """
+        results: List[Optional[Dict[str, Any]]] = []
+        chunks = _chunk(items)
+        for chunk_result in await asyncio.gather(*(self._batch_call(c, access_token) for c in chunks)):
+            results.extend(chunk_result)
+
+        pending = [i for i, r in enumerate(results) if r is None]
+        if pending:
+            logger.info(f"🔁 Retry {len(pending)} incomplete batch sub-requests")
+            retry_results = await asyncio.gather(
+                *(self._batch_call([items[i] for i in c], access_token) for c in _chunk(pending))
+            )
+            for chunk_indexes, chunk_result in zip(_chunk(pending), retry_results):
+                for i, r in zip(chunk_indexes, chunk_result):
+                    results[i] = r
+
+        return [r if r is not None else _batch_incomplete() for r in results]
+
+    # ---------- sync wrappers (Celery) ----------
+
+    def request_sync(
+        self,
+        method: str,
+        endpoint: str,
+        access_token: str = None,
+        params: Dict[str, Any] = None,
+        json: Any = None,
+        data: Any = None,
+        files: Any = None,
+        cost: int = 1,
+    ) -> Dict[str, Any]:
+        params = dict(params or {})
+        if access_token:
+            params["access_token"] = access_token
+        url = self.build_url(endpoint)
+
+        # รอ token จาก rate limiter (cost = จำนวน call ที่นับกับ quota, batch นับตามจำนวน sub-request)
+        waited = 0.0
+        while True:
+            wait = graph_rate_limiter.try_acquire(access_token, cost)
+            if wait <= 0:
+                break
+            if waited + wait > config.GRAPH_RATE_MAX_WAIT:
+                return rate_limited_error(wait)
+            waited += wait
+            time.sleep(wait)
+
+        try:
+            response = self._get_sync_client().request(
+                method, url, params=params, json=json, data=data, files=files
+            )
+        except httpx.HTTPError as e:
+            logger.error(f"❌ Graph {method} {endpoint} failed: {e}")
+            return _transport_error(e)
+        result = _parse_response(response)
+        graph_rate_limiter.observe(access_token, response.headers, result)
+        return result
+
+    def get_sync(self, endpoint: str, params: Dict[str, Any] = None, access_token: str = None) -> Dict[str, Any]:
+        return self.request_sync("GET", endpoint, access_token, params=params)
+
+    def post_sync(self, endpoint: str, payload: Any = None, access_token: str = None, **kwargs) -> Dict[str, Any]:
+        return self.request_sync("POST", endpoint, access_token, json=payload, **kwargs)
+
+    def _batch_call_sync(self, items: List[Dict[str, Any]], access_token: str) -> List[Optional[Dict[str, Any]]]:
+        result = self.request_sync(
+            "POST", "", access_token,
+            data={"batch": jsonlib.dumps(items), "include_headers": "false"},
+            cost=len(items),
+        )
+        return _split_batch_result(result, len(items))
+
+    def batch_sync(self, items: List[Dict[str, Any]], access_token: str = None) -> List[Dict[str, Any]]:
+        """เวอร์ชัน sync ของ batch()"""
+        results: List[Optional[Dict[str, Any]]] = []
+        for chunk in _chunk(items):
+            results.extend(self._batch_call_sync(chunk, access_token))
+
+        pending = [i for i, r in enumerate(results) if r is None]
+        if pending:
+            logger.info(f"🔁 Retry {len(pending)} incomplete batch sub-requests")
+            for chunk_indexes in _chunk(pending):
+                chunk_result = self._batch_call_sync([items[i] for i in chunk_indexes], access_token)
+                for i, r in zip(chunk_indexes, chunk_result):
+                    results[i] = r
+
+        return [r if r is not None else _batch_incomplete() for r in results]
+
+    # ---------- lifecycle ----------
+
+    async def aclose(self):
+        """ปิด async client ของ loop ปัจจุบัน (เรียกตอน shutdown)"""
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.pop(loop, None)
+        if client is not None:
+            await client.aclose()
+
+    def close(self):
+        """ปิด sync client"""
+        with self._sync_lock:
+            if self._sync_client is not None:
+                self._sync_client.close()
+                self._sync_client = None
+
+
+# สร้าง instance กลาง
+graph_client = GraphClient()
@@ -0,0 +1,230 @@
+# backend/app/service/graph_rate_limiter.py
+"""
+Graph API Rate Limiter
+จัดการ:
+- token bucket ต่อ app และต่อเพจ เก็บใน Redis (ใช้ร่วมกันทั้ง API process และ Celery workers)
+- ปรับความเร็วตาม usage headers (X-App-Usage / X-Page-Usage / X-Business-Use-Case-Usage)
+- หยุดส่งชั่วคราว (backoff) เมื่อ Facebook ตอบ rate limit error (code 4, 17, 32, 613)
+"""
+
+import hashlib
+import json
+import logging
+from typing import Any, Dict, List, Optional
+
+import redis
+
+from app import config
+from app.utils.redis_helper import r
+
+logger = logging.getLogger(__name__)
+
+APP_LIMIT_CODES = {4, 17}
+PAGE_LIMIT_CODES = {17, 32, 613, 80001, 80006}
+
+# KEYS = bucket keys, ARGV[1] = cost, ARGV[2i] / ARGV[2i+1] = rate / capacity ของ bucket ที่ i
+# คืนค่า 0 ถ้าได้ token (หักทุก bucket พร้อมกัน) หรือจำนวน ms ที่ต้องรอ
+_ACQUIRE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local cost = tonumber(ARGV[1])
+local wait = 0
+local states = {}
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2])
+    local capacity = tonumber(ARGV[i * 2 + 1])
+    local need = math.min(cost, capacity)
+    local blocked = redis.call('PTTL', key .. ':block')
+    local data = redis.call('HMGET', key, 'tokens', 'ts', 'factor')
+    local factor = tonumber(data[3]) or 1
+    local effective = math.max(rate * factor, 0.001)
+    local tokens = tonumber(data[1]) or capacity
+    local ts = tonumber(data[2]) or now
+    tokens = math.min(capacity, tokens + math.max(now - ts, 0) * effective / 1000)
+    states[i] = {tokens, need}
+    if blocked > 0 then
+        wait = math.max(wait, blocked)
+    elseif tokens < need then
+        wait = math.max(wait, math.ceil((need - tokens) * 1000 / effective))
+    end
+end
+if wait > 0 then
+    return wait
+end
+for i, key in ipairs(KEYS) do
+    redis.call('HSET', key, 'tokens', states[i][1] - states[i][2], 'ts', now)
+    redis.call('PEXPIRE', key, 3600000)
+end
+return 0
+"""
+
+
+def _load_usage(raw: Optional[str]) -> Any:
+    if not raw:
+        return None
+    try:
+        return json.loads(raw)
+    except ValueError:
+        return None
+
+
+def _usage_percent(usage: Optional[Dict[str, Any]]) -> float:
+    if not isinstance(usage, dict):
+        return 0.0
+    values = [usage.get(k) for k in ("call_count", "total_cputime", "total_time")]
+    return float(max([v for v in values if isinstance(v, (int, float))] or [0]))
+
+
+def _regain_minutes(usage: Any) -> float:
+    if not isinstance(usage, dict):
+        return 0.0
+    value = usage.get("estimated_time_to_regain_access")
+    return float(value) if isinstance(value, (int, float)) and value > 0 else 0.0
+
+
+def parse_usage_headers(headers) -> Dict[str, Any]:
+    """
+    อ่าน usage headers ของ Graph API (ข้ามค่าที่รูปแบบไม่ตรง)
+    คืน {"app": %, "page": %, "regain_seconds": วินาทีที่ต้องรอ (ถ้า Facebook บอกมา)}
+    """
+    headers = headers or {}
+    app_usage = _load_usage(headers.get("x-app-usage"))
+    page_usage = _load_usage(headers.get("x-page-usage"))
+    buc_usage = _load_usage(headers.get("x-business-use-case-usage"))
+
+    page_percent = _usage_percent(page_usage)
+    regain_minutes = _regain_minutes(page_usage)
+
+    # X-Business-Use-Case-Usage: {"<id>": [{"type": "pages", "call_count": ..., ...}]}
+    if isinstance(buc_usage, dict):
+        for entries in buc_usage.values():
+            for entry in entries if isinstance(entries, list) else []:
+                if not isinstance(entry, dict):
+                    continue
+                page_percent = max(page_percent, _usage_percent(entry))
+                regain_minutes = max(regain_minutes, _regain_minutes(entry))
+
+    return {
+        "app": _usage_percent(app_usage) if app_usage is not None else None,
+        "page": page_percent if (page_usage is not None or buc_usage is not None) else None,
+        "regain_seconds": regain_minutes * 60,
+    }
+
+
+class GraphRateLimiter:
+    """
+    Token bucket แบบ distributed บน Redis
+    - bucket "app" ใช้ร่วมกันทุกเพจ
+    - bucket ต่อเพจ ระบุด้วย hash ของ page access token (token หนึ่งตัว = เพจหนึ่งเพจ)
+    - factor ของแต่ละ bucket ลดลงเมื่อ usage สูงขึ้น ทำให้ส่งช้าลงก่อนโดน block
+    ถ้า Redis ใช้ไม่ได้จะปล่อยผ่าน (fail open) เพื่อไม่ให้ระบบหลักหยุด
+    """
+
+    def __init__(self, redis_client=None, prefix: str = "graph_rl"):
+        self.redis = redis_client or r
+        self.prefix = prefix
+        self.enabled = config.GRAPH_RATE_LIMIT_ENABLED
+        self._acquire = self.redis.register_script(_ACQUIRE_SCRIPT)
+
+    # ---------- keys ----------
+
+    def app_key(self) -> str:
+        return f"{self.prefix}:app"
+
+    def page_key(self, access_token: str) -> str:
+        digest = hashlib.sha1(access_token.encode()).hexdigest()[:16]
+        return f"{self.prefix}:page:{digest}"
+
+    def _buckets(self, access_token: Optional[str]) -> List[tuple]:
+        buckets = [(self.app_key(), config.GRAPH_RATE_APP_PER_SEC, config.GRAPH_RATE_APP_BURST)]
+        if access_token:
+            buckets.append((self.page_key(access_token), config.GRAPH_RATE_PAGE_PER_SEC, config.GRAPH_RATE_PAGE_BURST))
+        return buckets
+
+    # ---------- acquire ----------
+
+    def try_acquire(self, access_token: Optional[str], cost: int = 1) -> float:
+        """ขอ token จากทุก bucket พร้อมกัน คืนจำนวนวินาทีที่ต้องรอ (0 = ส่งได้เลย)"""
+        if not self.enabled:
+            return 0.0
+        buckets = self._buckets(access_token)
+        args = [max(cost, 1)]
+        for _, rate, capacity in buckets:
+            args.extend([rate, capacity])
+        try:
+            wait_ms = self._acquire(keys=[key for key, _, _ in buckets], args=args)
+        except redis.RedisError as e:
+            logger.warning(f"⚠️ Rate limiter unavailable, skipping: {e}")
+            return 0.0
+        return int(wait_ms) / 1000.0
+
+    # ---------- feedback จาก Facebook ----------
+
+    def _factor_for(self, percent: float) -> float:
+        start = config.GRAPH_USAGE_THROTTLE_START
+        block_at = config.GRAPH_USAGE_BLOCK_AT
+        if percent <= start:
+            return 1.0
+        if percent >= block_at:
+            return config.GRAPH_RATE_MIN_FACTOR
+        return max(config.GRAPH_RATE_MIN_FACTOR, (block_at - percent) / (block_at - start))
+
+    def _block(self, pipe, key: str, seconds: float):
+        pipe.set(f"{key}:block", 1, px=max(int(seconds * 1000), 1))
+
+    def _backoff_seconds(self, key: str) -> float:
+        strikes = self.redis.incr(f"{key}:strikes")
+        self.redis.expire(f"{key}:strikes", int(config.GRAPH_BACKOFF_MAX_SECONDS) * 2)
+        return min(config.GRAPH_BACKOFF_BASE_SECONDS * (2 ** (strikes - 1)), config.GRAPH_BACKOFF_MAX_SECONDS)
+
+    def observe(self, access_token: Optional[str], headers, result: Any):
+        """อัพเดท bucket จาก usage headers และ error code ของ response"""
+        if not self.enabled:
+            return
+        try:
+            usage = parse_usage_headers(headers)
+            page_key = self.page_key(access_token) if access_token else None
+            pipe = self.redis.pipeline()
+
+            for key, percent in ((self.app_key(), usage["app"]), (page_key, usage["page"])):
+                if key is None or percent is None:
+                    continue
+                pipe.hset(key, "factor", self._factor_for(percent))
+                if percent >= config.GRAPH_USAGE_BLOCK_AT:
+                    seconds = usage["regain_seconds"] or config.GRAPH_BACKOFF_BASE_SECONDS
+                    self._block(pipe, key, seconds)
+                    logger.warning(f"🚦 Graph usage {percent}% on {key}, pausing {seconds}s")
+
+            error = result.get("error") if isinstance(result, dict) else None
+            code = error.get("code") if isinstance(error, dict) else None
+            if code in APP_LIMIT_CODES:
+                seconds = max(self._backoff_seconds(self.app_key()), usage["regain_seconds"])
+                self._block(pipe, self.app_key(), seconds)
+                logger.warning(f"🚦 Graph app rate limit (code {code}), backing off {seconds}s")
+            if code in PAGE_LIMIT_CODES and page_key:
+                seconds = max(self._backoff_seconds(page_key), usage["regain_seconds"])
+                self._block(pipe, page_key, seconds)
+                logger.warning(f"🚦 Graph page rate limit (code {code}), backing off {seconds}s")
+
+            pipe.execute()
+        except redis.RedisError as e:
+            logger.warning(f"⚠️ Rate limiter unavailable, skipping: {e}")
+        except Exception as e:
+            # ห้ามทำให้ request ที่สำเร็จแล้วล้มเพราะอ่าน feedback ไม่ได้
+            logger.warning(f"⚠️ Cannot apply Graph rate limit feedback: {e}")
+
+
+def rate_limited_error(wait_seconds: float) -> Dict[str, Any]:
+    """error ที่คืนแทนการเรียก Facebook เมื่อต้องรอนานเกิน GRAPH_RATE_MAX_WAIT"""
+    return {
+        "error": {
+            "message": f"Graph API calls paused by rate limiter, retry after {wait_seconds:.0f}s",
+            "type": "GraphRateLimited",
+            "code": -3,
+            "retry_after": wait_seconds,
+        }
+    }
+
+
+# สร้าง instance กลาง
+graph_rate_limiter = GraphRateLimiter()
@@ -1,35 +1,46 @@
 import asyncio
 from datetime import datetime, timedelta
-from typing import Dict, List, Any, Set
+from typing import Dict, List, Any, Set, Tuple
+import calendar
+import heapq
+import time
 import logging
-from app.service.facebook_api import send_message, send_image_binary_from_db, send_video_binary
+from app.service.facebook_api import async_fb_get
+from app.service.broadcast_sender import broadcast_sender
 from app.database import crud
 from sqlalchemy.orm import Session
 from app.database.database import SessionLocal
 import json
-from app.routes.facebook.sse import send_customer_type_update
+from app.service.sse_hub import publish
 from app.database import models
 from app.utils.redis_helper import get_page_token
+from app.service.schedule_store import schedule_store, is_knowledge_schedule, initial_run_at
+from app import config
+import pytz
 
 logger = logging.getLogger(__name__)
 
+bangkok_tz = pytz.timezone('Asia/Bangkok')
+
 class MessageScheduler:
+    """
+    ตัวส่งข้อความตาม schedule
+    state ทั้งหมดอยู่ใน schedule_store (Postgres + Redis) จึงรันหลาย instance พร้อมกันได้
+    แต่ละ instance claim schedule ที่ถึงเวลาด้วย lease ทำให้ไม่ส่งซ้ำ
+    """
     def __init__(self):
-        self.active_schedules: Dict[str, List[Dict[str, Any]]] = {}
         self.is_running = False
         self.page_tokens = {}
-        # แยก tracking สำหรับแต่ละประเภท
-        self.sent_tracking: Dict[str, Set[str]] = {}
-        self.last_check_time: Dict[int, datetime] = {}
-        self.user_inactivity_data: Dict[str, Dict[str, Any]] = {}
-        
-        # แยก schedules ตามประเภท
-        self.user_group_schedules: Dict[str, List[Dict[str, Any]]] = {}
-        self.knowledge_group_schedules: Dict[str, List[Dict[str, Any]]] = {}
+        self.store = schedule_store
         
-        # แยก tasks สำหรับแต่ละประเภท
-        self.user_group_task = None
-        self.knowledge_group_task = None
+        # min-heap ของ (next_run_at, row_id) สำหรับ dispatcher
+        self._heap: List[Tuple[datetime, int]] = []
+        self._last_resync = 0.0
+        self._resync_requested = True
+        self._loop = None
+        self._wakeup = None
+        self._running_tasks: Set[asyncio.Task] = set()
+        self.dispatch_task = None
     
     def set_page_tokens(self, tokens: Dict[str, str]):
         """อัพเดท page tokens"""
@@ -37,151 +48,187 @@ class MessageScheduler:
         logger.info(f"Updated page tokens for {len(tokens)} pages")
     
     def update_user_inactivity_data(self, page_id: str, user_data: List[Dict[str, Any]]):
-        """อัพเดทข้อมูลระยะเวลาที่หายไปของ users จาก frontend"""
-        if page_id not in self.user_inactivity_data:
-            self.user_inactivity_data[page_id] = {}
-        
+        """อัพเดท last_interaction_at ของ users จากข้อมูลที่ frontend ส่งมา"""
+        now = datetime.now(bangkok_tz)
+        last_interactions = {}
         for data in user_data:
             user_id = data.get('user_id')
+            if not user_id:
+                continue
             last_message_time = data.get('last_message_time')
-            inactivity_minutes = data.get('inactivity_minutes', 0)
-            
-            if user_id:
-                self.user_inactivity_data[page_id][user_id] = {
-                    'last_message_time': last_message_time,
-                    'inactivity_minutes': inactivity_minutes,
-                    'updated_at': datetime.now()
-                }
+            try:
+                last_time = datetime.fromisoformat(str(last_message_time).replace('Z', '+00:00')) if last_message_time else None
+            except ValueError:
+                last_time = None
+            if last_time is None:
+                last_time = now - timedelta(minutes=float(data.get('inactivity_minutes', 0) or 0))
+            elif last_time.tzinfo is None:
+                last_time = bangkok_tz.localize(last_time)
+            last_interactions[user_id] = last_time
         
-        logger.info(f"Updated inactivity data for {len(user_data)} users on page {page_id}")
+        updated = self.store.apply_last_interactions(page_id, last_interactions)
+        logger.info(f"Updated inactivity data for {len(user_data)} users on page {page_id} ({updated} changed)")
     
-    def add_schedule(self, page_id: str, schedule: Dict[str, Any]):
-        """เพิ่ม schedule เข้าระบบโดยแยกตามประเภท"""
-        if page_id not in self.active_schedules:
-            self.active_schedules[page_id] = []
-            self.user_group_schedules[page_id] = []
-            self.knowledge_group_schedules[page_id] = []
-        
-        # ตรวจสอบประเภทของ schedule
-        groups = schedule.get('groups', [])
-        is_knowledge_group = any(str(g).startswith('knowledge_') for g in groups)
-        
-        # ตรวจสอบว่ามี schedule นี้อยู่แล้วหรือไม่
-        existing = next((s for s in self.active_schedules[page_id] if s['id'] == schedule['id']), None)
-        if existing:
-            # อัพเดท schedule ที่มีอยู่
-            existing.update(schedule)
-            # อัพเดทใน list ที่แยกตามประเภทด้วย
-            if is_knowledge_group:
-                for s in self.knowledge_group_schedules[page_id]:
-                    if s['id'] == schedule['id']:
-                        s.update(schedule)
-                        break
-            else:
-                for s in self.user_group_schedules[page_id]:
-                    if s['id'] == schedule['id']:
-                        s.update(schedule)
-                        break
-        else:
-            # เพิ่ม schedule ใหม่
-            schedule['activated_at'] = datetime.now().isoformat()
-            self.active_schedules[page_id].append(schedule)
-            
-            # เพิ่มเข้า list ที่แยกตามประเภท
-            if is_knowledge_group:
-                self.knowledge_group_schedules[page_id].append(schedule)
-                logger.info(f"Added KNOWLEDGE schedule {schedule['id']} for page {page_id}")
-            else:
-                self.user_group_schedules[page_id].append(schedule)
-                logger.info(f"Added USER schedule {schedule['id']} for page {page_id}")
-            
-            # เริ่ม tracking สำหรับ schedule ใหม่
-            self.sent_tracking[str(schedule['id'])] = set()
+    def add_schedule(self, page_id: str, schedule: Dict[str, Any], hold_lease: bool = False) -> Dict[str, Any]:
+        """เพิ่ม/อัพเดท schedule ลงฐานข้อมูล คืน schedule พร้อม _row_id"""
+        stored = self.store.upsert(page_id, schedule, hold_lease=hold_lease)
+        kind = "KNOWLEDGE" if is_knowledge_schedule(schedule) else "USER"
+        logger.info(f"Added {kind} schedule {schedule['id']} for page {page_id}")
+        self.notify_schedules_changed()
+        return stored
     
-    def remove_schedule(self, page_id: str, schedule_id: int):
-        """ลบ schedule ออกจากระบบ"""
-        if page_id in self.active_schedules:
-            # ลบจาก active schedules
-            self.active_schedules[page_id] = [
-                s for s in self.active_schedules[page_id] if s['id'] != schedule_id
-            ]
-            
-            # ลบจาก user group schedules
-            self.user_group_schedules[page_id] = [
-                s for s in self.user_group_schedules.get(page_id, []) if s['id'] != schedule_id
-            ]
-            
-            # ลบจาก knowledge group schedules
-            self.knowledge_group_schedules[page_id] = [
-                s for s in self.knowledge_group_schedules.get(page_id, []) if s['id'] != schedule_id
-            ]
-            
-            # ลบ tracking data
-            self.sent_tracking.pop(str(schedule_id), None)
-            self.last_check_time.pop(schedule_id, None)
+    def remove_schedule(self, page_id: str, schedule_id: Any):
+        """ลบ schedule ออกจากระบบ (deliveries ถูกลบตามด้วย cascade)"""
+        if self.store.remove(page_id, schedule_id):
             logger.info(f"Removed schedule {schedule_id} for page {page_id}")
+            self.notify_schedules_changed()
+    
+    def remove_schedules_for_group(self, page_id: str, group_id: str) -> List[Any]:
+        """ลบทุก schedule ของเพจที่ส่งหา group นี้ คืน id ของ schedules ที่ลบ"""
+        removed = []
+        for schedule in self.get_active_schedules_for_page(page_id):
+            if group_id in schedule.get('groups', []):
+                self.remove_schedule(page_id, schedule['id'])
+                removed.append(schedule['id'])
+        return removed
+    
+    def reset_tracking(self, page_id: str, schedule_id: Any) -> int:
+        """ล้างรายชื่อ users ที่ส่งไปแล้วของ schedule"""
+        return self.store.reset_tracking(page_id=page_id, schedule_key=schedule_id)
+    
+    def notify_schedules_changed(self):
+        """ปลุก dispatcher ให้โหลด heap ใหม่ (เรียกได้จากทุก thread)"""
+        self._resync_requested = True
+        if self._loop and self._wakeup and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._wakeup.set)
     
     async def start_schedule_monitoring(self):
-        """เริ่มระบบตรวจสอบ schedule แบบแยก tasks"""
+        """เริ่ม dispatcher ที่หลับจนกว่า schedule ถัดไปจะถึงเวลา"""
         self.is_running = True
-        logger.info("Message scheduler started with separate tasks")
-        
-        # สร้าง tasks แยกสำหรับแต่ละประเภท
-        self.user_group_task = asyncio.create_task(self.monitor_user_groups())
-        self.knowledge_group_task = asyncio.create_task(self.monitor_knowledge_groups())
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        logger.info(f"Message scheduler started (owner={self.store.owner})")
         
-        # รอให้ทั้งสอง tasks ทำงาน
+        self.dispatch_task = asyncio.create_task(self.dispatch_loop())
         try:
-            await asyncio.gather(self.user_group_task, self.knowledge_group_task)
+            await self.dispatch_task
+        except asyncio.CancelledError:
+            pass
         except Exception as e:
             logger.error(f"Error in schedule monitoring: {e}")
     
-    async def monitor_user_groups(self):
-        """Monitor เฉพาะ User Group schedules"""
-        logger.info("🟦 User Groups Monitor started")
+    def _rebuild_heap(self):
+        """โหลด schedules ที่ใกล้ถึงเวลาที่สุดจากฐานข้อมูลมาเป็น min-heap"""
+        self._heap = list(self.store.upcoming())
+        heapq.heapify(self._heap)
+        self._resync_requested = False
+        self._last_resync = time.monotonic()
+    
+    async def dispatch_loop(self):
+        """
+        วน loop ตาม min-heap ของ (next_run_at, row_id)
+        - หลับจนถึงเวลาของ schedule แรกใน heap หรือจนกว่าจะถูกปลุก / ถึงรอบ resync
+        - งานต่อรอบขึ้นกับจำนวน schedule ที่ถึงเวลา ไม่ใช่จำนวน schedule ทั้งหมด
+        - resync เป็นระยะเพื่อรับ schedule ที่ instance อื่นเพิ่มหรือเลื่อนเวลา
+        """
         while self.is_running:
             try:
-                current_time = datetime.now()
-                logger.debug(f"🟦 Checking User Group schedules at {current_time}")
+                if self._resync_requested or time.monotonic() - self._last_resync >= config.SCHEDULE_RESYNC_SECONDS:
+                    self._rebuild_heap()
+                
+                now = datetime.now(bangkok_tz)
+                due_ids = []
+                while self._heap and self._heap[0][0] <= now:
+                    due_ids.append(heapq.heappop(self._heap)[1])
                 
-                for page_id, schedules in self.user_group_schedules.items():
-                    for schedule in schedules:
-                        try:
-                            await self.check_schedule(page_id, schedule, current_time, "USER")
-                        except Exception as e:
-                            logger.error(f"Error checking user schedule {schedule['id']}: {e}")
+                if due_ids:
+                    # row ที่ถูก instance อื่น claim ไปแล้วหรือถูกเลื่อนเวลาจะไม่ถูกคืนมา
+                    for schedule in self.store.claim_ids(due_ids):
+                        group_type = "KNOWLEDGE" if schedule['_is_knowledge'] else "USER"
+                        task = asyncio.create_task(self._run_and_requeue(schedule, group_type))
+                        self._running_tasks.add(task)
+                        task.add_done_callback(self._running_tasks.discard)
+                    continue
                 
-                # User groups check ทุก 30 วินาที
-                await asyncio.sleep(30)
+                timeout = config.SCHEDULE_RESYNC_SECONDS - (time.monotonic() - self._last_resync)
+                if self._heap:
+                    timeout = min(timeout, (self._heap[0][0] - now).total_seconds())
                 
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=max(timeout, 0.01))
+                except asyncio.TimeoutError:
+                    pass
+                
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
-                logger.error(f"Error in user group monitoring: {e}")
-                await asyncio.sleep(30)
+                logger.error(f"Error in schedule dispatch: {e}")
+                await asyncio.sleep(config.SCHEDULE_RETRY_SECONDS)
+                self._resync_requested = True
     
-    async def monitor_knowledge_groups(self):
-        """Monitor เฉพาะ Knowledge Group schedules"""
-        logger.info("🟩 Knowledge Groups Monitor started")
-        while self.is_running:
+    async def _run_and_requeue(self, schedule: Dict[str, Any], group_type: str):
+        next_run_at = await self.run_claimed_schedule(schedule, group_type)
+        if next_run_at is not None:
+            heapq.heappush(self._heap, (next_run_at, schedule['_row_id']))
+            self._wakeup.set()
+    
+    async def _renew_lease_periodically(self, row_id: int):
+        """ต่ออายุ lease ระหว่างประมวลผล (broadcast อาจนานกว่า SCHEDULE_LEASE_SECONDS)"""
+        interval = max(config.SCHEDULE_LEASE_SECONDS / 3, 1)
+        while True:
+            await asyncio.sleep(interval)
             try:
-                current_time = datetime.now()
-                logger.debug(f"🟩 Checking Knowledge Group schedules at {current_time}")
-                
-                for page_id, schedules in self.knowledge_group_schedules.items():
-                    for schedule in schedules:
-                        try:
-                            await self.check_schedule(page_id, schedule, current_time, "KNOWLEDGE")
-                        except Exception as e:
-                            logger.error(f"Error checking knowledge schedule {schedule['id']}: {e}")
-                
-                # Knowledge groups check ทุก 30 วินาที (หรือปรับตามต้องการ)
-                await asyncio.sleep(30)
-                
+                if not await asyncio.to_thread(self.store.renew_lease, row_id):
+                    logger.warning(f"Lost lease on schedule row {row_id}")
+                    return
             except Exception as e:
-                logger.error(f"Error in knowledge group monitoring: {e}")
-                await asyncio.sleep(30)
+                logger.error(f"Error renewing lease on schedule row {row_id}: {e}")
+    
+    async def _run_with_lease(self, row_id: int, coro):
+        heartbeat = asyncio.create_task(self._renew_lease_periodically(row_id))
+        try:
+            return await coro
+        finally:
+            heartbeat.cancel()
+    
+    async def run_immediate(self, page_id: str, schedule: Dict[str, Any]):
+        """ส่ง immediate schedule ทันที (schedule ต้องถูกเพิ่มด้วย hold_lease=True)"""
+        try:
+            await self._run_with_lease(
+                schedule['_row_id'], self.process_schedule(page_id, schedule, "IMMEDIATE")
+            )
+        finally:
+            self.store.release(schedule['_row_id'], None, sent_at=datetime.now(bangkok_tz))
+    
+    async def run_claimed_schedule(self, schedule: Dict[str, Any], group_type: str = ""):
+        """ประมวลผล schedule ที่ claim มาแล้ว ปล่อย lease และคืนเวลาทำงานครั้งถัดไป"""
+        page_id = schedule['_page_id']
+        row_id = schedule['_row_id']
+        current_time = datetime.now(bangkok_tz)
+        try:
+            interrupted = self.store.fail_interrupted(row_id)
+            if interrupted:
+                logger.warning(f"[{group_type}] {interrupted} deliveries of schedule {schedule.get('id')} were interrupted by a previous run")
+            next_run_at, sent_at = await self._run_with_lease(
+                row_id, self.check_schedule(page_id, schedule, current_time, group_type)
+            )
+        except Exception as e:
+            logger.error(f"[{group_type}] Error checking schedule {schedule.get('id')}: {e}")
+            next_run_at, sent_at = current_time + timedelta(seconds=config.SCHEDULE_RETRY_SECONDS), None
+        
+        if next_run_at is None and schedule.get('type') == 'scheduled':
+            # ส่งครั้งเดียว / เกินวันสิ้นสุด → ลบออกจากระบบ
+            self.store.remove_by_row(row_id)
+            return None
+        self.store.release(row_id, next_run_at, payload=schedule, sent_at=sent_at)
+        return next_run_at
     
     async def check_schedule(self, page_id: str, schedule: Dict[str, Any], current_time: datetime, group_type: str = ""):
-        """ตรวจสอบแต่ละ schedule พร้อมแสดงประเภท"""
+        """
+        ตรวจสอบแต่ละ schedule พร้อมแสดงประเภท
+        คืน (เวลาทำงานครั้งถัดไป, เวลาที่ส่ง)
+        """
         schedule_type = schedule.get('type')
         schedule_id = str(schedule['id'])
         
@@ -189,61 +236,35 @@ class MessageScheduler:
         logger.debug(f"[{group_type}] Checking schedule {schedule_id} type: {schedule_type}")
         
         if schedule_type == 'immediate':
-            # ส่งทันทีถ้ายังไม่เคยส่ง
-            if not schedule.get('sent'):
-                await self.process_schedule(page_id, schedule, group_type)
-                schedule['sent'] = True
+            # ส่งครั้งเดียว (recipients ที่ส่งแล้วถูกกรองด้วย schedule_deliveries)
+            await self.process_schedule(page_id, schedule, group_type)
+            return None, current_time
                 
         elif schedule_type == 'scheduled':
-            await self.check_scheduled_time(page_id, schedule, current_time, group_type)
-            
-        elif schedule_type == 'user-inactive':
-            # ป้องกันการตรวจสอบถี่เกินไป - ตรวจสอบทุก 30 วินาที
-            last_check = self.last_check_time.get(schedule['id'])
-            if last_check and (current_time - last_check).seconds < 30:
-                return
-
-            self.last_check_time[schedule['id']] = current_time
-            await self.check_user_inactivity_v2(page_id, schedule, group_type)
-    
-    async def check_scheduled_time(self, page_id: str, schedule: Dict[str, Any], current_time: datetime, group_type: str = ""):
-        """ตรวจสอบการส่งตามเวลาที่กำหนด"""
-        schedule_date = schedule.get('date')
-        schedule_time = schedule.get('time')
-        
-        if not schedule_date or not schedule_time:
-            return
+            due_at = schedule.get('_due_at')
+            if due_at and (current_time - due_at).total_seconds() > config.SCHEDULE_MISFIRE_GRACE_SECONDS:
+                # ระบบหยุดไปนานเกินไป ข้ามรอบนี้แล้วไปรอบถัดไป
+                logger.warning(f"[{group_type}] Skipping schedule {schedule_id} missed at {due_at}")
+                return await self.handle_repeat(page_id, schedule, current_time), None
             
-        # แปลงเป็น datetime
-        schedule_datetime = datetime.strptime(f"{schedule_date} {schedule_time}", "%Y-%m-%d %H:%M")
-        
-        # ตรวจสอบว่าเวลาปัจจุบันอยู่ในช่วงเวลาที่กำหนด
-        time_diff = abs((current_time - schedule_datetime).total_seconds())
-        
-        if time_diff <= 30:  # ถ้าอยู่ในช่วง 30 วินาทีของเวลาที่กำหนด
-            # ตรวจสอบว่าส่งไปแล้วหรือยัง
-            last_sent = schedule.get('last_sent')
-            if last_sent:
-                try:
-                    last_sent_time = datetime.fromisoformat(last_sent)
-                    if (current_time - last_sent_time).total_seconds() < 3600:  # ส่งไปแล้วในชั่วโมงที่ผ่านมา
-                        return
-                except:
-                    pass
-                    
             logger.info(f"[{group_type}] Processing scheduled message for page {page_id} at {current_time}")
-            
-            # ส่งข้อความ
             await self.process_schedule(page_id, schedule, group_type)
             
-            # อัพเดทเวลาที่ส่งล่าสุด
-            schedule['last_sent'] = current_time.isoformat()
-            
             # ตรวจสอบการทำซ้ำ
-            await self.handle_repeat(page_id, schedule, current_time)
+            return await self.handle_repeat(page_id, schedule, current_time), current_time
+            
+        elif schedule_type == 'user-inactive':
+            sent = await self.check_user_inactivity_v2(page_id, schedule, group_type)
+            next_check = current_time + timedelta(seconds=config.SCHEDULE_INACTIVITY_CHECK_SECONDS)
+            return next_check, current_time if sent else None
+        
+        return None, None
     
     async def check_user_inactivity_v2(self, page_id: str, schedule: Dict[str, Any], group_type: str = ""):
-        """ตรวจสอบ user ที่หายไปโดยใช้ข้อมูลจาก frontend พร้อมแสดงประเภท"""
+        """
+        ตรวจสอบ user ที่หายไปจาก fb_customers.last_interaction_at พร้อมแสดงประเภท
+        ใช้ query เดียว (ไม่ต้องพึ่งข้อมูลจาก browser)
+        """
         try:
             inactivity_period = int(schedule.get('inactivityPeriod', 1))
             inactivity_unit = schedule.get('inactivityUnit', 'days')
@@ -264,86 +285,52 @@ class MessageScheduler:
 
             logger.info(f"[{group_type}] Checking inactivity for schedule {schedule_id}: target={target_minutes} minutes")
 
-            # ดึงข้อมูล inactivity ของ page นี้
-            page_inactivity_data = self.user_inactivity_data.get(page_id, {})
-            if not page_inactivity_data:
-                logger.warning(f"[{group_type}] No inactivity data for page {page_id}")
-                await self.update_inactivity_from_conversations(page_id)
-                page_inactivity_data = self.user_inactivity_data.get(page_id, {})
-
             # ดึง access token
             access_token = get_page_token(page_id)
             if not access_token:
                 logger.warning(f"No access token for page {page_id}")
-                return
+                return False
 
-            # 🔥 เพิ่มการตรวจสอบ users ที่อยู่ในกลุ่ม knowledge
             db = SessionLocal()
             try:
                 # หา page record
-                page = crud.get_page_by_page_id(db, page_id)
+                page = crud.get_page_ref(db, page_id)
                 if not page:
                     logger.error(f"Page {page_id} not found")
-                    return
-
-                # ตรวจสอบว่าเป็น knowledge group หรือไม่
-                knowledge_group_ids = []
-                for group_id in groups:
-                    if str(group_id).startswith('knowledge_'):
-                        knowledge_id = int(str(group_id).replace('knowledge_', ''))
-                        knowledge_group_ids.append(knowledge_id)
-
-                inactive_users = []
-                sent_users = self.sent_tracking.get(schedule_id, set())
-
-                # ตรวจสอบแต่ละ user
-                for user_id, user_data in page_inactivity_data.items():
-                    # ตรวจสอบว่าเคยส่งให้ user นี้แล้วหรือยัง
-                    if user_id in sent_users:
-                        continue
-
-                    # ดึงระยะเวลาที่หายไป (เป็นนาที)
-                    user_inactivity_minutes = user_data.get('inactivity_minutes', 0)
-
-                    # ตรวจสอบว่าอยู่ในช่วงที่ตรงกับเงื่อนไข
-                    tolerance = target_minutes * 0.02  # 2% ของเป้าหมาย
-                    min_tolerance = max(0.2, tolerance)
-                    
-                    lower_bound = target_minutes - min_tolerance
-                    upper_bound = target_minutes + min_tolerance
-                    
-                    if lower_bound <= user_inactivity_minutes <= upper_bound:
-                        # 🔥 ถ้าเป็น knowledge group ต้องตรวจสอบว่า user อยู่ในกลุ่มหรือไม่
-                        if knowledge_group_ids:
-                            customer = crud.get_customer_by_psid(db, page.ID, user_id)
-                            if not customer:
-                                logger.debug(f"[{group_type}] User {user_id} not found in database")
-                                continue
-                            
-                            # ตรวจสอบว่า customer อยู่ใน knowledge group ที่ต้องการหรือไม่
-                            if not customer.current_category_id or customer.current_category_id not in knowledge_group_ids:
-                                logger.info(f"[{group_type}] User {user_id} not in knowledge group {knowledge_group_ids}, skipping")
-                                continue
-                            
-                            logger.info(f"[{group_type}] User {user_id} is in knowledge group {customer.current_category_id}")
-                        
-                        inactive_users.append(user_id)
-                        logger.info(f"[{group_type}] User {user_id} matches: {user_inactivity_minutes} min (target: {target_minutes}±{min_tolerance})")
-
-                # ส่งข้อความให้ users ที่ตรงเงื่อนไข
-                if inactive_users:
-                    logger.info(f"[{group_type}] Found {len(inactive_users)} inactive users for schedule {schedule['id']}")
-                    await self.send_messages_to_users(page_id, inactive_users, schedule['messages'], access_token, schedule, group_type)
-
-                    # เพิ่ม users ที่ส่งแล้วเข้า tracking
-                    self.sent_tracking[schedule_id].update(inactive_users)
-                    schedule['last_sent'] = datetime.now().isoformat()
-
+                    return False
+                page_db_id = page.ID
             finally:
                 db.close()
 
+            # ตรวจสอบว่าเป็น knowledge group หรือไม่
+            knowledge_group_ids = [
+                int(str(group_id).replace('knowledge_', ''))
+                for group_id in groups if str(group_id).startswith('knowledge_')
+            ]
+
+            # ช่วงเวลาที่ตรงเงื่อนไข: เผื่อ 2% ของเป้าหมาย และเผื่อไปข้างหลังอย่างน้อย 2 รอบการตรวจ
+            # เพื่อไม่ให้หลุด user ที่เลยเป้าหมายไประหว่างรอบ (คนที่ส่งแล้วถูกกรองด้วย schedule_deliveries)
+            target_seconds = target_minutes * 60
+            tolerance = max(12, target_seconds * 0.02)
+            catch_up = max(tolerance, 2 * config.SCHEDULE_INACTIVITY_CHECK_SECONDS)
+
+            inactive_users = self.store.find_inactive_recipients(
+                schedule['_row_id'], page_db_id,
+                min_seconds=target_seconds - tolerance,
+                max_seconds=target_seconds + catch_up,
+                knowledge_ids=knowledge_group_ids
+            )
+
+            # ส่งข้อความให้ users ที่ตรงเงื่อนไข
+            if inactive_users:
+                logger.info(f"[{group_type}] Found {len(inactive_users)} inactive users for schedule {schedule['id']}")
+                report = await self.deliver(page_id, schedule, inactive_users, access_token, group_type)
+                return bool(report and report.results)
+            return False
+
         except Exception as e:
             logger.error(f"[{group_type}] Error checking user inactivity: {e}")
+            return False
     
     async def process_schedule(self, page_id: str, schedule: Dict[str, Any], group_type: str = ""):
         """ประมวลผลและส่งข้อความตาม schedule พร้อมแสดงประเภท"""
@@ -375,7 +362,7 @@ class MessageScheduler:
             if knowledge_group_ids:
                 db = SessionLocal()
                 try:
-                    page = crud.get_page_by_page_id(db, page_id)
+                    page = crud.get_page_ref(db, page_id)
                     if not page:
                         logger.error(f"Page {page_id} not found")
                         return
@@ -393,281 +380,232 @@ class MessageScheduler:
                     db.close()
             else:
                 # กรณีเดิม - ดึงจาก conversations
-                from app.service.facebook_api import fb_get
-                
                 endpoint = f"{page_id}/conversations"
                 params = {
                     "fields": "participants,updated_time,id",
                     "limit": 100
                 }
                 
-                conversations = fb_get(endpoint, params, access_token)
+                conversations = await async_fb_get(endpoint, params, access_token)
                 if "error" in conversations:
                     logger.error(f"Error getting conversations: {conversations['error']}")
                     return
                     
                 # รวบรวม PSIDs ทั้งหมด
                 all_psids = []
-                sent_users = self.sent_tracking.get(schedule_id, set())
                 
                 for conv in conversations.get('data', []):
                     participants = conv.get('participants', {}).get('data', [])
                     for participant in participants:
                         user_id = participant.get('id')
-                        if user_id and user_id != page_id and user_id not in sent_users:
+                        if user_id and user_id != page_id:
                             all_psids.append(user_id)
             
-            # กรอง users ที่ส่งแล้ว
-            sent_users = self.sent_tracking.get(schedule_id, set())
-            filtered_psids = [psid for psid in all_psids if psid not in sent_users]
-            
-            if filtered_psids:
-                logger.info(f"[{group_type}] Sending messages to {len(filtered_psids)} users")
-                await self.send_messages_to_users(page_id, filtered_psids, messages, access_token, schedule, group_type)
-                self.sent_tracking[schedule_id].update(filtered_psids)
-            else:
+            # กรอง users ที่ส่งแล้ว (จองใน schedule_deliveries) แล้วส่ง
+            report = await self.deliver(page_id, schedule, all_psids, access_token, group_type)
+            if not report or not report.results:
                 logger.warning(f"[{group_type}] No users found to send messages")
             
         except Exception as e:
             logger.error(f"[{group_type}] Error processing schedule: {e}")
     
+    async def deliver(self, page_id: str, schedule: Dict[str, Any], psids: List[str],
+                      access_token: str, group_type: str = ""):
+        """จอง recipients ที่ยังไม่เคยได้รับ schedule นี้ ส่งข้อความ แล้วบันทึกผลราย user"""
+        row_id = schedule['_row_id']
+        recipients = self.store.claim_recipients(row_id, psids)
+        if not recipients:
+            return None
+        
+        logger.info(f"[{group_type}] Sending messages to {len(recipients)} users")
+        report = await self.send_messages_to_users(
+            page_id, recipients, schedule.get('messages', []), access_token, schedule, group_type
+        )
+        self.store.record_results(row_id, report.results)
+        return report
+    
     async def send_messages_to_users(self, page_id: str, psids: List[str], messages: List[Dict], 
                                 access_token: str, schedule: Dict[str, Any] = None, group_type: str = ""):
-        """ส่งข้อความไปยัง users พร้อมอัพเดท customer type (knowledge/custom)"""
-        success_count = 0
-        fail_count = 0
-
+        """ส่งข้อความไปยัง users แบบขนาน พร้อมอัพเดท customer type (knowledge/custom) ของคนที่ส่งสำเร็จ"""
         logger.info(f"[{group_type}] Starting to send messages to {len(psids)} users")
 
-        db = SessionLocal()
+        report = await broadcast_sender.broadcast(
+            page_id, psids, messages, access_token, log_prefix=f"[{group_type}]"
+        )
+
+        if report.succeeded and schedule and schedule.get('groups'):
+            await self.apply_group_to_customers(page_id, report.succeeded, schedule['groups'][0], group_type)
 
+        logger.info(f"[{group_type}] Sent messages complete: {len(report.succeeded)} success, {len(report.failed)} failed")
+        return report
+
+    async def apply_group_to_customers(self, page_id: str, psids: List[str], group_id: Any, group_type: str = ""):
+        """อัพเดทกลุ่มของ customers ที่ส่งข้อความสำเร็จ (ทำทีเดียวทั้งชุด) แล้วส่ง SSE"""
+        if str(group_id).startswith('default_'):
+            return
+        # งาน DB และ Redis เป็นแบบ sync จึงย้ายไปทำใน thread ไม่ให้บล็อก event loop
+        await asyncio.to_thread(self._apply_group_sync, page_id, psids, group_id, group_type)
+
+    def _apply_group_sync(self, page_id: str, psids: List[str], group_id: Any, group_type: str):
+        db = SessionLocal()
         try:
-            page = crud.get_page_by_page_id(db, page_id)
+            page = crud.get_page_ref(db, page_id)
             if not page:
                 logger.error(f"Page {page_id} not found in database")
                 return
 
-            for psid in psids:
-                try:
-                    # ส่งข้อความ
-                    for message in sorted(messages, key=lambda x: x.get('order', 0)):
-                        message_type = message.get('type', 'text')
-                        content = message.get('content', '')
-                        logger.info(f"[{group_type}] Sending {message_type} message to {psid}")
-
-                        if message_type == 'text':
-                            result = send_message(psid, content, access_token)
-                        elif message_type == 'image':
-                            from app.config import image_dir
-                            clean_content = content.replace('[IMAGE] ', '')
-                            image_path = f"{image_dir}/{clean_content}"
-                            result = send_image_binary_from_db(psid, image_path, access_token)
-                        elif message_type == 'video':
-                            from app.config import vid_dir
-                            clean_content = content.replace('[VIDEO] ', '')
-                            video_path = f"{vid_dir}/{clean_content}"
-                            result = send_video_binary(psid, video_path, access_token)
-                        else:
-                            continue
-
-                        if 'error' in result:
-                            logger.error(f"[{group_type}] Error sending message to {psid}: {result}")
-                            fail_count += 1
-                            break
-                        else:
-                            logger.info(f"[{group_type}] Successfully sent message to {psid}")
-                            await asyncio.sleep(0.5)
-
-                    # อัพเดท customer type ถ้าส่งสำเร็จ
-                    if schedule and 'groups' in schedule and len(schedule['groups']) > 0:
-                        group_id = schedule['groups'][0]
-
-                        # ✅ Knowledge group
-                        if str(group_id).startswith('knowledge_'):
-                            try:
-                                knowledge_id = int(str(group_id).replace('knowledge_', ''))
-                                customer = crud.get_customer_by_psid(db, page.ID, psid)
-                                if customer:
-                                    # อัพเดท current_category_id ของ FbCustomer
-                                    customer.current_category_id = knowledge_id
-                                    customer.updated_at = datetime.now()
-                                    db.commit()
-                                    db.refresh(customer)
-                                    logger.info(f"[{group_type}] ✅ Updated customer {psid} to knowledge group {knowledge_id}")
-
-                                    # ส่ง SSE update
-                                    knowledge_type = db.query(models.CustomerTypeKnowledge).filter(
-                                        models.CustomerTypeKnowledge.id == knowledge_id
-                                    ).first()
-                                    if knowledge_type:
-                                        from app.routes.facebook.sse import send_customer_type_update
-                                        await send_customer_type_update(
-                                            page_id=page_id,
-                                            psid=psid,
-                                            customer_type_knowledge_id=knowledge_id,  
-                                            customer_type_knowledge_name=knowledge_type.type_name
-                                        )
-                                        logger.info(f"[{group_type}] 📡 Sent SSE update for knowledge type: {knowledge_type.type_name}")
-
-                            except Exception as e:
-                                logger.error(f"[{group_type}] ❌ Error updating customer knowledge type: {e}")
-                                db.rollback()
+            # ดึงเป็น tuple (id, psid) ก่อน commit จะได้ไม่ต้อง SELECT ซ้ำรายคนหลัง commit
+            customers = db.query(models.FbCustomer.id, models.FbCustomer.customer_psid).filter(
+                models.FbCustomer.page_id == page.ID,
+                models.FbCustomer.customer_psid.in_(psids)
+            ).all()
+            if not customers:
+                return
 
-                        # ✅ Custom group
-                        elif not str(group_id).startswith('default_'):
-                            try:
-                                customer = crud.get_customer_by_psid(db, page.ID, psid)
-                                if customer:
-                                    group_id_int = int(group_id) if isinstance(group_id, str) else group_id
-                                    custom_group = db.query(models.CustomerTypeCustom).filter(
-                                        models.CustomerTypeCustom.id == group_id_int
-                                    ).first()
-                                    if custom_group:
-                                        # ➡️ Insert new record into FBCustomerCustomClassification
-                                        new_classification = models.FBCustomerCustomClassification(
-                                            customer_id=customer.id,
-                                            old_category_id=None,  # หรือใส่ group เดิมถ้ามี logic
-                                            new_category_id=group_id_int,
-                                            page_id=page.ID,
-                                            classified_by="system"
-                                        )
-                                        db.add(new_classification)
-                                        customer.updated_at = datetime.now()
-                                        db.commit()
-                                        db.refresh(customer)
+            customer_ids = [customer_id for customer_id, _ in customers]
+            now = datetime.now()
+            timestamp = now.isoformat()
 
-                                        logger.info(f"[{group_type}] ✅ Inserted classification for customer {psid} into custom group {group_id_int}")
+            # ✅ Knowledge group
+            if str(group_id).startswith('knowledge_'):
+                try:
+                    knowledge_id = int(str(group_id).replace('knowledge_', ''))
+                    knowledge_type = db.query(models.CustomerTypeKnowledge.type_name).filter(
+                        models.CustomerTypeKnowledge.id == knowledge_id
+                    ).first()
+                    db.query(models.FbCustomer).filter(
+                        models.FbCustomer.id.in_(customer_ids)
+                    ).update(
+                        {"current_category_id": knowledge_id, "updated_at": now},
+                        synchronize_session=False
+                    )
+                    db.commit()
+                    logger.info(f"[{group_type}] ✅ Updated {len(customers)} customers to knowledge group {knowledge_id}")
+
+                    if knowledge_type:
+                        publish(page_id, 'customer_type_update', [{
+                            'page_id': page_id,
+                            'psid': psid,
+                            'timestamp': timestamp,
+                            'customer_type_knowledge_name': knowledge_type.type_name,
+                            'customer_type_knowledge_id': knowledge_id
+                        } for _, psid in customers])
+                        logger.info(f"[{group_type}] 📡 Sent SSE update for knowledge type: {knowledge_type.type_name}")
 
-                                        # ส่ง SSE update
-                                        from app.routes.facebook.sse import send_customer_type_update
-                                        await send_customer_type_update(
-                                            page_id=page_id,
-                                            psid=psid,
-                                            customer_type_name=custom_group.type_name,
-                                            customer_type_custom_id=group_id_int
-                                        )
-                                        logger.info(f"[{group_type}] 📡 Sent SSE update for custom type: {custom_group.type_name}")
+                except Exception as e:
+                    logger.error(f"[{group_type}] ❌ Error updating customer knowledge type: {e}")
+                    db.rollback()
 
-                            except Exception as e:
-                                logger.error(f"[{group_type}] ❌ Error inserting customer custom classification: {e}")
-                                db.rollback()
+            # ✅ Custom group
+            else:
+                try:
+                    group_id_int = int(group_id) if isinstance(group_id, str) else group_id
+                    custom_group = db.query(models.CustomerTypeCustom.type_name).filter(
+                        models.CustomerTypeCustom.id == group_id_int
+                    ).first()
+                    if not custom_group:
+                        return
 
-                    success_count += 1
-                    await asyncio.sleep(1)
+                    # ➡️ Insert records into FBCustomerCustomClassification ทีเดียว
+                    db.add_all([
+                        models.FBCustomerCustomClassification(
+                            customer_id=customer_id,
+                            old_category_id=None,  # หรือใส่ group เดิมถ้ามี logic
+                            new_category_id=group_id_int,
+                            page_id=page.ID,
+                            classified_by="system"
+                        )
+                        for customer_id in customer_ids
+                    ])
+                    db.query(models.FbCustomer).filter(
+                        models.FbCustomer.id.in_(customer_ids)
+                    ).update({"updated_at": now}, synchronize_session=False)
+                    db.commit()
+                    logger.info(f"[{group_type}] ✅ Inserted classification for {len(customers)} customers into custom group {group_id_int}")
+
+                    publish(page_id, 'customer_type_update', [{
+                        'page_id': page_id,
+                        'psid': psid,
+                        'timestamp': timestamp,
+                        'customer_type_name': custom_group.type_name,
+                        'customer_type_custom_id': group_id_int
+                    } for _, psid in customers])
+                    logger.info(f"[{group_type}] 📡 Sent SSE update for custom type: {custom_group.type_name}")
 
                 except Exception as e:
-                    logger.error(f"[{group_type}] Error sending messages to {psid}: {e}")
-                    fail_count += 1
-
+                    logger.error(f"[{group_type}] ❌ Error inserting customer custom classification: {e}")
+                    db.rollback()
         finally:
             db.close()
 
-        logger.info(f"[{group_type}] Sent messages complete: {success_count} success, {fail_count} failed")
-
-    
-    async def update_inactivity_from_conversations(self, page_id: str):
-        """อัพเดทข้อมูล inactivity จาก conversations โดยตรง"""
-        try:
-            access_token = get_page_token(page_id)
-            if not access_token:
-                return
-
-            from app.service.facebook_api import fb_get
-
-            # ดึง conversations
-            endpoint = f"{page_id}/conversations"
-            params = {
-                "fields": "participants,updated_time,id",
-                "limit": 100
-            }
-
-            conversations = fb_get(endpoint, params, access_token)
-            if "error" in conversations or not conversations.get('data'):
-                return
-
-            # สร้างข้อมูล inactivity
-            if page_id not in self.user_inactivity_data:
-                self.user_inactivity_data[page_id] = {}
-
-            for conv in conversations['data']:
-                participants = conv.get('participants', {}).get('data', [])
-                for participant in participants:
-                    user_id = participant.get('id')
-                    if user_id and user_id != page_id:
-                        # คำนวณระยะเวลาที่หายไป
-                        updated_time = conv.get('updated_time')
-                        if updated_time:
-                            try:
-                                past = datetime.fromisoformat(updated_time.replace('Z', '+00:00'))
-                            except Exception:
-                                continue
-                            now = datetime.now(past.tzinfo)
-                            diff_minutes = int((now - past).total_seconds() / 60)
-
-                            self.user_inactivity_data[page_id][user_id] = {
-                                'last_message_time': updated_time,
-                                'inactivity_minutes': diff_minutes,
-                                'updated_at': datetime.now()
-                            }
-
-        except Exception as e:
-            logger.error(f"Error updating inactivity from conversations: {e}")
-    
     async def handle_repeat(self, page_id: str, schedule: Dict[str, Any], current_time: datetime):
-        """จัดการการทำซ้ำของ schedule"""
+        """
+        จัดการการทำซ้ำของ schedule
+        คืนเวลาทำงานครั้งถัดไป หรือ None ถ้าไม่ต้องทำซ้ำ (ผู้เรียกจะลบ schedule ออก)
+        """
         repeat_info = schedule.get('repeat', {})
         repeat_type = repeat_info.get('type', 'once')
-        schedule_id = str(schedule['id'])
         
         if repeat_type == 'once':
             # ถ้าส่งครั้งเดียว ให้ลบออกจากระบบ
-            self.remove_schedule(page_id, schedule['id'])
-            return
+            return None
             
-        # คำนวณวันถัดไป
+        if repeat_type not in ('daily', 'weekly', 'monthly'):
+            return None
+        
+        # วันที่ของเดือนที่ตั้งไว้แต่แรก (กันวันที่ 31 เลื่อนเป็น 28 ถาวร)
         current_date = datetime.strptime(schedule['date'], "%Y-%m-%d")
+        anchor_day = repeat_info.setdefault('anchorDay', current_date.day)
+        end_date = repeat_info.get('endDate')
+        end_datetime = datetime.strptime(end_date, "%Y-%m-%d") if end_date else None
         
-        if repeat_type == 'daily':
-            next_date = current_date + timedelta(days=1)
-        elif repeat_type == 'weekly':
-            next_date = current_date + timedelta(weeks=1)
-        elif repeat_type == 'monthly':
-            # เพิ่ม 1 เดือน
-            if current_date.month == 12:
-                next_date = current_date.replace(year=current_date.year + 1, month=1)
-            else:
-                next_date = current_date.replace(month=current_date.month + 1)
-        else:
-            return
+        # คำนวณรอบถัดไปที่ยังไม่เลยเวลาปัจจุบัน (ข้ามรอบที่พลาดไปแล้ว ไม่ส่งย้อนหลังซ้ำหลายรอบ)
+        next_date = current_date
+        while True:
+            next_date = self._next_repeat_date(next_date, repeat_type, anchor_day)
             
-        # ตรวจสอบวันสิ้นสุด
-        end_date = repeat_info.get('endDate')
-        if end_date:
-            end_datetime = datetime.strptime(end_date, "%Y-%m-%d")
-            if next_date > end_datetime:
+            # ตรวจสอบวันสิ้นสุด
+            if end_datetime and next_date > end_datetime:
                 # ถ้าเกินวันสิ้นสุด ให้ลบออกจากระบบ
-                self.remove_schedule(page_id, schedule['id'])
-                return
-                
-        # อัพเดทวันที่ใน schedule
-        schedule['date'] = next_date.strftime("%Y-%m-%d")
+                return None
+            
+            # อัพเดทวันที่ใน schedule
+            schedule['date'] = next_date.strftime("%Y-%m-%d")
+            next_run_at = initial_run_at(schedule, current_time)
+            if next_run_at is None or next_run_at > current_time:
+                break
         
         # Reset tracking สำหรับรอบใหม่
-        self.sent_tracking[schedule_id] = set()
+        self.store.reset_tracking(row_id=schedule['_row_id'])
+        
+        return next_run_at
+    
+    def _next_repeat_date(self, current_date: datetime, repeat_type: str, anchor_day: int) -> datetime:
+        """คำนวณวันถัดไปตามประเภทการทำซ้ำ"""
+        if repeat_type == 'daily':
+            return current_date + timedelta(days=1)
+        if repeat_type == 'weekly':
+            return current_date + timedelta(weeks=1)
+        # เพิ่ม 1 เดือน (ถ้าเดือนถัดไปไม่มีวันที่นั้น ใช้วันสุดท้ายของเดือน)
+        year = current_date.year + (1 if current_date.month == 12 else 0)
+        month = 1 if current_date.month == 12 else current_date.month + 1
+        return current_date.replace(year=year, month=month, day=min(anchor_day, calendar.monthrange(year, month)[1]))
     
     def get_active_schedules_for_page(self, page_id: str):
         """ดึง active schedules สำหรับ page"""
-        return self.active_schedules.get(page_id, [])
+        return self.store.list_for_page(page_id)
+    
+    def get_all_active_schedules(self) -> Dict[str, List[Dict[str, Any]]]:
+        """ดึง active schedules ทุกเพจ"""
+        return self.store.list_all()
     
     def stop(self):
         """หยุดระบบ scheduler"""
         self.is_running = False
         
         # Cancel tasks
-        if self.user_group_task:
-            self.user_group_task.cancel()
-        if self.knowledge_group_task:
-            self.knowledge_group_task.cancel()
+        if self.dispatch_task and self._loop and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self.dispatch_task.cancel)
             
         logger.info("Message scheduler stopped")
 
@@ -0,0 +1,429 @@
+# backend/app/service/schedule_store.py
+"""
+Schedule Store
+จัดการ:
+- เก็บ schedules ที่เปิดใช้งานใน Postgres (ตาราง active_message_schedules)
+- claim schedule ที่ถึงเวลาด้วย lease (FOR UPDATE SKIP LOCKED) ให้หลาย instance แบ่งงานกันได้
+- ดึง schedules ที่ใกล้ถึงเวลาที่สุด (สำหรับ heap ของ MessageScheduler)
+- เก็บสถานะการส่งราย user (ตาราง schedule_deliveries) กันการส่งซ้ำข้าม process / restart
+- หา users ที่หายไปตามช่วงเวลาด้วย query เดียว (index บน fb_customers)
+"""
+
+import json
+import logging
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+import pytz
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from app import config
+from app.database import models
+from app.database.database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+bangkok_tz = pytz.timezone("Asia/Bangkok")
+
+def is_knowledge_schedule(schedule: Dict[str, Any]) -> bool:
+    return any(str(g).startswith('knowledge_') for g in schedule.get('groups', []))
+
+
+def initial_run_at(schedule: Dict[str, Any], now: datetime) -> Optional[datetime]:
+    """เวลาที่ schedule ควรทำงานครั้งแรก"""
+    schedule_type = schedule.get('type')
+    if schedule_type == 'scheduled':
+        if not schedule.get('date') or not schedule.get('time'):
+            return None
+        return bangkok_tz.localize(
+            datetime.strptime(f"{schedule['date']} {schedule['time']}", "%Y-%m-%d %H:%M")
+        )
+    return now
+
+
+def _row_to_schedule(row) -> Dict[str, Any]:
+    schedule = dict(row.payload or {})
+    schedule['_row_id'] = row.id
+    if row.last_sent_at:
+        schedule['last_sent'] = row.last_sent_at.isoformat()
+    return schedule
+
+
+class ScheduleStore:
+    def __init__(self):
+        # ชื่อ instance ที่ใช้ถือ lease
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+    # ---------- schedules ----------
+
+    def upsert(self, page_id: str, schedule: Dict[str, Any], hold_lease: bool = False) -> Dict[str, Any]:
+        """
+        เพิ่ม/อัพเดท schedule
+        - hold_lease=True ให้ instance นี้ถือ lease ไว้ (ใช้กับ immediate ที่ route ประมวลผลเอง)
+        """
+        now = datetime.now(bangkok_tz)
+        payload = {k: v for k, v in schedule.items() if not k.startswith('_')}
+        payload.setdefault('activated_at', now.isoformat())
+        values = {
+            "page_id": page_id,
+            "schedule_key": str(schedule['id']),
+            "schedule_type": schedule.get('type', ''),
+            "is_knowledge_group": is_knowledge_schedule(schedule),
+            "payload": payload,
+            "next_run_at": initial_run_at(schedule, now),
+            "lease_owner": self.owner if hold_lease else None,
+            "lease_expires_at": now + timedelta(seconds=config.SCHEDULE_LEASE_SECONDS) if hold_lease else None,
+        }
+        stmt = pg_insert(models.ActiveSchedule).values(**values)
+        stmt = stmt.on_conflict_do_update(
+            constraint="uq_active_schedule_page_key",
+            set_={k: stmt.excluded[k] for k in values if k not in ("page_id", "schedule_key")},
+        ).returning(models.ActiveSchedule.id)
+
+        db = SessionLocal()
+        try:
+            row_id = db.execute(stmt).scalar()
+            db.commit()
+        finally:
+            db.close()
+
+        payload['_row_id'] = row_id
+        return payload
+
+    def remove(self, page_id: str, schedule_key: Any) -> bool:
+        db = SessionLocal()
+        try:
+            deleted = db.query(models.ActiveSchedule).filter(
+                models.ActiveSchedule.page_id == page_id,
+                models.ActiveSchedule.schedule_key == str(schedule_key)
+            ).delete(synchronize_session=False)
+            db.commit()
+            return deleted > 0
+        finally:
+            db.close()
+
+    def remove_by_row(self, row_id: int):
+        db = SessionLocal()
+        try:
+            db.query(models.ActiveSchedule).filter(models.ActiveSchedule.id == row_id).delete(synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+    def list_for_page(self, page_id: str) -> List[Dict[str, Any]]:
+        db = SessionLocal()
+        try:
+            rows = db.query(models.ActiveSchedule).filter(
+                models.ActiveSchedule.page_id == page_id
+            ).order_by(models.ActiveSchedule.id).all()
+            return [_row_to_schedule(row) for row in rows]
+        finally:
+            db.close()
+
+    def list_all(self) -> Dict[str, List[Dict[str, Any]]]:
+        db = SessionLocal()
+        try:
+            result: Dict[str, List[Dict[str, Any]]] = {}
+            for row in db.query(models.ActiveSchedule).order_by(models.ActiveSchedule.id).all():
+                result.setdefault(row.page_id, []).append(_row_to_schedule(row))
+            return result
+        finally:
+            db.close()
+
+    # ---------- lease ----------
+
+    def upcoming(self, limit: int = None) -> List[Any]:
+        """
+        schedules ที่จะถึงเวลาเร็วที่สุด N ตัว (ใช้ index ix_active_schedule_due)
+        คืน list ของ (next_run_at, id)
+        """
+        db = SessionLocal()
+        try:
+            rows = db.query(models.ActiveSchedule.next_run_at, models.ActiveSchedule.id).filter(
+                models.ActiveSchedule.next_run_at.isnot(None)
+            ).order_by(models.ActiveSchedule.next_run_at).limit(limit or config.SCHEDULE_HEAP_SIZE).all()
+            return [(row.next_run_at, row.id) for row in rows]
+        finally:
+            db.close()
+
+    def claim_ids(self, row_ids: List[int]) -> List[Dict[str, Any]]:
+        """claim schedules ตาม id ที่ถึงเวลาแล้วและยังไม่มี instance อื่นถือ lease อยู่"""
+        if not row_ids:
+            return []
+        sql = text("""
+            UPDATE active_message_schedules AS s
+            SET lease_owner = :owner,
+                lease_expires_at = now() + make_interval(secs => :lease)
+            WHERE s.id IN (
+                SELECT id FROM active_message_schedules
+                WHERE id = ANY(:ids)
+                  AND next_run_at IS NOT NULL
+                  AND next_run_at <= now()
+                  AND (lease_expires_at IS NULL OR lease_expires_at < now())
+                ORDER BY next_run_at
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING s.id, s.page_id, s.payload, s.last_sent_at, s.next_run_at, s.is_knowledge_group
+        """)
+        db = SessionLocal()
+        try:
+            rows = db.execute(sql, {
+                "owner": self.owner,
+                "lease": config.SCHEDULE_LEASE_SECONDS,
+                "ids": list(row_ids),
+            }).fetchall()
+            db.commit()
+        finally:
+            db.close()
+
+        claimed = []
+        for row in rows:
+            schedule = _row_to_schedule(row)
+            schedule['_page_id'] = row.page_id
+            schedule['_due_at'] = row.next_run_at
+            schedule['_is_knowledge'] = row.is_knowledge_group
+            claimed.append(schedule)
+        return claimed
+
+    def renew_lease(self, row_id: int) -> bool:
+        """ต่ออายุ lease ที่ instance นี้ถืออยู่ คืน False ถ้า lease ไม่ใช่ของ instance นี้แล้ว"""
+        sql = text("""
+            UPDATE active_message_schedules
+            SET lease_expires_at = now() + make_interval(secs => :lease)
+            WHERE id = :row_id AND lease_owner = :owner
+            RETURNING id
+        """)
+        db = SessionLocal()
+        try:
+            renewed = db.execute(sql, {
+                "row_id": row_id,
+                "owner": self.owner,
+                "lease": config.SCHEDULE_LEASE_SECONDS,
+            }).fetchone() is not None
+            db.commit()
+            return renewed
+        finally:
+            db.close()
+
+    def release(self, row_id: int, next_run_at: Optional[datetime],
+                payload: Dict[str, Any] = None, sent_at: Optional[datetime] = None):
+        """ปล่อย lease พร้อมตั้งเวลาทำงานครั้งถัดไป (None = ไม่ต้องทำงานอีก)"""
+        values = {
+            "lease_owner": None,
+            "lease_expires_at": None,
+            "next_run_at": next_run_at,
+        }
+        if payload is not None:
+            values["payload"] = {k: v for k, v in payload.items() if not k.startswith('_')}
+        if sent_at is not None:
+            values["last_sent_at"] = sent_at
+
+        db = SessionLocal()
+        try:
+            db.query(models.ActiveSchedule).filter(
+                models.ActiveSchedule.id == row_id,
+                models.ActiveSchedule.lease_owner == self.owner
+            ).update(values, synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+    # ---------- deliveries ----------
+
+    def claim_recipients(self, row_id: int, psids: List[str]) -> List[str]:
+        """
+        จอง recipients ก่อนส่ง (insert สถานะ pending)
+        คืนเฉพาะ psid ที่ยังไม่เคยถูกจอง/ส่ง → ส่งได้ไม่ซ้ำแม้ lease หมดอายุกลางทาง
+        """
+        psids = list(dict.fromkeys(psids))
+        if not psids:
+            return []
+        stmt = pg_insert(models.ScheduleDelivery).values([
+            {"active_schedule_id": row_id, "customer_psid": psid, "status": "pending"}
+            for psid in psids
+        ]).on_conflict_do_nothing(
+            constraint="uq_schedule_delivery_recipient"
+        ).returning(models.ScheduleDelivery.customer_psid)
+
+        db = SessionLocal()
+        try:
+            claimed = [row[0] for row in db.execute(stmt).fetchall()]
+            db.commit()
+            return claimed
+        finally:
+            db.close()
+
+    def record_results(self, row_id: int, results: List[Any]):
+        """บันทึกผลการส่งราย user (RecipientResult จาก broadcast_sender)"""
+        if not results:
+            return
+        sql = text("""
+            UPDATE schedule_deliveries AS d
+            SET status = v.status, error = v.error, updated_at = now()
+            FROM (
+                SELECT unnest(CAST(:psids AS text[])) AS psid,
+                       unnest(CAST(:statuses AS text[])) AS status,
+                       unnest(CAST(:errors AS text[])) AS error
+            ) AS v
+            WHERE d.active_schedule_id = :row_id AND d.customer_psid = v.psid
+        """)
+        db = SessionLocal()
+        try:
+            db.execute(sql, {
+                "row_id": row_id,
+                "psids": [res.psid for res in results],
+                "statuses": ["sent" if res.success else "failed" for res in results],
+                "errors": [json.dumps(res.error, ensure_ascii=False) if res.error else None for res in results],
+            })
+            db.commit()
+        finally:
+            db.close()
+
+    def fail_interrupted(self, row_id: int) -> int:
+        """
+        recipients ที่ค้างสถานะ pending จากรอบที่ process ตายระหว่างส่ง (เรียกตอนถือ lease อยู่)
+        ไม่ส่งซ้ำเพราะอาจส่งไปแล้ว แต่บันทึกเป็น failed ให้เห็นในรายงาน
+        """
+        sql = text("""
+            UPDATE schedule_deliveries AS d
+            SET status = 'failed', error = :error, updated_at = now()
+            FROM active_message_schedules s
+            WHERE d.active_schedule_id = :row_id AND d.status = 'pending'
+              AND s.id = d.active_schedule_id AND s.lease_owner = :owner
+        """)
+        db = SessionLocal()
+        try:
+            result = db.execute(sql, {
+                "row_id": row_id,
+                "owner": self.owner,
+                "error": json.dumps("interrupted before the result was recorded"),
+            })
+            db.commit()
+            return result.rowcount
+        finally:
+            db.close()
+
+    def delivered_recipients(self, row_id: int) -> List[str]:
+        db = SessionLocal()
+        try:
+            rows = db.query(models.ScheduleDelivery.customer_psid).filter(
+                models.ScheduleDelivery.active_schedule_id == row_id
+            ).all()
+            return [row[0] for row in rows]
+        finally:
+            db.close()
+
+    def reset_tracking(self, page_id: str = None, schedule_key: Any = None, row_id: int = None) -> int:
+        """
+        ล้างสถานะการส่งของ schedule (เริ่มรอบใหม่)
+        - row_id: ล้างเฉพาะเมื่อ instance นี้ยังถือ lease อยู่ (ไม่ล้าง deliveries ที่รอบของ instance อื่นใช้กันส่งซ้ำ)
+        - page_id + schedule_key: ล้างทันที (สั่งจาก route) schedule_key ซ้ำกันได้ระหว่างเพจจึงต้องระบุเพจ
+        """
+        db = SessionLocal()
+        try:
+            query = db.query(models.ScheduleDelivery)
+            if row_id is not None:
+                owned = db.query(models.ActiveSchedule.id).filter(
+                    models.ActiveSchedule.id == row_id,
+                    models.ActiveSchedule.lease_owner == self.owner
+                )
+                query = query.filter(models.ScheduleDelivery.active_schedule_id.in_(owned))
+            else:
+                row_ids = db.query(models.ActiveSchedule.id).filter(
+                    models.ActiveSchedule.page_id == str(page_id),
+                    models.ActiveSchedule.schedule_key == str(schedule_key)
+                )
+                query = query.filter(models.ScheduleDelivery.active_schedule_id.in_(row_ids))
+            deleted = query.delete(synchronize_session=False)
+            db.commit()
+            return deleted
+        finally:
+            db.close()
+
+    def tracking_counts(self) -> Dict[str, int]:
+        sql = text("""
+            SELECT s.schedule_key, count(d.id)
+            FROM active_message_schedules s
+            LEFT JOIN schedule_deliveries d ON d.active_schedule_id = s.id
+            GROUP BY s.schedule_key
+        """)
+        db = SessionLocal()
+        try:
+            return {key: count for key, count in db.execute(sql).fetchall()}
+        finally:
+            db.close()
+
+    # ---------- inactivity ----------
+
+    def find_inactive_recipients(self, row_id: int, page_db_id: int, min_seconds: float,
+                                 max_seconds: float, knowledge_ids: List[int] = None) -> List[str]:
+        """
+        หา users ที่หายไประหว่าง min_seconds ถึง max_seconds และยังไม่ได้รับ schedule นี้
+        เป็น query เดียวบน index (page_id, current_category_id, last_interaction_at)
+        """
+        category_filter = "AND c.current_category_id = ANY(:knowledge_ids)" if knowledge_ids else ""
+        sql = text(f"""
+            SELECT c.customer_psid
+            FROM fb_customers c
+            WHERE c.page_id = :page_db_id
+              {category_filter}
+              AND c.last_interaction_at > now() - make_interval(secs => :max_seconds)
+              AND c.last_interaction_at <= now() - make_interval(secs => :min_seconds)
+              AND NOT EXISTS (
+                  SELECT 1 FROM schedule_deliveries d
+                  WHERE d.active_schedule_id = :row_id
+                    AND d.customer_psid = c.customer_psid
+              )
+        """)
+        params = {
+            "page_db_id": page_db_id,
+            "row_id": row_id,
+            "min_seconds": max(min_seconds, 0),
+            "max_seconds": max_seconds,
+        }
+        if knowledge_ids:
+            params["knowledge_ids"] = list(knowledge_ids)
+
+        db = SessionLocal()
+        try:
+            return [row[0] for row in db.execute(sql, params).fetchall()]
+        finally:
+            db.close()
+
+    def apply_last_interactions(self, page_id: str, last_interactions: Dict[str, datetime]) -> int:
+        """
+        อัพเดท last_interaction_at จากข้อมูลที่ frontend ส่งมา (เลื่อนไปข้างหน้าเท่านั้น)
+        ทำทีเดียวทั้งชุดด้วย UPDATE ... FROM unnest
+        """
+        if not last_interactions:
+            return 0
+        sql = text("""
+            UPDATE fb_customers AS c
+            SET last_interaction_at = v.last_interaction_at
+            FROM facebook_pages p,
+                 (SELECT unnest(CAST(:psids AS text[])) AS psid,
+                         unnest(CAST(:times AS timestamptz[])) AS last_interaction_at) AS v
+            WHERE p.page_id = :page_id
+              AND c.page_id = p."ID"
+              AND c.customer_psid = v.psid
+              AND (c.last_interaction_at IS NULL OR c.last_interaction_at < v.last_interaction_at)
+        """)
+        db = SessionLocal()
+        try:
+            result = db.execute(sql, {
+                "page_id": page_id,
+                "psids": list(last_interactions.keys()),
+                "times": list(last_interactions.values()),
+            })
+            db.commit()
+            return result.rowcount
+        finally:
+            db.close()
+
+
+# สร้าง instance กลาง
+schedule_store = ScheduleStore()
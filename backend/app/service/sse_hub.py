@@ -0,0 +1,263 @@
+# backend/app/service/sse_hub.py
+"""
+SSE Hub
+จัดการ:
+- publish event ของแต่ละเพจผ่าน Redis pub/sub (ใช้ได้จากทุก process: API, scheduler thread, Celery)
+- เก็บ event ล่าสุดของแต่ละเพจใน Redis stream (จำกัดขนาด) ให้ client ที่ reconnect ขอย้อนหลังด้วย Last-Event-ID
+- ใน API process มี listener เดียวที่รับ event แล้วกระจายให้ทุก client ที่เปิด SSE ของเพจนั้น
+- ส่ง customer_update อัตโนมัติเมื่อ fb_customers ถูกเพิ่ม/แก้ผ่าน ORM (แทนการ poll DB ทุก 5 วินาที)
+  ส่วนการเขียนแบบ bulk (Core) เรียก publish_customer_rows เอง
+"""
+
+import asyncio
+import json
+import logging
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import redis
+import redis.asyncio as aioredis
+from sqlalchemy import event
+
+from app import config
+from app.database import crud, models
+from app.database.database import SessionLocal, engine
+from app.utils.redis_helper import r, REDIS_HOST, REDIS_PORT, REDIS_DB
+
+logger = logging.getLogger(__name__)
+
+
+# KEYS[1] = stream ของเพจ, KEYS[2] = channel ของเพจ
+# ARGV[1] = payload, ARGV[2] = maxlen, ARGV[3] = ttl (ms)
+# เขียนลง stream แล้ว publish "<id> <payload>" ในคำสั่งเดียว เพื่อให้ id ใน stream และ pub/sub ตรงกันเสมอ
+_PUBLISH_SCRIPT = """
+local id = redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[2], '*', 'payload', ARGV[1])
+redis.call('PEXPIRE', KEYS[1], ARGV[3])
+redis.call('PUBLISH', KEYS[2], id .. ' ' .. ARGV[1])
+return id
+"""
+_publish_event = r.register_script(_PUBLISH_SCRIPT)
+
+
+def page_channel(page_id: str) -> str:
+    return f"{config.SSE_CHANNEL_PREFIX}:{page_id}"
+
+
+def page_stream(page_id: str) -> str:
+    return f"{config.SSE_STREAM_PREFIX}:{page_id}"
+
+
+def stream_id_key(event_id: str) -> Tuple[int, int]:
+    """แปลง stream id ("<ms>-<seq>") เป็น tuple สำหรับเปรียบเทียบลำดับ"""
+    ms, _, seq = event_id.partition('-')
+    return int(ms), int(seq or 0)
+
+
+def publish(page_id: str, event_type: str, data: List[Dict[str, Any]]) -> Optional[str]:
+    """ส่ง event ไปยังทุก client ของเพจ (ทุก process) คืน event id หรือ None ถ้า Redis ใช้ไม่ได้"""
+    if not page_id or not data:
+        return None
+    try:
+        payload = json.dumps({'type': event_type, 'data': data}, default=str)
+        return _publish_event(
+            keys=[page_stream(page_id), page_channel(page_id)],
+            args=[payload, config.SSE_STREAM_MAXLEN, config.SSE_STREAM_TTL_SECONDS * 1000]
+        )
+    except redis.RedisError as e:
+        logger.error(f"Error publishing SSE event for page {page_id}: {e}")
+        return None
+
+
+def read_since(page_id: str, last_event_id: str) -> Tuple[List[Tuple[str, str]], bool]:
+    """
+    ดึง event หลัง last_event_id จาก stream ของเพจ
+    คืน (events, complete) - complete เป็น False ถ้า event เก่าถูกตัดทิ้งไปแล้ว (client ต้องโหลดข้อมูลใหม่)
+    """
+    try:
+        stream_id_key(last_event_id)
+    except ValueError:
+        return [], False
+    try:
+        entries = r.xrange(page_stream(page_id), min=last_event_id, max='+', count=config.SSE_STREAM_MAXLEN + 1)
+    except redis.RedisError as e:
+        logger.error(f"Error reading SSE stream for page {page_id}: {e}")
+        return [], False
+
+    # xrange รวม last_event_id ด้วย ถ้ายังอยู่แปลว่าไม่มี event ไหนหายไประหว่างนั้น
+    complete = bool(entries) and entries[0][0] == last_event_id
+    events = [(event_id, fields['payload']) for event_id, fields in entries if event_id != last_event_id]
+    return events, complete
+
+
+def publish_customer_type_update(update: Dict[str, Any]) -> Optional[str]:
+    """ส่ง update รายคน (กลุ่มลูกค้า / ลูกค้าใหม่ / สถานะการขุด) ในรูปแบบ customer_type_update เดิม"""
+    return publish(update.get('page_id'), 'customer_type_update', [update])
+
+
+# ใส่ในคิวแทน event ที่ถูกทิ้ง client ต้องโหลดข้อมูลใหม่ทั้งหมด
+RESYNC = (None, None)
+
+
+class SSEHub:
+    """
+    รวม subscription ของทุก client ไว้ที่ Redis connection เดียวต่อ process
+    - client แต่ละคนได้ asyncio.Queue ของ (event id, payload) ถ้าอ่านไม่ทันจะล้างคิวแล้วส่ง RESYNC แทน
+    - listener เริ่มเมื่อมี client คนแรก และหยุดเมื่อไม่มี client เหลือ
+    """
+
+    def __init__(self, queue_size: int = None):
+        self.queue_size = queue_size or config.SSE_CLIENT_QUEUE_SIZE
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = {}
+        self._listener_task: Optional[asyncio.Task] = None
+
+    def subscriber_count(self, page_id: str = None) -> int:
+        if page_id is not None:
+            return len(self._subscribers.get(page_id, ()))
+        return sum(len(queues) for queues in self._subscribers.values())
+
+    def subscribe(self, page_id: str) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        self._subscribers.setdefault(page_id, set()).add(queue)
+        if self._listener_task is None or self._listener_task.done():
+            self._listener_task = asyncio.get_running_loop().create_task(self._listen())
+        return queue
+
+    def unsubscribe(self, page_id: str, queue: asyncio.Queue):
+        queues = self._subscribers.get(page_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                self._subscribers.pop(page_id, None)
+        if not self._subscribers and self._listener_task and not self._listener_task.done():
+            self._listener_task.cancel()
+            self._listener_task = None
+
+    def _dispatch(self, page_id: str, message: str):
+        event_id, _, payload = message.partition(' ')
+        for queue in list(self._subscribers.get(page_id, ())):
+            if queue.full():
+                # client อ่านไม่ทันจนมี event หาย ล้างคิวแล้วให้ client โหลดข้อมูลใหม่ทั้งหมด
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(RESYNC)
+                logger.warning(f"SSE client queue full for page {page_id}, asked client to resync")
+                continue
+            queue.put_nowait((event_id, payload))
+
+    async def _listen(self):
+        prefix = page_channel("")
+        while True:
+            client = aioredis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decode_responses=True)
+            pubsub = client.pubsub()
+            try:
+                await pubsub.psubscribe(f"{prefix}*")
+                logger.info("📡 SSE hub listening on Redis pub/sub")
+                async for message in pubsub.listen():
+                    if message.get('type') != 'pmessage':
+                        continue
+                    self._dispatch(message['channel'][len(prefix):], message['data'])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"SSE hub listener error, reconnecting: {e}")
+                await asyncio.sleep(1)
+            finally:
+                try:
+                    await pubsub.close()
+                    await client.close()
+                except Exception:
+                    pass
+
+
+# สร้าง instance กลาง
+sse_hub = SSEHub()
+
+
+# ---------- ส่ง customer_update เมื่อ fb_customers เปลี่ยน ----------
+
+# cache facebook_pages.ID -> page_id (string) ไม่เปลี่ยนตลอดอายุเพจ
+def _facebook_page_id(page_db_id: int) -> Optional[str]:
+    page = crud.page_ref_cache.get(f"id:{page_db_id}")
+    if page is None:
+        # ใช้ connection แยกจาก session ที่กำลัง commit
+        with engine.connect() as conn:
+            page = crud.get_page_ref_by_db_id(conn, page_db_id)
+    return page.page_id if page else None
+
+
+def _customer_payload(customer: models.FbCustomer) -> Dict[str, Any]:
+    # ใช้เฉพาะค่าที่โหลดอยู่แล้ว ไม่ query เพิ่มระหว่าง flush
+    category = customer.__dict__.get('current_category')
+    mining_current = customer.__dict__.get('mining_current')
+    payload = {
+        'id': customer.id,
+        'psid': customer.customer_psid,
+        'name': customer.name or f"User...{customer.customer_psid[-8:]}",
+        'first_interaction': customer.first_interaction_at.isoformat() if isinstance(customer.first_interaction_at, datetime) else None,
+        'last_interaction': customer.last_interaction_at.isoformat() if isinstance(customer.last_interaction_at, datetime) else None,
+        'source_type': customer.source_type,
+        'current_category_id': customer.current_category_id,
+        'action': 'update'
+    }
+    if category is not None:
+        payload['current_category_name'] = category.type_name
+    if mining_current is not None:
+        payload['mining_status'] = mining_current.status
+    return payload
+
+
+def publish_customer_rows(page_db_id: int, rows) -> Optional[str]:
+    """ส่ง customer_update จากแถวที่ได้จาก RETURNING ของการเขียนแบบ bulk (ORM event ไม่ทำงานกับ Core)"""
+    updates = [{
+        'id': row.id,
+        'psid': row.customer_psid,
+        'name': row.name or f"User...{row.customer_psid[-8:]}",
+        'first_interaction': row.first_interaction_at.isoformat() if isinstance(row.first_interaction_at, datetime) else None,
+        'last_interaction': row.last_interaction_at.isoformat() if isinstance(row.last_interaction_at, datetime) else None,
+        'source_type': row.source_type,
+        'current_category_id': row.current_category_id,
+        'action': 'update'
+    } for row in rows]
+    if not updates:
+        return None
+    try:
+        page_id = _facebook_page_id(page_db_id)
+    except Exception as e:
+        logger.error(f"Error resolving page for SSE update: {e}")
+        return None
+    return publish(page_id, 'customer_update', updates) if page_id else None
+
+
+@event.listens_for(SessionLocal, "after_flush")
+def _collect_customer_changes(session, flush_context):
+    changed = [obj for obj in session.new if isinstance(obj, models.FbCustomer)] + [
+        obj for obj in session.dirty
+        if isinstance(obj, models.FbCustomer) and session.is_modified(obj, include_collections=False)
+    ]
+    if changed:
+        pending = session.info.setdefault('sse_customer_updates', {})
+        for customer in changed:
+            pending[customer.id] = (customer.page_id, _customer_payload(customer))
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def _publish_customer_changes(session):
+    pending = session.info.pop('sse_customer_updates', None)
+    if not pending:
+        return
+    by_page: Dict[int, List[Dict[str, Any]]] = {}
+    for page_db_id, payload in pending.values():
+        by_page.setdefault(page_db_id, []).append(payload)
+    for page_db_id, updates in by_page.items():
+        try:
+            page_id = _facebook_page_id(page_db_id)
+        except Exception as e:
+            logger.error(f"Error resolving page for SSE update: {e}")
+            continue
+        if page_id:
+            publish(page_id, 'customer_update', updates)
+
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _discard_customer_changes(session):
+    session.info.pop('sse_customer_updates', None)
@@ -0,0 +1,254 @@
+# backend/app/service/webhook_ingest.py
+"""
+Webhook Ingest
+จัดการ:
+- รับ payload ดิบจาก POST /webhook ใส่ Redis stream ทันที (ตอบ Facebook ได้โดยไม่ต้องรอ DB)
+- consumer group อ่านเป็น batch รวม event ซ้ำของ (page, psid) ให้เหลือเวลาล่าสุด
+- อัพเดท last_interaction_at ด้วย statement เดียวต่อ batch แล้วส่ง task sync ให้ user ใหม่
+- event ที่ consumer ค้างไว้ (process ตาย) จะถูก claim ใหม่หลัง WEBHOOK_CLAIM_IDLE_SECONDS
+  ถ้าถูกส่งเกิน WEBHOOK_MAX_DELIVERIES ครั้งจะย้ายไป dead-letter stream
+- payload ที่รูปแบบไม่ถูกต้อง (POST /webhook ไม่มีการยืนยันตัวตน) ถูกข้ามทีละ event ไม่ทำให้ทั้ง batch ล้ม
+"""
+
+import json
+import logging
+import os
+import socket
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Tuple
+
+import redis
+from sqlalchemy import text
+
+from app import config
+from app.database import crud
+from app.database.database import SessionLocal
+from app.utils.redis_helper import r
+
+logger = logging.getLogger(__name__)
+
+# (page_id, psid) -> เวลาของ event ล่าสุด
+InteractionMap = Dict[Tuple[str, str], datetime]
+
+
+def enqueue_webhook(body: Dict[str, Any]) -> str:
+    """ใส่ webhook payload ลง stream คืน stream id (โยน RedisError ถ้าเขียนไม่ได้ ให้ Facebook ส่งซ้ำ)"""
+    return r.xadd(
+        config.WEBHOOK_STREAM_KEY,
+        {"body": json.dumps(body)},
+        maxlen=config.WEBHOOK_STREAM_MAXLEN,
+        approximate=True
+    )
+
+
+def coalesce_interactions(bodies: List[Any]) -> InteractionMap:
+    """รวม messaging events ของทุก payload ให้เหลือเวลาล่าสุดต่อ (page, psid) ข้ามส่วนที่รูปแบบไม่ถูกต้อง"""
+    interactions: InteractionMap = {}
+    for body in bodies:
+        entries = body.get("entry") if isinstance(body, dict) else None
+        if not isinstance(entries, list):
+            continue
+        for entry in entries:
+            if not isinstance(entry, dict):
+                continue
+            page_id = entry.get("id")
+            messaging = entry.get("messaging")
+            if not isinstance(page_id, (str, int)) or not page_id or not isinstance(messaging, list):
+                continue
+            page_id = str(page_id)
+            for msg_event in messaging:
+                sender = msg_event.get("sender") if isinstance(msg_event, dict) else None
+                sender_id = sender.get("id") if isinstance(sender, dict) else None
+                if not isinstance(sender_id, (str, int)) or not sender_id:
+                    continue
+                sender_id = str(sender_id)
+                if sender_id == page_id:
+                    continue
+                timestamp = msg_event.get("timestamp") or entry.get("time")
+                try:
+                    event_time = datetime.fromtimestamp(timestamp / 1000, tz=timezone.utc)
+                except (TypeError, ValueError, OverflowError, OSError):
+                    event_time = datetime.now(timezone.utc)
+                key = (page_id, sender_id)
+                if key not in interactions or event_time > interactions[key]:
+                    interactions[key] = event_time
+    return interactions
+
+
+def _stream_id_key(entry_id: str) -> Tuple[int, int]:
+    ms, _, seq = entry_id.partition("-")
+    return int(ms), int(seq or 0)
+
+
+class WebhookIngestor:
+    def __init__(self):
+        self.is_running = False
+        self.stream = config.WEBHOOK_STREAM_KEY
+        self.group = config.WEBHOOK_CONSUMER_GROUP
+        self.consumer = f"{socket.gethostname()}:{os.getpid()}"
+        self._last_claim = 0.0
+
+    def _ensure_group(self):
+        try:
+            r.xgroup_create(self.stream, self.group, id="0", mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def _read_batch(self) -> List[Tuple[str, Dict[str, str]]]:
+        # claim event ที่ค้างใน consumer อื่นนานเกินกำหนดก่อน
+        now = time.monotonic()
+        if now - self._last_claim >= config.WEBHOOK_CLAIM_IDLE_SECONDS:
+            self._last_claim = now
+            claimed = r.xautoclaim(
+                self.stream, self.group, self.consumer,
+                min_idle_time=config.WEBHOOK_CLAIM_IDLE_SECONDS * 1000,
+                start_id="0-0", count=config.WEBHOOK_BATCH_SIZE
+            )
+            if claimed and claimed[1]:
+                logger.warning(f"♻️ Reclaimed {len(claimed[1])} stale webhook events")
+                entries = self._drop_exhausted([(entry_id, fields) for entry_id, fields in claimed[1] if fields])
+                if entries:
+                    return entries
+
+        result = r.xreadgroup(
+            self.group, self.consumer, {self.stream: ">"},
+            count=config.WEBHOOK_BATCH_SIZE, block=config.WEBHOOK_BLOCK_MS
+        )
+        return result[0][1] if result else []
+
+    def _drop_exhausted(self, entries: List[Tuple[str, Dict[str, str]]]) -> List[Tuple[str, Dict[str, str]]]:
+        """ย้าย event ที่ถูกส่งเกิน WEBHOOK_MAX_DELIVERIES ครั้งไป dead-letter stream แล้ว ack คืน event ที่เหลือ"""
+        if not entries:
+            return entries
+        ids = [entry_id for entry_id, _ in entries]
+        pending = r.xpending_range(
+            self.stream, self.group, min=min(ids, key=_stream_id_key), max=max(ids, key=_stream_id_key),
+            count=len(ids) * 2, consumername=self.consumer
+        )
+        deliveries = {item["message_id"]: item["times_delivered"] for item in pending}
+
+        exhausted = [(entry_id, fields) for entry_id, fields in entries
+                     if deliveries.get(entry_id, 0) > config.WEBHOOK_MAX_DELIVERIES]
+        if not exhausted:
+            return entries
+
+        pipe = r.pipeline()
+        for entry_id, fields in exhausted:
+            pipe.xadd(
+                config.WEBHOOK_DEAD_LETTER_KEY,
+                {**fields, "source_id": entry_id, "deliveries": deliveries[entry_id]},
+                maxlen=config.WEBHOOK_STREAM_MAXLEN, approximate=True
+            )
+        pipe.xack(self.stream, self.group, *[entry_id for entry_id, _ in exhausted])
+        pipe.execute()
+        logger.error(f"☠️ Moved {len(exhausted)} webhook events to {config.WEBHOOK_DEAD_LETTER_KEY} after repeated failures")
+
+        dropped = {entry_id for entry_id, _ in exhausted}
+        return [(entry_id, fields) for entry_id, fields in entries if entry_id not in dropped]
+
+    def process_batch(self, entries: List[Tuple[str, Dict[str, str]]]):
+        """รวม event ของ batch แล้วอัพเดท DB ครั้งเดียว"""
+        from app.celery_task.webhook_task import sync_new_user_data_task
+        from app.service.sse_hub import publish
+
+        bodies = []
+        for entry_id, fields in entries:
+            try:
+                bodies.append(json.loads(fields.get("body", "{}")))
+            except ValueError:
+                logger.error(f"Invalid webhook payload in stream entry {entry_id}")
+
+        interactions = coalesce_interactions(bodies)
+        if not interactions:
+            return
+
+        db = SessionLocal()
+        try:
+            page_refs = {page_id: crud.get_page_ref(db, page_id) for page_id in {page_id for page_id, _ in interactions}}
+            page_db_ids = {page_id: page.ID for page_id, page in page_refs.items() if page}
+
+            keys = [key for key in interactions if key[0] in page_db_ids]
+            if not keys:
+                return
+
+            # อัพเดทเฉพาะให้เวลาเดินหน้า และเติม first_interaction_at ถ้ายังว่าง
+            updated = db.execute(text("""
+                UPDATE fb_customers c
+                SET last_interaction_at = GREATEST(COALESCE(c.last_interaction_at, v.ts), v.ts),
+                    first_interaction_at = COALESCE(c.first_interaction_at, v.ts),
+                    updated_at = now()
+                FROM unnest(CAST(:page_db_ids AS integer[]), CAST(:psids AS text[]), CAST(:times AS timestamptz[]))
+                     AS v(page_db_id, psid, ts)
+                WHERE c.page_id = v.page_db_id AND c.customer_psid = v.psid
+                RETURNING c.id, c.page_id, c.customer_psid, c.name, c.first_interaction_at,
+                          c.last_interaction_at, c.source_type, c.current_category_id
+            """), {
+                "page_db_ids": [page_db_ids[page_id] for page_id, _ in keys],
+                "psids": [psid for _, psid in keys],
+                "times": [interactions[key] for key in keys],
+            }).fetchall()
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+        page_ids = {page_db_id: page_id for page_id, page_db_id in page_db_ids.items()}
+        existing = set()
+        sse_updates: Dict[str, List[Dict[str, Any]]] = {}
+        for row in updated:
+            page_id = page_ids[row.page_id]
+            existing.add((page_id, row.customer_psid))
+            sse_updates.setdefault(page_id, []).append({
+                'id': row.id,
+                'psid': row.customer_psid,
+                'name': row.name or f"User...{row.customer_psid[-8:]}",
+                'first_interaction': row.first_interaction_at.isoformat() if row.first_interaction_at else None,
+                'last_interaction': row.last_interaction_at.isoformat() if row.last_interaction_at else None,
+                'source_type': row.source_type,
+                'current_category_id': row.current_category_id,
+                'action': 'update'
+            })
+        for page_id, updates in sse_updates.items():
+            publish(page_id, 'customer_update', updates)
+
+        # ✅ user ที่ยังไม่มีใน DB ส่งให้ Celery sync (กันส่งซ้ำระหว่างที่ task ยังทำงานอยู่)
+        new_users = [key for key in keys if key not in existing]
+        for page_id, sender_id in new_users:
+            if r.set(f"webhook:new_user:{page_id}:{sender_id}", 1, nx=True, ex=config.WEBHOOK_NEW_USER_LOCK_SECONDS):
+                logger.info(f"🆕 New user detected: {sender_id} in page {page_id}")
+                sync_new_user_data_task.delay(page_id, sender_id, page_db_ids[page_id])
+
+        logger.info(
+            f"📥 Webhook batch: {len(entries)} payloads -> {len(keys)} users "
+            f"({len(updated)} updated, {len(new_users)} new)"
+        )
+
+    def run(self):
+        """loop หลักของ consumer (รันใน thread แยก)"""
+        self.is_running = True
+        logger.info(f"Webhook consumer {self.consumer} started")
+        while self.is_running:
+            try:
+                self._ensure_group()
+                while self.is_running:
+                    entries = self._read_batch()
+                    if not entries:
+                        continue
+                    self.process_batch(entries)
+                    r.xack(self.stream, self.group, *[entry_id for entry_id, _ in entries])
+            except Exception as e:
+                # ไม่ ack - event จะถูก claim ใหม่ภายหลัง
+                logger.error(f"Webhook consumer error: {e}")
+                time.sleep(1)
+        logger.info(f"Webhook consumer {self.consumer} stopped")
+
+    def stop(self):
+        self.is_running = False
+
+
+# สร้าง instance กลาง
+webhook_ingestor = WebhookIngestor()
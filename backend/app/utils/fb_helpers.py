@@ -23,7 +23,8 @@ def parse_datetime_bangkok(dt_str: str) -> datetime:
         return None
 
 # ฟังก์ชันสำหรับประมวลผล conversation และดึงข้อมูลลูกค้า
-def process_conversation(convo, page_id, access_token, filter_start_date=None, filter_end_date=None):
+# - resolve_name=False: ใช้ชื่อจาก participants เท่านั้น (เมื่อ batch ดึงชื่อไว้แล้ว)
+def process_conversation(convo, page_id, access_token, filter_start_date=None, filter_end_date=None, resolve_name=True):
     try:
         convo_id = convo.get("id")
         updated_time_str = convo.get("updated_time")
@@ -66,11 +67,11 @@ def process_conversation(convo, page_id, access_token, filter_start_date=None, f
 
                 # ดึงชื่อ
                 user_name = participant.get("name")
-                if not user_name:
+                if not user_name and resolve_name:
                     user_info = get_user_info_from_psid(participant_id, access_token)
                     user_name = user_info.get("name")
 
-                if not user_name or user_name.startswith("User"):
+                if resolve_name and (not user_name or user_name.startswith("User")):
                     name_from_msg = get_name_from_messages(convo_id, access_token, page_id)
                     if name_from_msg:
                         user_name = name_from_msg
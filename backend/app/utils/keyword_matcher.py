@@ -0,0 +1,114 @@
+# backend/app/utils/keyword_matcher.py
+"""
+Keyword Matcher
+- รวม keywords ทุกหมวดของเพจเป็น regex เดียวที่ compile ครั้งเดียว ตรวจข้อความได้ในการอ่านรอบเดียว
+- normalize ข้อความไทย (NFKC, ตัด zero-width, ช่องว่างซ้ำ) ทั้ง keyword และข้อความ
+- cache ต่อเพจ/ชุด knowledge และล้างเมื่อแก้ไขกลุ่มลูกค้าหรือ knowledge
+"""
+
+import hashlib
+import re
+import unicodedata
+from typing import Any, Iterable, List, Optional, Sequence, Tuple
+
+from app import config
+from app.utils.local_cache import TTLCache, publish_invalidation
+
+_ZERO_WIDTH = re.compile(r'[\u200b-\u200d\u2060\ufeff]')
+_WHITESPACE = re.compile(r'\s+')
+_ASCII_WORD = re.compile(r'[a-z0-9_]')
+
+# key: "knowledge:<hash>" และ "custom:<page DB ID>"
+matcher_cache = TTLCache("keyword_matcher", maxsize=config.PAGE_CACHE_MAXSIZE, ttl=config.PAGE_CACHE_TTL_SECONDS)
+
+
+def normalize_text(text: str) -> str:
+    text = unicodedata.normalize("NFKC", text or "")
+    text = _ZERO_WIDTH.sub("", text)
+    return _WHITESPACE.sub(" ", text).strip().lower()
+
+
+def split_keywords(keywords) -> List[str]:
+    """รองรับทั้ง ARRAY และ string คั่นด้วย comma แบบเดิม"""
+    if not keywords:
+        return []
+    if isinstance(keywords, str):
+        keywords = keywords.split(",")
+    return [keyword for keyword in (normalize_text(k) for k in keywords) if keyword]
+
+
+class KeywordMatcher:
+    """
+    entries: [(label, keywords)] เรียงตามลำดับความสำคัญ
+    match() คืน label ของ entry แรกที่มี keyword อยู่ในข้อความ (เหมือนการวนตรวจทีละหมวดแบบเดิม)
+    word_boundary=True: keyword ภาษาอังกฤษ/ตัวเลขต้องเป็นคำเต็ม ส่วนภาษาไทย (ไม่มีช่องว่างระหว่างคำ) ตรวจแบบ substring
+    """
+
+    def __init__(self, entries: Iterable[Tuple[Any, Sequence[str]]], word_boundary: bool = False):
+        self._labels = []
+        self._priority = {}
+        for priority, (label, keywords) in enumerate(entries):
+            self._labels.append(label)
+            for keyword in split_keywords(keywords):
+                self._priority.setdefault(keyword, priority)
+
+        if not self._priority:
+            self._pattern = None
+            return
+
+        # keyword ที่สำคัญกว่า/ยาวกว่ามาก่อน และใช้ lookahead เพื่อหา match ได้ทุกตำแหน่ง (ซ้อนกันได้)
+        ordered = sorted(self._priority, key=lambda k: (self._priority[k], -len(k)))
+        alternatives = [self._wrap(keyword, word_boundary) for keyword in ordered]
+        self._pattern = re.compile(r'(?=(' + '|'.join(alternatives) + r'))')
+
+    @staticmethod
+    def _wrap(keyword: str, word_boundary: bool) -> str:
+        pattern = re.escape(keyword)
+        if word_boundary:
+            if _ASCII_WORD.match(keyword[0]):
+                pattern = r'(?<![a-z0-9_])' + pattern
+            if _ASCII_WORD.match(keyword[-1]):
+                pattern = pattern + r'(?![a-z0-9_])'
+        return pattern
+
+    def match(self, text: str) -> Optional[Any]:
+        if self._pattern is None or not text:
+            return None
+        best = None
+        for found in self._pattern.finditer(normalize_text(text)):
+            priority = self._priority.get(found.group(1))
+            if priority is not None and (best is None or priority < best):
+                best = priority
+                if best == 0:
+                    break
+        return self._labels[best] if best is not None else None
+
+
+def get_knowledge_matcher(knowledge_map: dict) -> KeywordMatcher:
+    """matcher ของ knowledge types (key ตาม id + keywords จึงเปลี่ยนตามเมื่อแก้ keywords)"""
+    knowledge = list(knowledge_map.values())
+    digest = hashlib.sha1(repr([(k.id, k.keywords) for k in knowledge]).encode("utf-8")).hexdigest()
+    return matcher_cache.get_or_load(
+        f"knowledge:{digest}",
+        lambda: KeywordMatcher(((k.id, k.keywords) for k in knowledge), word_boundary=True)
+    )
+
+
+def get_custom_group_matcher(db, page_db_id: int) -> KeywordMatcher:
+    """matcher ของกลุ่มลูกค้า (custom) ที่ active ของเพจ - label คือ group id"""
+    from app.database import crud
+
+    return matcher_cache.get_or_load(
+        f"custom:{page_db_id}",
+        lambda: KeywordMatcher(
+            (group.id, group.keywords) for group in crud.get_customer_types_by_page(db, page_db_id)
+        )
+    )
+
+
+def invalidate_custom_groups(page_db_id: int):
+    publish_invalidation("keyword_matcher", [f"custom:{page_db_id}"])
+
+
+def invalidate_knowledge():
+    publish_invalidation("keyword_matcher")
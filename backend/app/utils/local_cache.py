@@ -0,0 +1,134 @@
+# backend/app/utils/local_cache.py
+"""
+Local Cache
+- LRU + TTL cache ในหน่วยความจำของ process (thread-safe)
+- เมื่อข้อมูลต้นทางเปลี่ยน เรียก publish_invalidation() เพื่อล้าง cache ของทุก process ผ่าน Redis pub/sub
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Iterable, Optional
+
+from app import config
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+_caches: Dict[str, "TTLCache"] = {}
+# PID ของ process ที่ start listener แล้ว (Celery prefork: process ลูกไม่ได้ thread ของ parent มาด้วย)
+_listener_pid: Optional[int] = None
+_listener_lock = threading.Lock()
+
+
+class TTLCache:
+    def __init__(self, name: str, maxsize: int, ttl: float):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        _caches[name] = self
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        _start_invalidation_listener()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires_at = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get_or_load(self, key: Hashable, loader: Callable[[], Any]) -> Any:
+        """คืนค่าจาก cache หรือเรียก loader (ไม่ cache ค่า None)"""
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = loader()
+            if value is not None:
+                self.set(key, value)
+        return value
+
+    def invalidate(self, keys: Optional[Iterable[Hashable]] = None):
+        """ล้าง key ที่ระบุ (หรือทั้งหมดถ้าไม่ระบุ) เฉพาะใน process นี้"""
+        with self._lock:
+            if keys is None:
+                self._data.clear()
+                return
+            for key in keys:
+                self._data.pop(key, None)
+
+
+def publish_invalidation(cache_name: str, keys: Optional[Iterable[str]] = None):
+    """ล้าง cache ใน process นี้ทันที แล้วแจ้ง process อื่นผ่าน Redis"""
+    import json
+    import redis
+    from app.utils.redis_helper import r
+
+    keys = list(keys) if keys is not None else None
+    cache = _caches.get(cache_name)
+    if cache:
+        cache.invalidate(keys)
+    try:
+        r.publish(config.CACHE_INVALIDATION_CHANNEL, json.dumps({"cache": cache_name, "keys": keys}))
+    except redis.RedisError as e:
+        logger.warning(f"⚠️ Cannot publish cache invalidation for {cache_name}: {e}")
+
+
+def _listen_for_invalidations():
+    import json
+    from app.utils.redis_helper import r
+
+    while True:
+        try:
+            pubsub = r.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(config.CACHE_INVALIDATION_CHANNEL)
+            for message in pubsub.listen():
+                data = json.loads(message["data"])
+                cache = _caches.get(data.get("cache"))
+                if cache:
+                    cache.invalidate(data.get("keys"))
+        except Exception as e:
+            logger.warning(f"⚠️ Cache invalidation listener error, clearing local caches: {e}")
+            # อาจพลาด invalidation ระหว่างหลุด จึงล้างทั้งหมด
+            for cache in list(_caches.values()):
+                cache.invalidate()
+            time.sleep(1)
+
+
+def _start_invalidation_listener():
+    """start listener ครั้งแรกที่ใช้ cache ในแต่ละ process (รวมถึง process ที่ fork มา)"""
+    global _listener_pid
+    pid = os.getpid()
+    if _listener_pid == pid:
+        return
+    with _listener_lock:
+        if _listener_pid == pid:
+            return
+        _listener_pid = pid
+    threading.Thread(target=_listen_for_invalidations, name="cache-invalidation", daemon=True).start()
+
+
+def _reset_after_fork():
+    # ค่าที่ cache ไว้ก่อน fork อาจพลาด invalidation ระหว่างที่ process ลูกยังไม่มี listener จึงล้างทิ้ง
+    global _listener_lock
+    _listener_lock = threading.Lock()
+    for cache in _caches.values():
+        cache._lock = threading.Lock()
+        cache._data.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
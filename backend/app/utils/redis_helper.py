@@ -1,5 +1,7 @@
 import os
 import redis
+from app import config
+from app.utils.local_cache import TTLCache, publish_invalidation
 
 REDIS_HOST = os.getenv("REDIS_HOST", "redis")
 REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
@@ -15,17 +17,24 @@ except redis.ConnectionError as e:
     print(f"❌ Redis connection failed: {e}")
     raise
 
+# cache token ใน process (ไม่ต้อง GET Redis ทุกครั้งที่เรียก Graph API)
+token_cache = TTLCache("page_token", maxsize=config.PAGE_CACHE_MAXSIZE, ttl=config.TOKEN_CACHE_TTL_SECONDS)
+
 def store_page_token(page_id: str, access_token: str, expires_in: int = 3600*24*30):
     key = f"page_token:{page_id}"
     r.setex(key, expires_in, access_token)
+    publish_invalidation("page_token", [page_id])
     print(f"✅ Stored token for page_id={page_id} with key={key}")
     return True
 
 def get_page_token(page_id: str):
+    token = token_cache.get(page_id)
+    if token:
+        return token
     key = f"page_token:{page_id}"
-    print(f"🔍 Checking Redis for key: {key}")
     token = r.get(key)
     if token:
+        token_cache.set(page_id, token)
         print(f"✅ Found token for page_id={page_id}")
     else:
         print(f"⚠️ Token not found for page_id={page_id} in Redis {REDIS_HOST}:{REDIS_PORT}/{REDIS_DB}")
@@ -34,5 +43,6 @@ def get_page_token(page_id: str):
 def delete_page_token(page_id: str):
     key = f"page_token:{page_id}"
     r.delete(key)
+    publish_invalidation("page_token", [page_id])
     print(f"🗑 Deleted token for page_id={page_id}")
     return True
\ No newline at end of file
@@ -992,10 +992,18 @@ function App() {
   // SECTION 14: REALTIME UPDATES HOOK
   // =====================================================
   
+  // ✅ server แจ้งว่า event ที่พลาดไปส่งย้อนหลังไม่ได้ → โหลดรายชื่อลูกค้าของเพจที่เลือกใหม่
+  const handleRealtimeResync = useCallback(async (pageId) => {
+    if (pageId !== selectedPage) return;
+    await loadConversations(selectedPage, true, false, true);
+    await loadMiningStatuses(selectedPage);
+  }, [selectedPage, loadConversations, loadMiningStatuses]);
+
   const { disconnect, reconnect } = useRealtimeUpdates(
     pages,              // ✅ ส่ง pages ทั้งหมด
     selectedPage,       // ✅ ส่ง selectedPage เพื่อใช้ในการแสดง notification
-    handleRealtimeUpdate // ✅ callback รับ pageId ด้วย
+    handleRealtimeUpdate, // ✅ callback รับ pageId ด้วย
+    handleRealtimeResync  // ✅ โหลดใหม่ทั้งหมดเมื่อได้รับ resync
   );
 
   // =====================================================
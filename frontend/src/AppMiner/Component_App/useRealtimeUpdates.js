@@ -2,11 +2,12 @@
 
 import { useEffect, useRef, useCallback } from 'react';
 
-export const useRealtimeUpdates = (pages, selectedPageId, onUpdate) => {
+export const useRealtimeUpdates = (pages, selectedPageId, onUpdate, onResync) => {
   const eventSourcesRef = useRef({});
   const reconnectTimeoutsRef = useRef({});
   const reconnectAttemptsRef = useRef({});
   const lastEventIdsRef = useRef({});
+  const lastStreamIdsRef = useRef({});
 
   // ✅ สร้าง connection สำหรับเพจเดียว
   const connectToPage = useCallback((pageId) => {
@@ -20,8 +21,11 @@ export const useRealtimeUpdates = (pages, selectedPageId, onUpdate) => {
 
     console.log(`🔌 Connecting to SSE for page ${pageId}`);
     
+    // ✅ ส่ง id ล่าสุดที่ได้รับ เพื่อให้ server ส่งเฉพาะ event ที่พลาดไป
+    const lastStreamId = lastStreamIdsRef.current[pageId];
+    const query = lastStreamId ? `?last_event_id=${encodeURIComponent(lastStreamId)}` : '';
     const eventSource = new EventSource(
-      `http://localhost:8000/sse/customers/${pageId}`
+      `http://localhost:8000/sse/customers/${pageId}${query}`
     );
     
     eventSourcesRef.current[pageId] = eventSource;
@@ -34,6 +38,9 @@ export const useRealtimeUpdates = (pages, selectedPageId, onUpdate) => {
     eventSource.onmessage = (event) => {
       try {
         const data = JSON.parse(event.data);
+        if (event.lastEventId) {
+          lastStreamIdsRef.current[pageId] = event.lastEventId;
+        }
         
         // ป้องกันข้อมูลซ้ำ
         const eventId = data.id || data.timestamp;
@@ -68,6 +75,14 @@ export const useRealtimeUpdates = (pages, selectedPageId, onUpdate) => {
             }
             break;
             
+          case 'resync':
+            // event ที่พลาดไปเก่าเกินกว่าที่ server เก็บไว้ → โหลดข้อมูลทั้งหมดใหม่
+            console.warn(`⚠️ [${pageId}] Missed updates could not be replayed, reloading`);
+            if (onResync) {
+              onResync(pageId);
+            }
+            break;
+
           case 'heartbeat':
             // Heartbeat - ไม่ต้องทำอะไร
             break;
@@ -100,7 +115,7 @@ export const useRealtimeUpdates = (pages, selectedPageId, onUpdate) => {
         connectToPage(pageId);
       }, delay);
     };
-  }, [onUpdate]);
+  }, [onUpdate, onResync]);
 
   // ✅ เชื่อมต่อทุกเพจ
   const connectAllPages = useCallback(() => {